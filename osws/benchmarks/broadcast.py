@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Broadcast throughput of the server fan-out to many subscribers.
+
+Each subscriber writes to a transport which discards its data, so this
+measures the cost of routing, queueing, framing and writing notifications
+inside the server. The send mode frames every message for every
+subscriber, the way websockets.send() does, and frame_once writes a frame
+shared by all subscribers.
+
+Run with ``python -m osws.benchmarks.broadcast``.
+"""
+
+import argparse
+import asyncio
+import collections
+import time
+
+from websockets import frames
+
+from osws.benchmarks import samples
+from osws.benchmarks import utils
+from osws import server as osws_server
+
+SEND = 'send'
+FRAME_ONCE = 'frame_once'
+
+
+class NullTransport(object):
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def get_write_buffer_limits(self):
+        return 16 * 1024, 64 * 1024
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+class SendWebsocket(object):
+    """Frames every message itself, as websockets does."""
+
+    subprotocol = None
+
+    def __init__(self):
+        self.null_transport = NullTransport()
+
+    async def send(self, data):
+        frame = frames.Frame(frames.OP_TEXT, data.encode('utf-8'))
+        self.null_transport.write(frame.serialize(mask=False, extensions=[]))
+
+
+class FrameOnceWebsocket(object):
+    """Accepts shared frames written to its transport."""
+
+    subprotocol = None
+    extensions = []
+
+    def __init__(self):
+        self.transport = self.null_transport = NullTransport()
+
+    async def ensure_open(self):
+        pass
+
+    async def drain(self):
+        pass
+
+
+class NullSource(object):
+    def add_message_handler(self, handler):
+        pass
+
+
+async def _broadcast(mode, subscribers, messages):
+    srv = osws_server.Server(notify_source=NullSource(),
+                             send_queue_size=messages + 1,
+                             replay_count=0)
+    websocket_cls = FrameOnceWebsocket if mode == FRAME_ONCE else SendWebsocket
+    conns = []
+    for _ in range(subscribers):
+        conn = osws_server.Connection(websocket_cls(), srv._subscriptions,
+                                      send_queue_size=messages + 1)
+        srv._subscriptions.add_subscription('compute', conn)
+        conn.start()
+        conns.append(conn)
+    bodies = [samples.amqp_body(samples.nova_instance_update())
+              for _ in range(messages)]
+    await asyncio.sleep(0)
+
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    for body in bodies:
+        srv._handle_amqp_message(None, body)
+    while any(conn.queue_depth for conn in conns):
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+
+    written = sum(conn.websocket.null_transport.written for conn in conns)
+    for conn in conns:
+        conn.stop()
+    return elapsed, cpu, written
+
+
+def run(subscribers=10000, messages=100, modes=(SEND, FRAME_ONCE)):
+    results = collections.OrderedDict()
+    loop = asyncio.new_event_loop()
+    try:
+        for mode in modes:
+            elapsed, cpu, written = loop.run_until_complete(
+                _broadcast(mode, subscribers, messages)
+            )
+            results['%s_msgs_per_cpu_second' % mode] = messages / cpu
+            results['%s_deliveries_per_second' % mode] = (
+                messages * subscribers / elapsed)
+            results['%s_mbytes_written' % mode] = written / 1024.0 / 1024.0
+    finally:
+        loop.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subscribers', type=int, default=10000,
+                        help='Number of subscribed connections.')
+    parser.add_argument('--messages', type=int, default=100,
+                        help='Notifications to broadcast.')
+    parser.add_argument('--mode', choices=[SEND, FRAME_ONCE], action='append',
+                        help='Fan-out to measure, may be repeated. Defaults '
+                             'to all of them.')
+    args = parser.parse_args(argv)
+    print('%d subscribers, %d notifications' %
+          (args.subscribers, args.messages))
+    utils.print_results(run(args.subscribers, args.messages,
+                            args.mode or (SEND, FRAME_ONCE)), unit='')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Encode and decode throughput of the message codec.
+
+Run with ``python -m osws.benchmarks.codec``.
+"""
+
+import argparse
+import collections
+import json
+
+from osws.benchmarks import samples
+from osws.benchmarks import utils
+from osws import jsonutils
+from osws import messages
+
+
+def run(number=20000):
+    body = samples.amqp_body(samples.nova_instance_update())
+    notification = messages.Notification.from_amqp(body)
+    subscribe = json.dumps({'cmd_type': 'subscribe',
+                            'payload': {'services': ['compute', 'network']}})
+    legacy_subscribe = json.dumps({
+        'cmd_type': 'subscribe',
+        'payload': json.dumps({'services': ['compute', 'network']})
+    })
+
+    results = collections.OrderedDict()
+    results['notification_from_amqp'] = utils.rate(
+        lambda: messages.Notification.from_amqp(body), number)
+    results['command_encode'] = utils.rate(
+        lambda: messages.Command.encode(notification), number)
+    results['command_for_message_to_json'] = utils.rate(
+        lambda: messages.Command.for_message(notification).to_json(), number)
+    results['command_decode'] = utils.rate(
+        lambda: messages.Command.from_json(subscribe).get_message(), number)
+    results['command_decode_double_encoded'] = utils.rate(
+        lambda: messages.Command.from_json(legacy_subscribe).get_message(),
+        number)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000,
+                        help='Operations per timing run.')
+    args = parser.parse_args(argv)
+    print('JSON backend: %s' % jsonutils.BACKEND)
+    utils.print_results(run(args.number), unit='msgs/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Throughput of the AMQP ingest path, without a broker or websockets.
+
+NotificationConsumer is connected to an in-process fake of pika's
+SelectConnection and channel, which delivers notifications to on_message
+as fast as it can. The scenarios add the server's decoding, sequencing,
+replay buffering and routing, subscribers which encode what they are sent,
+and debug logging, so the cost of each stage can be told apart.
+
+CPython has no counter of all allocations, so memory is reported per
+message as the high-water mark of memory tracemalloc saw allocated while
+handling it, and as the blocks still allocated once all messages were
+handled, which includes what the replay buffer holds on to.
+
+Run with ``python -m osws.benchmarks.ingest``.
+"""
+
+import argparse
+import collections
+import gc
+import logging
+import sys
+import time
+import tracemalloc
+
+from osws.benchmarks import samples
+from osws import consumer
+from osws import formats
+from osws import server as osws_server
+
+
+class FakeMethod(object):
+    __slots__ = ('delivery_tag',)
+
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class FakeProperties(object):
+    app_id = 'nova'
+
+
+class FakeChannel(object):
+    """Answers every RPC straight away and counts acknowledgements."""
+
+    def __init__(self):
+        self.acks = 0
+        self.on_message = None
+
+    def __int__(self):
+        return 1
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def add_on_cancel_callback(self, callback):
+        pass
+
+    def exchange_declare(self, callback, *args, **kwargs):
+        callback(None)
+
+    def queue_declare(self, callback, *args, **kwargs):
+        callback(None)
+
+    def queue_bind(self, callback, *args, **kwargs):
+        callback(None)
+
+    def basic_qos(self, callback, **kwargs):
+        callback(None)
+
+    def basic_consume(self, on_message, queue):
+        self.on_message = on_message
+        return 'ctag'
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.acks += 1
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        pass
+
+
+class FakeSelectConnection(object):
+    """Stands in for pika.SelectConnection, opening a FakeChannel."""
+
+    def __init__(self, on_open_callback):
+        self.channel_obj = FakeChannel()
+        self._on_open_callback = on_open_callback
+
+    def open(self):
+        self._on_open_callback(self)
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def add_timeout(self, deadline, callback):
+        # Acks are flushed by batch size while the benchmark runs
+        return object()
+
+    def remove_timeout(self, timeout_id):
+        pass
+
+    def channel(self, on_open_callback):
+        on_open_callback(self.channel_obj)
+
+
+class BenchmarkConsumer(consumer.NotificationConsumer):
+    def connect(self):
+        return FakeSelectConnection(self.on_connection_open)
+
+
+class NullConnection(object):
+    """A subscriber which encodes what it is sent and discards it."""
+
+    format = formats.JSON
+
+    def send_notification(self, encoded):
+        encoded.encode(self.format)
+
+
+def _consumer(with_server, subscribers, ack_batch_size):
+    nc = BenchmarkConsumer('amqp://localhost', 'notifications.info',
+                           ack_batch_size=ack_batch_size)
+    if with_server:
+        srv = osws_server.Server(notify_source=nc)
+        for _ in range(subscribers):
+            srv._subscriptions.add_subscription('compute', NullConnection())
+    nc._connection = nc.connect()
+    nc._connection.open()
+    return nc, nc._connection.channel_obj
+
+
+def _deliver(channel, bodies):
+    on_message = channel.on_message
+    properties = FakeProperties()
+    for tag, body in enumerate(bodies, 1):
+        on_message(channel, FakeMethod(tag), properties, body)
+
+
+def _transient_bytes(channel, bodies):
+    """Return the memory allocated while handling each message."""
+    on_message = channel.on_message
+    properties = FakeProperties()
+    total = 0
+    tracemalloc.start()
+    try:
+        for tag, body in enumerate(bodies, 1):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            on_message(channel, FakeMethod(tag), properties, body)
+            total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return total
+
+
+def run_scenario(number, with_server=True, subscribers=0,
+                 ack_batch_size=100, debug_logging=False):
+    makers = (samples.nova_instance_update, samples.neutron_port_create)
+    bodies = [samples.amqp_body(makers[i % 2]()).encode('utf-8')
+              for i in range(number)]
+    logger = logging.getLogger('osws')
+    handler = logging.NullHandler()
+    if debug_logging:
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+    try:
+        nc, channel = _consumer(with_server, subscribers, ack_batch_size)
+        started = time.perf_counter()
+        _deliver(channel, bodies)
+        elapsed = time.perf_counter() - started
+
+        acks = channel.acks
+        del nc, channel
+        gc.collect()
+
+        nc, channel = _consumer(with_server, subscribers, ack_batch_size)
+        blocks = sys.getallocatedblocks()
+        _deliver(channel, bodies)
+        gc.collect()
+        retained = sys.getallocatedblocks() - blocks
+
+        nc, channel = _consumer(with_server, subscribers, ack_batch_size)
+        sample = bodies[:min(number, 2000)]
+        transient = _transient_bytes(channel, sample)
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+    return {'msgs_per_second': number / elapsed,
+            'transient_bytes_per_msg': transient / float(len(sample)),
+            'retained_blocks_per_msg': retained / float(number),
+            'acks_per_msg': acks / float(number)}
+
+
+SCENARIOS = collections.OrderedDict([
+    ('consumer', {'with_server': False}),
+    ('server', {}),
+    ('server_1000_subscribers', {'subscribers': 1000}),
+    ('server_unbatched_acks', {'ack_batch_size': 1}),
+    ('server_debug_logging', {'debug_logging': True}),
+])
+
+
+def run(number=20000, scenarios=None):
+    results = collections.OrderedDict()
+    for name in scenarios or SCENARIOS:
+        results[name] = run_scenario(number, **SCENARIOS[name])
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000,
+                        help='Messages to deliver in each scenario.')
+    parser.add_argument('--scenario', choices=list(SCENARIOS),
+                        action='append',
+                        help='Scenario to run, may be repeated. Defaults to '
+                             'all of them.')
+    args = parser.parse_args(argv)
+    print('%-28s %12s %14s %12s %8s' % ('scenario', 'msgs/s', 'bytes/msg',
+                                        'blocks/msg', 'acks/msg'))
+    for name, result in run(args.number, args.scenario).items():
+        print('%-28s %12.1f %14.1f %12.2f %8.3f' % (
+            name, result['msgs_per_second'],
+            result['transient_bytes_per_msg'],
+            result['retained_blocks_per_msg'], result['acks_per_msg']))
+
+
+if __name__ == '__main__':
+    main()
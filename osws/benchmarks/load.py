@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""End-to-end load test of a server with many websocket clients.
+
+A server process runs Server with a synthetic notification source, which
+publishes nova and neutron shaped notifications at a fixed rate. Client
+processes open websocket connections to it on localhost, subscribe and
+time each notification from publication to receipt. Reported are the
+delivered notifications per second, end-to-end latency percentiles, the
+server's CPU usage while publishing and its memory use per connection.
+
+Run with ``python -m osws.benchmarks.load``.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import multiprocessing
+import random
+import time
+
+import websockets
+
+from osws.benchmarks import samples
+from osws.benchmarks import utils
+from osws import compression
+from osws import server as osws_server
+
+SENT_AT = 'osws_benchmark_sent_at'
+
+
+class SyntheticSource(object):
+    """A notify source publishing generated notifications at a rate."""
+
+    def __init__(self):
+        self._handlers = set()
+
+    def add_message_handler(self, handler):
+        self._handlers.add(handler)
+
+    def _notify(self, notification):
+        notification['payload'][SENT_AT] = time.time()
+        body = samples.amqp_body(notification)
+        for handler in self._handlers:
+            handler(None, body)
+
+    async def run(self, rate, duration, tick=0.01):
+        """Publish rate notifications per second for duration seconds."""
+        makers = (samples.nova_instance_update, samples.neutron_port_create)
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        published = 0
+        while True:
+            elapsed = loop.time() - started
+            due = int(min(elapsed, duration) * rate)
+            while published < due:
+                self._notify(makers[published % len(makers)]())
+                published += 1
+            if elapsed >= duration:
+                return published
+            await asyncio.sleep(tick)
+
+
+async def _serve(port, mode, control):
+    source = SyntheticSource()
+    srv = osws_server.Server(notify_source=source, host='127.0.0.1',
+                             port=port, send_queue_size=100000,
+                             compression_mode=mode)
+    await srv.start()
+    loop = asyncio.get_event_loop()
+    baseline_rss = utils.rss_bytes()
+    control.send('ready')
+
+    rate, duration = await loop.run_in_executor(None, control.recv)
+    connections = srv.connections
+    connected_rss = utils.rss_bytes()
+    cpu_started = time.process_time()
+    published = await source.run(rate, duration)
+    while any(conn.queue_depth for conn in connections):
+        await asyncio.sleep(0.01)
+    cpu = time.process_time() - cpu_started
+
+    control.send({'published': published,
+                  'connections': len(connections),
+                  'cpu_seconds': cpu,
+                  'baseline_rss': baseline_rss,
+                  'connected_rss': connected_rss})
+    srv.stop()
+    await srv.wait_closed()
+
+
+def serve(port, mode, control):
+    utils.raise_open_files_limit()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(_serve(port, mode, control))
+
+
+async def _receive(ws, latencies, received, idle_timeout):
+    while True:
+        try:
+            data = await asyncio.wait_for(ws.recv(), idle_timeout)
+        except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed):
+            return
+        now = time.time()
+        cmd = json.loads(data)
+        if cmd['cmd_type'] != 'notification':
+            continue
+        latencies.append(now - cmd['payload']['payload'][SENT_AT])
+        received.append(now)
+
+
+async def _clients(port, count, ready, start, idle_timeout):
+    sockets = []
+    for _ in range(count):
+        ws = await websockets.connect('ws://127.0.0.1:%d/' % port,
+                                      max_queue=None)
+        await ws.send(json.dumps({
+            'cmd_type': 'subscribe',
+            'payload': {'services': ['compute', 'network']}
+        }))
+        await ws.recv()
+        sockets.append(ws)
+    ready.put(count)
+
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, start.wait)
+    latencies = []
+    received = []
+    await asyncio.gather(*[_receive(ws, latencies, received, idle_timeout)
+                           for ws in sockets])
+    for ws in sockets:
+        await ws.close()
+    return latencies, min(received or [0]), max(received or [0])
+
+
+def clients(port, count, ready, start, results, idle_timeout):
+    utils.raise_open_files_limit()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results.put(loop.run_until_complete(
+        _clients(port, count, ready, start, idle_timeout)
+    ))
+
+
+def run(connections=1000, rate=100, duration=10, client_processes=2,
+        mode=compression.PER_CONNECTION, idle_timeout=5):
+    port = random.randint(20000, 60000)
+    control, server_control = multiprocessing.Pipe()
+    server_proc = multiprocessing.Process(target=serve,
+                                          args=(port, mode, server_control))
+    server_proc.start()
+    control.recv()
+
+    ready = multiprocessing.Queue()
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    procs = []
+    for i in range(client_processes):
+        count = connections // client_processes
+        if i < connections % client_processes:
+            count += 1
+        proc = multiprocessing.Process(
+            target=clients,
+            args=(port, count, ready, start, results, idle_timeout)
+        )
+        proc.start()
+        procs.append(proc)
+    for _ in procs:
+        ready.get()
+
+    control.send((rate, duration))
+    start.set()
+    stats = control.recv()
+    latencies = []
+    first, last = [], []
+    for _ in procs:
+        client_latencies, client_first, client_last = results.get()
+        latencies.extend(client_latencies)
+        if client_latencies:
+            first.append(client_first)
+            last.append(client_last)
+    for proc in procs + [server_proc]:
+        proc.join()
+
+    latencies.sort()
+    window = (max(last) - min(first)) if first else 0
+    report = collections.OrderedDict()
+    report['connections'] = stats['connections']
+    report['published'] = stats['published']
+    report['delivered'] = len(latencies)
+    report['expected'] = stats['published'] * stats['connections']
+    report['delivered_per_second'] = (len(latencies) / window
+                                      if window else float('nan'))
+    for name, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+        report['latency_%s_ms' % name] = utils.percentile(
+            latencies, fraction) * 1000
+    report['server_cpu_seconds'] = stats['cpu_seconds']
+    report['server_cpu_percent'] = stats['cpu_seconds'] / duration * 100
+    report['rss_per_connection_kb'] = (
+        (stats['connected_rss'] - stats['baseline_rss']) /
+        max(stats['connections'], 1) / 1024.0)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=1000,
+                        help='Number of websocket clients.')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='Notifications published per second.')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds to publish for.')
+    parser.add_argument('--client-processes', type=int, default=2,
+                        help='Processes to spread the clients over.')
+    parser.add_argument('--compression', choices=compression.MODES,
+                        default=compression.PER_CONNECTION,
+                        help='Server compression mode.')
+    args = parser.parse_args(argv)
+    report = run(args.connections, args.rate, args.duration,
+                 args.client_processes, args.compression)
+    for name, value in report.items():
+        print('%-30s %14.2f' % (name, value))
+
+
+if __name__ == '__main__':
+    main()
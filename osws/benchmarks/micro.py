@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Micro-benchmarks of the codec and subscription map, with a regression gate.
+
+Results can be saved as JSON with --save, and compared with a saved
+baseline with --compare, in which case the exit status is 1 if any result
+is slower than the baseline by more than --threshold. Baselines are only
+comparable when taken on the same machine.
+
+Run with ``python -m osws.benchmarks.micro``.
+"""
+
+import argparse
+import collections
+import json
+import sys
+import time
+
+from osws.benchmarks import samples
+from osws.benchmarks import utils
+from osws import messages
+from osws import server as osws_server
+
+SERVICES = ('compute', 'network', 'image', 'volume', 'identity')
+
+
+class Client(object):
+    """Stands in for a Connection, which the map only hashes."""
+    __slots__ = ()
+
+
+def _best_rate(fn, number, repeat=3):
+    """Return the best ops per second of fn(), which does number ops."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return number / best
+
+
+def codec(number=20000):
+    notification = messages.Notification.from_amqp(
+        samples.amqp_body(samples.nova_instance_update()))
+    notification_json = notification.to_json()
+    subscribe = messages.Command.from_json(json.dumps({
+        'cmd_type': 'subscribe',
+        'payload': {'services': ['compute', 'network']}
+    }))
+
+    results = collections.OrderedDict()
+    results['notification_from_json'] = utils.rate(
+        lambda: messages.Notification.from_json(notification_json), number)
+    results['command_for_message_to_json'] = utils.rate(
+        lambda: messages.Command.for_message(notification).to_json(), number)
+    results['command_get_message'] = utils.rate(subscribe.get_message,
+                                                number)
+    return results
+
+
+def subscription_map(connections=100000):
+    clients = [Client() for _ in range(connections)]
+    state = {}
+
+    def add():
+        subs = state['map'] = osws_server.SubscriptionMap()
+        for i, client in enumerate(clients):
+            subs.add_subscription(SERVICES[i % len(SERVICES)], client)
+
+    def get():
+        get_connections = state['map'].get_connections
+        for i in range(connections):
+            get_connections(SERVICES[i % len(SERVICES)])
+
+    def remove():
+        subs = state['map']
+        for client in clients:
+            subs.remove_connection(client)
+
+    results = collections.OrderedDict()
+    results['subscription_map_add_subscription'] = _best_rate(add,
+                                                              connections)
+    results['subscription_map_get_connections'] = _best_rate(get, connections)
+
+    # Each removal needs a full map, so rebuild it between timings
+    best = None
+    for _ in range(3):
+        add()
+        started = time.perf_counter()
+        remove()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    results['subscription_map_remove_connection'] = connections / best
+    return results
+
+
+def run(number=20000, connections=100000):
+    results = codec(number)
+    results.update(subscription_map(connections))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000,
+                        help='Operations per codec timing run.')
+    parser.add_argument('--connections', type=int, default=100000,
+                        help='Connections in the subscription map.')
+    parser.add_argument('--save', metavar='PATH',
+                        help='Save the results as JSON.')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='Compare the results with a saved baseline.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown, as a fraction of the baseline, '
+                             'which counts as a regression.')
+    args = parser.parse_args(argv)
+
+    results = run(args.number, args.connections)
+    utils.print_results(results)
+    if args.save:
+        utils.save_results(args.save, results)
+    if args.compare:
+        regressions = utils.compare(results, utils.load_results(args.compare),
+                                    args.threshold)
+        for name, base, value, change in regressions:
+            print('REGRESSION %s: %.1f ops/s, baseline %.1f ops/s (%+.1f%%)'
+                  % (name, value, base, change * 100))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Notifications shaped like those emitted by nova and neutron."""
+
+import json
+import uuid
+
+
+def nova_instance_update(instance_id=None, state='active'):
+    instance_id = instance_id or str(uuid.uuid4())
+    return {
+        'event_type': 'compute.instance.update',
+        'publisher_id': 'compute.host1',
+        'priority': 'INFO',
+        'message_id': str(uuid.uuid4()),
+        'timestamp': '2016-06-01 12:00:00.000000',
+        'payload': {
+            'instance_id': instance_id,
+            'tenant_id': '4f5ba7b4ff2c4e0c8f2d1a6a6e4b3c2d',
+            'user_id': '9a1cc2c3f7a94f0d8f1ef7c3bd1c2a45',
+            'display_name': 'web-%s' % instance_id[:8],
+            'hostname': 'web-%s' % instance_id[:8],
+            'host': 'host1',
+            'node': 'host1.example.com',
+            'state': state,
+            'old_state': 'building',
+            'state_description': '',
+            'task_state': None,
+            'old_task_state': 'spawning',
+            'instance_type': 'm1.small',
+            'instance_type_id': 2,
+            'memory_mb': 2048,
+            'disk_gb': 20,
+            'root_gb': 20,
+            'ephemeral_gb': 0,
+            'vcpus': 1,
+            'image_ref_url': 'http://glance:9292/images/'
+                             'a3d0a3ae-2c8e-4a49-9a4c-0f3a4e6a8b41',
+            'image_meta': {'base_image_ref':
+                           'a3d0a3ae-2c8e-4a49-9a4c-0f3a4e6a8b41',
+                           'min_disk': '20', 'min_ram': '0',
+                           'container_format': 'bare',
+                           'disk_format': 'qcow2'},
+            'architecture': 'x86_64',
+            'os_type': 'linux',
+            'launched_at': '2016-06-01T12:00:00.000000',
+            'created_at': '2016-06-01 11:59:30+00:00',
+            'terminated_at': '',
+            'deleted_at': '',
+            'availability_zone': 'nova',
+            'reservation_id': 'r-3h6t2kq1',
+            'metadata': {},
+            'progress': '',
+            'access_ip_v4': None,
+            'access_ip_v6': None,
+            'cell_name': '',
+            'audit_period_beginning': '2016-06-01T00:00:00.000000',
+            'audit_period_ending': '2016-06-01T12:00:00.000000',
+            'bandwidth': {},
+        },
+    }
+
+
+def neutron_port_create(port_id=None):
+    port_id = port_id or str(uuid.uuid4())
+    return {
+        'event_type': 'port.create.end',
+        'publisher_id': 'network.controller1',
+        'priority': 'INFO',
+        'message_id': str(uuid.uuid4()),
+        'timestamp': '2016-06-01 12:00:00.000000',
+        'payload': {
+            'port': {
+                'id': port_id,
+                'name': '',
+                'network_id': 'c4d2b5a7-7f4c-4e59-9bd3-1a4b2c3d4e5f',
+                'tenant_id': '4f5ba7b4ff2c4e0c8f2d1a6a6e4b3c2d',
+                'mac_address': 'fa:16:3e:12:34:56',
+                'admin_state_up': True,
+                'status': 'DOWN',
+                'device_id': '',
+                'device_owner': '',
+                'fixed_ips': [{
+                    'subnet_id': '0d8f1ef7-c3bd-41c2-a459-a1cc2c3f7a94',
+                    'ip_address': '10.0.0.5',
+                }],
+                'allowed_address_pairs': [],
+                'extra_dhcp_opts': [],
+                'security_groups': ['8a6c1c2b-3d4e-4f5a-9b8c-7d6e5f4a3b2c'],
+                'binding:vnic_type': 'normal',
+                'binding:host_id': '',
+                'binding:vif_type': 'unbound',
+                'binding:vif_details': {},
+                'binding:profile': {},
+                'port_security_enabled': True,
+                'description': '',
+                'created_at': '2016-06-01T12:00:00',
+                'updated_at': '2016-06-01T12:00:00',
+            }
+        },
+    }
+
+
+def amqp_body(notification):
+    """Wrap a notification in the oslo.messaging 2.0 envelope."""
+    return json.dumps({'oslo.version': '2.0',
+                       'oslo.message': json.dumps(notification)})
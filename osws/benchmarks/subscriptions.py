@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Memory used by the subscription map with many connections.
+
+Connections subscribe to a few shared services and one service of their
+own, the way clients watching a single project do. Reported are the bytes
+allocated per subscription and per connection, what is still allocated
+once every connection is removed, and how much memory grows while
+connections come and go with services of their own. The same figures are
+given for a map of sets in both directions, as SubscriptionMap used to be,
+for comparison.
+
+Run with ``python -m osws.benchmarks.subscriptions``.
+"""
+
+import argparse
+import collections
+import gc
+import tracemalloc
+
+from osws.benchmarks import micro
+from osws import server as osws_server
+
+SHARED_SERVICES = ('compute', 'network', 'image', 'volume', 'identity',
+                   'orchestration', 'metering', 'dns')
+
+
+class SetSubscriptionMap(object):
+    """Services to sets of connections and back, without removal."""
+
+    def __init__(self):
+        self._service_map = collections.defaultdict(set)
+        self._connection_map = collections.defaultdict(set)
+
+    def add_subscription(self, service, connection):
+        self._service_map[service].add(connection)
+        self._connection_map[connection].add(service)
+
+    def remove_connection(self, connection):
+        for service in self._connection_map[connection]:
+            self._service_map[service].remove(connection)
+
+
+def _services(index, shared):
+    # Fresh strings, as decoded from each client's subscribe command
+    services = [
+        SHARED_SERVICES[(index + i) % len(SHARED_SERVICES)].encode(
+            'utf-8').decode('utf-8')
+        for i in range(shared)
+    ]
+    services.append('project-%d' % index)
+    return services
+
+
+def _allocated():
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def measure(map_cls, connections=100000, shared=3, churn_rounds=5):
+    replaced = max(connections // 10, 1)
+    # Everything the map is given is allocated up front, so that only the
+    # map's own memory is traced
+    total = connections + replaced * churn_rounds
+    clients = [micro.Client() for _ in range(total)]
+    subscriptions = [_services(i, shared) for i in range(total)]
+    num_subscriptions = sum(len(services)
+                            for services in subscriptions[:connections])
+
+    tracemalloc.start()
+    try:
+        subs = map_cls()
+        before = _allocated()
+        for client, services in zip(clients[:connections],
+                                    subscriptions[:connections]):
+            for service in services:
+                subs.add_subscription(service, client)
+        built = _allocated()
+
+        # Each round the oldest tenth of the connections are replaced
+        for index in range(connections, total):
+            subs.remove_connection(clients[index - connections])
+            for service in subscriptions[index]:
+                subs.add_subscription(service, clients[index])
+        churned = _allocated()
+
+        for client in clients[total - connections:]:
+            subs.remove_connection(client)
+        removed = _allocated()
+    finally:
+        tracemalloc.stop()
+
+    results = collections.OrderedDict()
+    results['bytes_per_subscription'] = (
+        (built - before) / float(num_subscriptions))
+    results['bytes_per_connection'] = (built - before) / float(connections)
+    results['churn_growth_bytes'] = churned - built
+    results['retained_after_removal_bytes'] = removed - before
+    return results
+
+
+def run(connections=100000, shared=3, churn_rounds=5):
+    results = collections.OrderedDict()
+    for name, map_cls in (('subscription_map', osws_server.SubscriptionMap),
+                          ('set_map', SetSubscriptionMap)):
+        results[name] = measure(map_cls, connections, shared, churn_rounds)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=100000,
+                        help='Number of subscribed connections.')
+    parser.add_argument('--shared', type=int, default=3,
+                        help='Shared services each connection subscribes '
+                             'to, besides one of its own.')
+    parser.add_argument('--churn-rounds', type=int, default=5,
+                        help='Rounds replacing a tenth of the connections.')
+    args = parser.parse_args(argv)
+    print('%d connections, %d subscriptions each' %
+          (args.connections, args.shared + 1))
+    print('%-18s %10s %10s %14s %14s' % ('map', 'bytes/sub', 'bytes/conn',
+                                         'churn growth', 'retained'))
+    for name, result in run(args.connections, args.shared,
+                            args.churn_rounds).items():
+        print('%-18s %10.1f %10.1f %14d %14d' % (
+            name, result['bytes_per_subscription'],
+            result['bytes_per_connection'], result['churn_growth_bytes'],
+            result['retained_after_removal_bytes']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import resource
+import timeit
+
+
+def rate(fn, number, repeat=3):
+    """Return the best calls per second of fn over repeat runs."""
+    best = min(timeit.repeat(fn, number=number, repeat=repeat))
+    return number / best
+
+
+def print_results(results, unit='ops/s'):
+    for name, value in results.items():
+        print('%-40s %14.1f %s' % (name, value, unit))
+
+
+def percentile(values, fraction):
+    """Return the value below which a fraction of sorted values fall."""
+    if not values:
+        return float('nan')
+    index = min(int(len(values) * fraction), len(values) - 1)
+    return values[index]
+
+
+def rss_bytes():
+    """Return the resident set size of this process."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        # Not Linux, fall back to the peak which is in KiB there
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def raise_open_files_limit():
+    """Allow as many open files as the hard limit does."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def save_results(path, results):
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
+        fp.write('\n')
+
+
+def load_results(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def compare(results, baseline, threshold=0.1):
+    """Find the results which are slower than a baseline.
+
+    Results are rates, so higher is better. Returns (name, baseline,
+    result, change) for each result which dropped by more than threshold,
+    a fraction of the baseline. Results missing from either side are not
+    compared.
+    """
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        change = (value - base) / float(base)
+        if change < -threshold:
+            regressions.append((name, base, value, change))
+    return regressions
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import collections
+
+from osws import filters
+
+DEFAULT_RESOURCE_FIELDS = ('payload.instance_id', 'payload.resource_id',
+                           'payload.id')
+
+
+class Coalescer(object):
+    """Merge bursts of notifications about the same resource.
+
+    Notifications are keyed by their event_type and the first of
+    resource_fields they have, and by the audience they are added for. The
+    first notification for a key opens a window, later ones within it
+    replace the pending notification, and the latest one is emitted when
+    the window closes. Notifications without a resource id are emitted
+    straight away.
+
+    Filters may route notifications about the same resource to different
+    connections, so only a notification for the same audience may replace
+    another. Otherwise a connection could be left without anything about a
+    resource it was sent a notification for.
+    """
+
+    def __init__(self, window, emit, resource_fields=DEFAULT_RESOURCE_FIELDS):
+        """
+        :param float window: Seconds to hold notifications for
+        :param emit: Called with (notification, encoded) for each
+            notification leaving the coalescer
+        :param resource_fields: Dotted notification fields holding the
+            resource id, in order of preference
+
+        """
+        self._window = window
+        self._emit = emit
+        self._paths = [tuple(field.split('.')) for field in resource_fields]
+        # key -> [deadline, notification, encoded], in deadline order
+        self._pending = collections.OrderedDict()
+        self._timer = None
+        self.merged = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def key(self, notification):
+        for path in self._paths:
+            value = filters.resolve(notification, path)
+            if value is filters.MISSING or value is None:
+                continue
+            key = (notification.get('event_type'), value)
+            try:
+                hash(key)
+            except TypeError:
+                continue
+            return key
+        return None
+
+    def add(self, notification, encoded, audience=None):
+        """Hold a notification back, or emit it if it has no resource id.
+
+        :param audience: A hashable identifying who the notification is
+            for, such as a frozenset of the connections it was routed to
+
+        """
+        key = self.key(notification)
+        if key is None:
+            self._emit(notification, encoded)
+            return
+        if audience is not None:
+            key += (audience,)
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending[1] = notification
+            pending[2] = encoded
+            self.merged += 1
+            return
+        loop = asyncio.get_event_loop()
+        self._pending[key] = [loop.time() + self._window, notification,
+                              encoded]
+        if self._timer is None:
+            self._timer = loop.call_later(self._window, self._emit_due)
+
+    def _emit_due(self):
+        self._timer = None
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        pending = self._pending
+        while pending:
+            deadline, notification, encoded = next(iter(pending.values()))
+            if deadline > now:
+                self._timer = loop.call_at(deadline, self._emit_due)
+                return
+            pending.popitem(last=False)
+            self._emit(notification, encoded)
+
+    def flush(self):
+        """Emit every pending notification now."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending = self._pending
+        while pending:
+            key, (deadline, notification, encoded) = pending.popitem(
+                last=False)
+            self._emit(notification, encoded)
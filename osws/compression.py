@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""permessage-deflate compression which is shared between connections.
+
+With the default extension every connection compresses each message it
+sends with its own compression context, so a notification broadcast to many
+subscribers is compressed once per subscriber. The shared mode negotiates
+server_no_context_takeover, which every client has to accept, so that each
+message is compressed on its own. The compressed bytes then only depend on
+the message and the negotiated window size, and are cached and reused by
+every connection sending the same message.
+"""
+
+import collections
+import dataclasses
+import zlib
+
+from websockets.extensions import permessage_deflate
+from websockets import frames
+
+NONE = 'none'
+PER_CONNECTION = 'per_connection'
+SHARED = 'shared'
+MODES = (NONE, PER_CONNECTION, SHARED)
+
+# Removed from the end of compressed messages, see RFC 7692 section 7.2.1
+_EMPTY_UNCOMPRESSED_BLOCK = b'\x00\x00\xff\xff'
+
+
+class CompressedCache(object):
+    """The compressed form of recently sent messages."""
+
+    def __init__(self, max_entries=256, compress_settings=None):
+        self._max_entries = max_entries
+        self._compress_settings = compress_settings or {}
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def compress(self, data, window_bits):
+        key = (window_bits, data)
+        entries = self._entries
+        try:
+            compressed = entries[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            entries.move_to_end(key)
+            return compressed
+
+        self.misses += 1
+        encoder = zlib.compressobj(wbits=-window_bits,
+                                   **self._compress_settings)
+        compressed = encoder.compress(data) + encoder.flush(zlib.Z_SYNC_FLUSH)
+        if compressed.endswith(_EMPTY_UNCOMPRESSED_BLOCK):
+            compressed = compressed[:-4]
+        entries[key] = compressed
+        if len(entries) > self._max_entries:
+            entries.popitem(last=False)
+        return compressed
+
+
+class SharedPerMessageDeflate(permessage_deflate.PerMessageDeflate):
+    def __init__(self, extension, cache):
+        super(SharedPerMessageDeflate, self).__init__(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings
+        )
+        self._cache = cache
+
+    def compress(self, data):
+        """Compress an unfragmented message, as encode() would."""
+        return self._cache.compress(data, self.local_max_window_bits)
+
+    def encode(self, frame):
+        # Fragmented messages are left to the per connection encoder
+        if (frame.opcode in frames.CTRL_OPCODES or
+                frame.opcode is frames.OP_CONT or not frame.fin):
+            return super(SharedPerMessageDeflate, self).encode(frame)
+        return dataclasses.replace(frame, rsv1=True,
+                                   data=self.compress(frame.data))
+
+
+class SharedDeflateFactory(permessage_deflate.ServerPerMessageDeflateFactory):
+    def __init__(self, cache, **kwargs):
+        kwargs['server_no_context_takeover'] = True
+        super(SharedDeflateFactory, self).__init__(**kwargs)
+        self._cache = cache
+
+    def process_request_params(self, params, accepted_extensions):
+        response, extension = super(
+            SharedDeflateFactory, self
+        ).process_request_params(params, accepted_extensions)
+        return response, SharedPerMessageDeflate(extension, self._cache)
+
+
+def server_extensions(mode, level=-1, window_bits=12, memory_level=5,
+                      cache_size=256):
+    """Return the websockets.serve arguments enabling a compression mode."""
+    if mode == NONE:
+        return {'compression': None}
+    if mode not in MODES:
+        raise ValueError('Invalid compression mode %s' % mode)
+    settings = {'level': level, 'memLevel': memory_level}
+    kwargs = {'server_max_window_bits': window_bits,
+              'client_max_window_bits': window_bits,
+              'compress_settings': settings}
+    if mode == SHARED:
+        factory = SharedDeflateFactory(
+            CompressedCache(cache_size, settings), **kwargs
+        )
+    else:
+        factory = permessage_deflate.ServerPerMessageDeflateFactory(**kwargs)
+    return {'extensions': [factory]}
@@ -12,25 +12,68 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import asyncio
+import functools
 import logging
+import urllib.parse
+
 import pika
+from pika.adapters import asyncio_connection
+
+from osws import metrics as osws_metrics
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
 LOGGER = logging.getLogger(__name__)
 
+NO_ORDERING = 'none'
+PER_SERVICE = 'per-service'
+PER_RESOURCE = 'per-resource'
+ORDERINGS = (NO_ORDERING, PER_SERVICE, PER_RESOURCE)
+
 
 class NotificationConsumer(object):
     EXCHANGE = 'amq.fanout'
     EXCHANGE_TYPE = 'fanout'
     EXCHANGE_DURABLE = True
     ROUTING_KEY = 'notifications.info'
+    RECONNECT_DELAY = 5
 
-    def __init__(self, amqp_url, queue_name):
+    def __init__(self, amqp_url, queue_name, prefetch_count=0,
+                 ack_batch_size=1, ack_interval=1.0, queue_auto_delete=False,
+                 metrics=None, dynamic_bindings=False,
+                 topic_exchange='amq.topic', binding_delay=5.0):
         """Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
 
+        Acknowledgements are batched: once a message has been accepted by
+        the message handlers its ack is held back until ack_batch_size
+        messages are pending or ack_interval seconds have passed, and all of
+        them are then acknowledged with a single Basic.Ack.
+
+        With dynamic_bindings the queue is bound to a topic exchange only
+        with the routing keys asked for through bind(), rather than to the
+        fanout exchange. Changes to the keys are applied binding_delay
+        seconds after the first of them, so a key which is dropped and
+        asked for again in the meantime is never unbound. The queue is then
+        named queue_name with a .dynamic suffix and is deleted once we stop
+        consuming from it. Bindings cannot be listed over AMQP, so this is
+        what keeps keys bound by an earlier run, or the fanout binding of
+        the plain queue, from delivering what nobody asked for.
+
         :param str amqp_url: The AMQP url to connect with
+        :param str queue_name: The queue to consume from
+        :param int prefetch_count: Unacked messages RabbitMQ may deliver to
+            us, 0 for no limit
+        :param int ack_batch_size: Accepted messages to acknowledge at once
+        :param float ack_interval: Longest time to hold back an ack
+        :param bool queue_auto_delete: Have RabbitMQ delete the queue once
+            we stop consuming from it
+        :param osws.metrics.Metrics metrics: Where to count received and
+            acknowledged messages
+        :param bool dynamic_bindings: Bind only the routing keys asked for
+        :param str topic_exchange: The exchange to bind them on
+        :param float binding_delay: Seconds to collect binding changes for
 
         """
         self._connection = None
@@ -39,7 +82,33 @@ class NotificationConsumer(object):
         self._consumer_tag = None
         self._url = amqp_url
         self.queue_name = queue_name
+        self._queue_auto_delete = queue_auto_delete
+        if dynamic_bindings:
+            self.queue_name = '%s.dynamic' % queue_name
+            self._queue_auto_delete = True
         self._message_handlers = set()
+        self._prefetch_count = prefetch_count
+        self._ack_batch_size = ack_batch_size
+        self._ack_interval = ack_interval
+        self._ack_pending = 0
+        self._ack_delivery_tag = None
+        self._ack_timer = None
+        self._metrics = metrics or osws_metrics.Metrics()
+        self._exchange = self.EXCHANGE
+        self._exchange_type = self.EXCHANGE_TYPE
+        self._dynamic_bindings = dynamic_bindings
+        if dynamic_bindings:
+            self._exchange = topic_exchange
+            self._exchange_type = 'topic'
+        self._binding_delay = binding_delay
+        # Routing key to the number of times it was asked for
+        self._binding_refs = {}
+        # Keys bound on the current channel, None until it is consuming
+        self._bound = None
+        self._binding_timer = None
+        # Consumers with a channel of their own on our connection
+        self._sharing = []
+        self._owner = None
 
     def add_message_handler(self, handler):
         self._message_handlers.add(handler)
@@ -57,6 +126,27 @@ class NotificationConsumer(object):
                                      self.on_connection_open,
                                      stop_ioloop_on_close=False)
 
+    def share_connection(self, consumer):
+        """Have another consumer open its channel on our connection rather
+        than connecting by itself. It is reattached whenever we reconnect,
+        and its channel closing unexpectedly closes the whole connection.
+
+        :param NotificationConsumer consumer: The consumer to share with
+
+        """
+        consumer._owner = self
+        self._sharing.append(consumer)
+
+    def attach(self, connection):
+        """Open our channel on the connection of the consumer we share it
+        with.
+
+        :param pika.connection.Connection connection: The open connection
+
+        """
+        self._connection = connection
+        self.open_channel()
+
     def on_connection_open(self, unused_connection):
         """This method is called by pika once the connection to RabbitMQ has
         been established. It passes the handle to the connection object in
@@ -68,6 +158,8 @@ class NotificationConsumer(object):
         LOGGER.info('Connection opened')
         self.add_on_connection_close_callback()
         self.open_channel()
+        for consumer in self._sharing:
+            consumer.attach(self._connection)
 
     def add_on_connection_close_callback(self):
         """This method adds an on close callback that will be invoked by pika
@@ -88,14 +180,16 @@ class NotificationConsumer(object):
 
         """
         self._channel = None
+        for consumer in self._sharing:
+            consumer._channel = None
         if self._closing:
             self._connection.ioloop.stop()
         else:
             LOGGER.warning(
-                'Connection closed, reopening in 5 seconds: (%s)%s',
-                reply_code, reply_text
+                'Connection closed, reopening in %d seconds: (%s)%s',
+                self.RECONNECT_DELAY, reply_code, reply_text
             )
-            self._connection.add_timeout(5, self.reconnect)
+            self._connection.add_timeout(self.RECONNECT_DELAY, self.reconnect)
 
     def reconnect(self):
         """Will be invoked by the IOLoop timer if the connection is
@@ -133,8 +227,11 @@ class NotificationConsumer(object):
         """
         LOGGER.info('Channel opened')
         self._channel = channel
+        self._reset_acks()
+        self._bound = None
+        self._binding_timer = None
         self.add_on_channel_close_callback()
-        self.setup_exchange(self.EXCHANGE)
+        self.setup_exchange(self._exchange)
 
     def add_on_channel_close_callback(self):
         """This method tells pika to call the on_channel_closed method if
@@ -158,6 +255,10 @@ class NotificationConsumer(object):
         """
         LOGGER.warning('Channel %i was closed: (%s) %s',
                        channel, reply_code, reply_text)
+        if self._owner is not None and self._closing:
+            # The connection is left to the consumer which owns it
+            self._channel = None
+            return
         self._connection.close()
 
     def setup_exchange(self, exchange_name):
@@ -171,7 +272,7 @@ class NotificationConsumer(object):
         LOGGER.info('Declaring exchange %s', exchange_name)
         self._channel.exchange_declare(self.on_exchange_declareok,
                                        exchange_name,
-                                       self.EXCHANGE_TYPE,
+                                       self._exchange_type,
                                        durable=self.EXCHANGE_DURABLE)
 
     def on_exchange_declareok(self, unused_frame):
@@ -194,7 +295,8 @@ class NotificationConsumer(object):
 
         """
         LOGGER.info('Declaring queue %s', queue_name)
-        self._channel.queue_declare(self.on_queue_declareok, queue_name)
+        self._channel.queue_declare(self.on_queue_declareok, queue_name,
+                                    auto_delete=self._queue_auto_delete)
 
     def on_queue_declareok(self, method_frame):
         """Method invoked by pika when the Queue.Declare RPC call made in
@@ -206,10 +308,94 @@ class NotificationConsumer(object):
         :param pika.frame.Method method_frame: The Queue.DeclareOk frame
 
         """
+        if self._dynamic_bindings:
+            self.setup_bindings()
+            return
         LOGGER.info('Binding %s to %s with %s',
-                    self.EXCHANGE, self.queue_name, self.ROUTING_KEY)
+                    self._exchange, self.queue_name, self.ROUTING_KEY)
         self._channel.queue_bind(self.on_bindok, self.queue_name,
-                                 self.EXCHANGE, self.ROUTING_KEY)
+                                 self._exchange, self.ROUTING_KEY)
+
+    def setup_bindings(self):
+        """Bind the queue with every routing key currently asked for, and
+        carry on setting up once RabbitMQ has confirmed all of them.
+
+        """
+        keys = sorted(self._binding_refs)
+        LOGGER.info('Binding %s to %s with %d routing keys',
+                    self._exchange, self.queue_name, len(keys))
+        self._bound = set(keys)
+        if not keys:
+            self.on_bindok(None)
+            return
+        remaining = [len(keys)]
+
+        def on_bindok(unused_frame):
+            remaining[0] -= 1
+            if not remaining[0]:
+                self.on_bindok(unused_frame)
+
+        for key in keys:
+            self._channel.queue_bind(on_bindok, self.queue_name,
+                                     self._exchange, key)
+
+    def bind(self, routing_key):
+        """Ask for the notifications whose routing key matches a topic
+        exchange binding key. Each call is undone by one call to unbind.
+
+        :param str routing_key: The binding key
+
+        """
+        count = self._binding_refs.get(routing_key, 0)
+        self._binding_refs[routing_key] = count + 1
+        if not count:
+            self._schedule_bindings()
+
+    def unbind(self, routing_key):
+        """Undo a call to bind.
+
+        :param str routing_key: The binding key
+
+        """
+        count = self._binding_refs.get(routing_key, 0) - 1
+        if count > 0:
+            self._binding_refs[routing_key] = count
+            return
+        self._binding_refs.pop(routing_key, None)
+        self._schedule_bindings()
+
+    def _schedule_bindings(self):
+        # Until the channel is consuming, setup_bindings will pick the
+        # changes up
+        if self._bound is None or self._binding_timer is not None:
+            return
+        self._binding_timer = self._connection.add_timeout(
+            self._binding_delay, self.sync_bindings
+        )
+
+    def sync_bindings(self):
+        """Bind the routing keys asked for since the last sync and unbind
+        those no longer asked for.
+
+        """
+        self._binding_timer = None
+        if not self._channel or self._bound is None:
+            return
+        wanted = set(self._binding_refs)
+        for key in sorted(wanted - self._bound):
+            LOGGER.info('Binding %s to %s with %s',
+                        self._exchange, self.queue_name, key)
+            self._channel.queue_bind(self._on_binding_changed,
+                                     self.queue_name, self._exchange, key)
+        for key in sorted(self._bound - wanted):
+            LOGGER.info('Unbinding %s from %s with %s',
+                        self._exchange, self.queue_name, key)
+            self._channel.queue_unbind(self._on_binding_changed,
+                                       self.queue_name, self._exchange, key)
+        self._bound = wanted
+
+    def _on_binding_changed(self, unused_frame):
+        LOGGER.debug('Binding change confirmed')
 
     def on_bindok(self, unused_frame):
         """Invoked by pika when the Queue.Bind method has completed. At this
@@ -220,6 +406,26 @@ class NotificationConsumer(object):
 
         """
         LOGGER.info('Queue bound')
+        self.set_qos()
+
+    def set_qos(self):
+        """Limit the number of unacknowledged messages RabbitMQ will deliver
+        by issuing the Basic.Qos RPC command. When it is complete, the
+        on_basic_qos_ok method will be invoked by pika.
+
+        """
+        LOGGER.info('Setting prefetch count to %d', self._prefetch_count)
+        self._channel.basic_qos(self.on_basic_qos_ok,
+                                prefetch_count=self._prefetch_count)
+
+    def on_basic_qos_ok(self, unused_frame):
+        """Invoked by pika when the Basic.Qos method has completed. At this
+        point we will start consuming messages.
+
+        :param pika.frame.Method unused_frame: The Basic.QosOk response frame
+
+        """
+        LOGGER.info('QOS set')
         self.start_consuming()
 
     def start_consuming(self):
@@ -272,21 +478,70 @@ class NotificationConsumer(object):
         :param str|unicode body: The message body
 
         """
-        LOGGER.info('Received message # %s from %s: %s',
-                    basic_deliver.delivery_tag, properties.app_id, body)
-        for handler in self._message_handlers:
-            handler(properties, body)
-        self.acknowledge_message(basic_deliver.delivery_tag)
+        LOGGER.debug('Received message # %s from %s',
+                     basic_deliver.delivery_tag, properties.app_id)
+        self._metrics.amqp_received.inc()
+        try:
+            for handler in self._message_handlers:
+                handler(properties, body)
+        except Exception:
+            LOGGER.exception('Unable to handle message # %s',
+                             basic_deliver.delivery_tag)
+            self.reject_message(basic_deliver.delivery_tag)
+        else:
+            self.acknowledge_message(basic_deliver.delivery_tag)
 
     def acknowledge_message(self, delivery_tag):
-        """Acknowledge the message delivery from RabbitMQ by sending a
-        Basic.Ack RPC method for the delivery tag.
+        """Mark the message delivery as accepted. The Basic.Ack RPC method is
+        sent once enough deliveries are pending or the ack interval has
+        passed, acknowledging every delivery up to and including the latest
+        one.
 
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
 
         """
-        LOGGER.info('Acknowledging message %s', delivery_tag)
-        self._channel.basic_ack(delivery_tag)
+        self._ack_delivery_tag = delivery_tag
+        self._ack_pending += 1
+        if self._ack_pending >= self._ack_batch_size:
+            self.flush_acks()
+        elif self._ack_timer is None:
+            self._ack_timer = self._connection.add_timeout(
+                self._ack_interval, self._on_ack_timer
+            )
+
+    def reject_message(self, delivery_tag):
+        """Reject a message which could not be handled by sending a
+        Basic.Nack RPC method without requeueing it. Pending acks are sent
+        first so that they do not cover the rejected delivery.
+
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+
+        """
+        self.flush_acks()
+        self._channel.basic_nack(delivery_tag, requeue=False)
+        self._metrics.amqp_rejected.inc()
+
+    def flush_acks(self):
+        """Acknowledge all pending deliveries with a single Basic.Ack."""
+        if self._ack_timer is not None:
+            self._connection.remove_timeout(self._ack_timer)
+            self._ack_timer = None
+        if self._ack_pending and self._channel:
+            self._channel.basic_ack(self._ack_delivery_tag,
+                                    multiple=self._ack_pending > 1)
+            self._metrics.amqp_acked.inc(self._ack_pending)
+        self._ack_pending = 0
+
+    def _on_ack_timer(self):
+        self._ack_timer = None
+        self.flush_acks()
+
+    def _reset_acks(self):
+        # Delivery tags are scoped to a channel, anything still pending
+        # belongs to a channel which no longer exists.
+        self._ack_pending = 0
+        self._ack_delivery_tag = None
+        self._ack_timer = None
 
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
@@ -294,6 +549,7 @@ class NotificationConsumer(object):
 
         """
         if self._channel:
+            self.flush_acks()
             LOGGER.info('Sending a Basic.Cancel RPC command to RabbitMQ')
             self._channel.basic_cancel(self.on_cancelok, self._consumer_tag)
 
@@ -348,6 +604,345 @@ class NotificationConsumer(object):
         self._connection.close()
 
 
+class AsyncioNotificationConsumer(NotificationConsumer):
+    """A NotificationConsumer which runs on an asyncio event loop.
+
+    Rather than driving a blocking IOLoop of its own, the connection is
+    registered with the given event loop. Message handlers are therefore
+    invoked on the same loop which serves the websockets, without any thread
+    or ioloop hand-off. The exchange, queue, bind and consume sequence and the
+    reconnect behaviour are inherited unchanged. This uses the asyncio
+    adapter of pika 0.x, which requirements.txt pins to.
+    """
+
+    def __init__(self, amqp_url, queue_name, loop=None, **kwargs):
+        super(AsyncioNotificationConsumer, self).__init__(amqp_url, queue_name,
+                                                          **kwargs)
+        self._loop = loop or asyncio.get_event_loop()
+        self._closed = None
+
+    def connect(self):
+        """Connect to RabbitMQ using the asyncio adapter on our loop.
+
+        :rtype: pika.adapters.asyncio_connection.AsyncioConnection
+
+        """
+        LOGGER.info('Connecting to %s', self._url)
+        return asyncio_connection.AsyncioConnection(
+            pika.URLParameters(self._url),
+            self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error,
+            stop_ioloop_on_close=False,
+            custom_ioloop=self._loop
+        )
+
+    def on_connection_open_error(self, unused_connection, error_message=None):
+        """Invoked by pika if the connection could not be established. We
+        retry after the reconnect delay, as for an unexpected close.
+
+        """
+        LOGGER.warning('Connection failed, retrying in %d seconds: %s',
+                       self.RECONNECT_DELAY, error_message)
+        self._loop.call_later(self.RECONNECT_DELAY, self.reconnect)
+
+    def on_connection_closed(self, connection, reply_code, reply_text):
+        if self._closing:
+            self._channel = None
+            self._set_closed()
+        else:
+            super(AsyncioNotificationConsumer, self).on_connection_closed(
+                connection, reply_code, reply_text
+            )
+
+    def reconnect(self):
+        """Create a new connection on the event loop, unless we are
+        shutting down.
+
+        """
+        if not self._closing:
+            self._connection = self.connect()
+
+    def run(self):
+        """Start connecting to RabbitMQ. This returns immediately, the
+        connection is driven by the event loop.
+
+        """
+        if self._owner is None:
+            self._connection = self.connect()
+
+    def stop(self):
+        """Cleanly shutdown the connection to RabbitMQ.
+
+        A consumer sharing another's connection only acknowledges what it
+        has accepted and stops consuming, the connection is closed by its
+        owner.
+
+        :returns: A future which completes once the connection is closed.
+
+        """
+        LOGGER.info('Stopping')
+        self._closing = True
+        self._closed = self._loop.create_future()
+        if self._owner is not None:
+            if self._channel:
+                self.stop_consuming()
+            self._set_closed()
+        elif self._channel:
+            self.stop_consuming()
+        elif self._connection and not self._connection.is_closed:
+            self.close_connection()
+        else:
+            self._set_closed()
+        return self._closed
+
+    def _set_closed(self):
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
+        LOGGER.info('Stopped')
+
+
+class ShardConsumer(AsyncioNotificationConsumer):
+    """Consume one of several shard queues of the notifications.
+
+    The shard exchange, a consistent hash exchange bound to the
+    notification exchange, puts each notification on one of the shard
+    queues bound to it by hashing its routing key, or the hash_header
+    header when one is given. Notifications with the same routing key or
+    header therefore always reach the same queue, and so the same channel,
+    in the order they were published. This needs the
+    rabbitmq_consistent_hash_exchange plugin.
+
+    The shard queues and exchange are always auto-deleted. A shard queue
+    left over from a run with more channels would otherwise stay bound and
+    take its share of the notifications, which nobody then consumes.
+    """
+    SHARD_EXCHANGE_TYPE = 'x-consistent-hash'
+    SHARD_WEIGHT = '1'
+
+    def __init__(self, amqp_url, queue_name, shard_exchange,
+                 hash_header=None, **kwargs):
+        super(ShardConsumer, self).__init__(amqp_url, queue_name, **kwargs)
+        self._queue_auto_delete = True
+        self._exchange = shard_exchange
+        self._exchange_type = self.SHARD_EXCHANGE_TYPE
+        self._hash_header = hash_header
+
+    def setup_exchange(self, exchange_name):
+        """Declare the shard exchange, which goes away with the last shard
+        queue once we stop.
+
+        """
+        LOGGER.info('Declaring exchange %s', exchange_name)
+        arguments = None
+        if self._hash_header:
+            arguments = {'hash-header': self._hash_header}
+        self._channel.exchange_declare(self.on_exchange_declareok,
+                                       exchange_name,
+                                       self._exchange_type,
+                                       durable=self.EXCHANGE_DURABLE,
+                                       auto_delete=self._queue_auto_delete,
+                                       arguments=arguments)
+
+    def on_exchange_declareok(self, unused_frame):
+        """Bind the shard exchange to the notification exchange."""
+        LOGGER.info('Binding %s to %s', self._exchange, self.EXCHANGE)
+        self._channel.exchange_bind(self.on_exchange_bindok, self._exchange,
+                                    self.EXCHANGE, self.ROUTING_KEY)
+
+    def on_exchange_bindok(self, unused_frame):
+        LOGGER.info('Exchange bound')
+        self.setup_queue(self.queue_name)
+
+    def on_queue_declareok(self, method_frame):
+        """Bind our queue to the shard exchange. The binding key of a
+        consistent hash exchange is the weight of the queue, and all shards
+        are weighted the same.
+
+        """
+        LOGGER.info('Binding %s to %s', self._exchange, self.queue_name)
+        self._channel.queue_bind(self.on_bindok, self.queue_name,
+                                 self._exchange, self.SHARD_WEIGHT)
+
+
+class ConsumerPool(object):
+    """Consume notifications over several connections and channels.
+
+    One connection is limited by its single socket, so the pool opens
+    connections connections with channels channels each. Every channel has
+    its own consumer, and so its own prefetch window and acknowledgements,
+    and hands what it receives to the same message handlers.
+
+    Channels consuming from one queue get its notifications in turn, so
+    notifications published one after the other may be handled in either
+    order. With an ordering other than NO_ORDERING each channel instead
+    consumes a shard queue of its own, see ShardConsumer. PER_SERVICE
+    shards by routing key, which publishers have to set to the service the
+    notification is about, and PER_RESOURCE by the hash_header header,
+    which they have to set to the id of the resource. Notifications of one
+    service or resource then keep their order.
+    """
+
+    def __init__(self, amqp_url, queue_name, connections=1, channels=1,
+                 ordering=NO_ORDERING, hash_header='resource_id', loop=None,
+                 **kwargs):
+        """
+        :param str amqp_url: The AMQP url to connect with
+        :param str queue_name: The queue to consume from, or to name the
+            shard queues and exchange after
+        :param int connections: Number of connections to open
+        :param int channels: Number of channels on each connection
+        :param str ordering: One of ORDERINGS
+        :param str hash_header: The header to shard by for PER_RESOURCE
+        :param loop: The event loop to run on
+
+        Other arguments are passed to every consumer.
+
+        """
+        if ordering not in ORDERINGS:
+            raise ValueError('Invalid ordering %s' % ordering)
+        count = connections * channels
+        if count < 1:
+            raise ValueError('At least one channel is needed')
+        # A single channel keeps everything in order
+        sharded = ordering != NO_ORDERING and count > 1
+        if sharded and kwargs.get('dynamic_bindings'):
+            raise ValueError('Dynamic bindings cannot be used with %s '
+                             'ordering' % ordering)
+        self.consumers = []
+        self._owners = []
+        for index in range(count):
+            if sharded:
+                nc = ShardConsumer(
+                    amqp_url, '%s.%d' % (queue_name, index),
+                    '%s.shards' % queue_name,
+                    hash_header=(hash_header if ordering == PER_RESOURCE
+                                 else None),
+                    loop=loop, **kwargs
+                )
+            else:
+                nc = AsyncioNotificationConsumer(amqp_url, queue_name,
+                                                 loop=loop, **kwargs)
+            if index % channels:
+                self._owners[-1].share_connection(nc)
+            else:
+                self._owners.append(nc)
+            self.consumers.append(nc)
+
+    def add_message_handler(self, handler):
+        for nc in self.consumers:
+            nc.add_message_handler(handler)
+
+    def bind(self, routing_key):
+        for nc in self.consumers:
+            nc.bind(routing_key)
+
+    def unbind(self, routing_key):
+        for nc in self.consumers:
+            nc.unbind(routing_key)
+
+    def run(self):
+        for nc in self._owners:
+            nc.run()
+
+    def stop(self):
+        """Stop every consumer.
+
+        :returns: A future which completes once every connection is closed.
+
+        """
+        # Consumers sharing a connection flush their acks before their
+        # owner closes it
+        stopped = [nc.stop() for nc in self.consumers
+                   if nc not in self._owners]
+        stopped.extend(nc.stop() for nc in self._owners)
+        return asyncio.gather(*stopped)
+
+
+def parse_broker(text):
+    """Split a broker into its name and AMQP URL.
+
+    A broker is given either as a bare URL or as 'name=URL'. A bare URL is
+    named by its host and port, followed by the virtual host unless that is
+    the default one, leaving out the credentials.
+
+    :param str text: The broker
+    :rtype: tuple
+
+    """
+    name, sep, url = text.partition('=')
+    if sep and '://' not in name:
+        return name, url
+    parsed = urllib.parse.urlsplit(text)
+    name = parsed.hostname or 'localhost'
+    if parsed.port:
+        name = '%s:%d' % (name, parsed.port)
+    vhost = urllib.parse.unquote(parsed.path[1:])
+    if vhost and vhost != '/':
+        name = '%s/%s' % (name, vhost)
+    return name, text
+
+
+class MultiConsumer(object):
+    """Consume notifications from several RabbitMQ brokers at once, such
+    as those of the cells of a nova deployment.
+
+    Each broker has its own consumer, which connects, reconnects and
+    acknowledges independently of the others, so a broker which is down or
+    slow holds up neither the other brokers nor their notifications.
+    Everything is handled on the one event loop, and message handlers are
+    called with the name of the broker as their source keyword argument.
+    """
+    STOP_TIMEOUT = 10
+
+    def __init__(self, consumers, loop=None):
+        """
+        :param consumers: (name, consumer) pairs, one for each broker
+        :param loop: The event loop to run on
+
+        """
+        names = [name for name, _ in consumers]
+        if len(set(names)) != len(names):
+            raise ValueError('Broker names must be unique: %s' %
+                             ', '.join(names))
+        self.consumers = consumers
+        self._loop = loop or asyncio.get_event_loop()
+
+    def add_message_handler(self, handler):
+        for name, nc in self.consumers:
+            nc.add_message_handler(functools.partial(handler, source=name))
+
+    def bind(self, routing_key):
+        for _, nc in self.consumers:
+            nc.bind(routing_key)
+
+    def unbind(self, routing_key):
+        for _, nc in self.consumers:
+            nc.unbind(routing_key)
+
+    def run(self):
+        for _, nc in self.consumers:
+            nc.run()
+
+    def stop(self):
+        """Stop consuming from every broker.
+
+        :returns: A future which completes once every connection is closed,
+            or once STOP_TIMEOUT has passed for brokers which do not
+            respond.
+
+        """
+        stopped = [(name, nc.stop()) for name, nc in self.consumers]
+        return self._loop.create_task(self._wait_stopped(stopped))
+
+    async def _wait_stopped(self, stopped):
+        futures = [asyncio.ensure_future(future) for _, future in stopped]
+        await asyncio.wait(futures, timeout=self.STOP_TIMEOUT)
+        for (name, _), future in zip(stopped, futures):
+            if not future.done():
+                LOGGER.warning('Gave up waiting for %s to stop', name)
+                future.cancel()
+
+
 def main():
     logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
     consumer = NotificationConsumer(
@@ -23,3 +23,15 @@ class InvalidCommandTypeError(Exception):
 
 class MessageDecodeError(Exception):
     pass
+
+
+class MessageEncodeError(Exception):
+    pass
+
+
+class InvalidSubscriptionError(Exception):
+    pass
+
+
+class InvalidFilterError(Exception):
+    pass
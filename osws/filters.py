@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import json
+import re
+
+from osws import exc
+
+EQ = '=='
+NE = '!='
+IN = 'in'
+NOT_IN = 'not in'
+
+_EXPRESSION_RE = re.compile(
+    r'^\s*([A-Za-z_][\w]*(?:\.[\w]+)*)\s+(==|!=|not\s+in|in)\s+(.+?)\s*$'
+)
+
+MISSING = object()
+
+
+class Predicate(object):
+    """A compiled filter expression such as 'payload.state in [error]'."""
+    __slots__ = ('path', 'op', 'values')
+
+    def __init__(self, path, op, values):
+        self.path = path
+        self.op = op
+        self.values = values
+
+    @property
+    def negated(self):
+        return self.op in (NE, NOT_IN)
+
+
+def _parse_scalar(text):
+    text = text.strip()
+    try:
+        value = json.loads(text)
+    except ValueError:
+        value = text
+    if isinstance(value, (dict, list)):
+        raise exc.InvalidFilterError('%s is not a scalar value' % text)
+    return value
+
+
+def _parse_list(text):
+    text = text.strip()
+    if not (text.startswith('[') and text.endswith(']')):
+        raise exc.InvalidFilterError('%s is not a list' % text)
+    try:
+        values = json.loads(text)
+    except ValueError:
+        inner = text[1:-1].strip()
+        values = [_parse_scalar(v) for v in inner.split(',')] if inner else []
+    for value in values:
+        if isinstance(value, (dict, list)):
+            raise exc.InvalidFilterError('%s is not a scalar value' % value)
+    return tuple(values)
+
+
+def compile_filter(expression):
+    """Compile a filter expression into a Predicate.
+
+    Expressions compare a dotted notification field with a value, using one
+    of '==', '!=', 'in' or 'not in'. Values are JSON literals or bare words,
+    and lists are written as '[a, b]'.
+    """
+    if not isinstance(expression, str):
+        raise exc.InvalidFilterError('%r is not a filter expression' %
+                                     (expression,))
+    match = _EXPRESSION_RE.match(expression)
+    if match is None:
+        raise exc.InvalidFilterError('Unable to parse %s' % expression)
+    path, op, value = match.groups()
+    op = ' '.join(op.split())
+    if op in (IN, NOT_IN):
+        values = _parse_list(value)
+    else:
+        values = (_parse_scalar(value),)
+    return Predicate(tuple(path.split('.')), op, values)
+
+
+def resolve(notification, path):
+    """Look up a dotted field path in a notification."""
+    try:
+        value = notification.get(path[0])
+    except KeyError:
+        return MISSING
+    for key in path[1:]:
+        if not isinstance(value, dict):
+            return MISSING
+        value = value.get(key, MISSING)
+        if value is MISSING:
+            return MISSING
+    return value
+
+
+class _FieldIndex(object):
+    __slots__ = ('positive', 'negated', 'excluded')
+
+    def __init__(self):
+        # value -> {connection: number of predicates}
+        self.positive = collections.defaultdict(dict)
+        # connection -> number of negated predicates on this field
+        self.negated = {}
+        # value -> {connection: number of negated predicates}
+        self.excluded = collections.defaultdict(dict)
+
+    def __bool__(self):
+        return bool(self.positive or self.negated)
+
+
+def _increment(counts, key, amount=1):
+    counts[key] = counts.get(key, 0) + amount
+
+
+def _decrement(mapping, bucket_key, key):
+    counts = mapping[bucket_key]
+    counts[key] -= 1
+    if not counts[key]:
+        del counts[key]
+        if not counts:
+            del mapping[bucket_key]
+
+
+class FilterIndex(object):
+    """Per-connection filters, indexed by the field they test.
+
+    A connection matches a notification when all of its predicates hold.
+    Each field is resolved once per notification and looked up in a hash of
+    the values tested by all predicates on that field, counting how many
+    predicates of each connection hold. Matching therefore does not
+    evaluate every predicate of every connection.
+    """
+
+    def __init__(self):
+        self._predicates = {}
+        self._fields = {}
+
+    def __bool__(self):
+        return bool(self._predicates)
+
+    def __contains__(self, connection):
+        return connection in self._predicates
+
+    def set_filters(self, connection, expressions):
+        """Replace the filters of a connection.
+
+        All expressions are compiled before any change is made, so an
+        invalid expression leaves the existing filters in place.
+        """
+        predicates = [compile_filter(expr) for expr in expressions]
+        self.remove_connection(connection)
+        if not predicates:
+            return
+        self._predicates[connection] = predicates
+        for pred in predicates:
+            field = self._fields.get(pred.path)
+            if field is None:
+                field = self._fields[pred.path] = _FieldIndex()
+            if pred.negated:
+                _increment(field.negated, connection)
+                for value in set(pred.values):
+                    _increment(field.excluded[value], connection)
+            else:
+                for value in set(pred.values):
+                    _increment(field.positive[value], connection)
+
+    def remove_connection(self, connection):
+        predicates = self._predicates.pop(connection, None)
+        if predicates is None:
+            return
+        for pred in predicates:
+            field = self._fields[pred.path]
+            if pred.negated:
+                field.negated[connection] -= 1
+                if not field.negated[connection]:
+                    del field.negated[connection]
+                for value in set(pred.values):
+                    _decrement(field.excluded, value, connection)
+            else:
+                for value in set(pred.values):
+                    _decrement(field.positive, value, connection)
+            if not field:
+                del self._fields[pred.path]
+
+    def match(self, notification):
+        """Return the filtered connections whose predicates all hold."""
+        held = {}
+        for path, field in self._fields.items():
+            value = resolve(notification, path)
+            try:
+                positive = field.positive.get(value)
+                excluded = field.excluded.get(value)
+            except TypeError:
+                # Unhashable values never equal a filter value
+                positive = excluded = None
+            if positive:
+                for conn, count in positive.items():
+                    _increment(held, conn, count)
+            for conn, count in field.negated.items():
+                _increment(held, conn, count)
+            if excluded:
+                for conn, count in excluded.items():
+                    _increment(held, conn, -count)
+        predicates = self._predicates
+        return set(conn for conn, count in held.items()
+                   if count == len(predicates[conn]))
+
+    def apply(self, notification, connections):
+        """Drop the connections whose filters reject a notification."""
+        if not self._predicates:
+            return connections
+        rejected = self._predicates.keys() - self.match(notification)
+        if rejected:
+            connections = set(connections)
+            connections.difference_update(rejected)
+        return connections
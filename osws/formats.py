@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Wire formats which clients can negotiate as a websocket subprotocol.
+
+JSON is used when a client does not ask for a subprotocol. Formats whose
+library is not installed are not offered.
+"""
+
+import collections
+
+from osws import exc
+from osws import framing
+from osws import jsonutils
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONFormat(object):
+    name = 'json'
+    subprotocol = 'osws.json'
+
+    def encode(self, obj):
+        return jsonutils.dumps(obj)
+
+    def encode_batch(self, cmd_type, key, encoded):
+        """Encode {cmd_type, payload: {key: [...]}} from encoded items."""
+        return '{"cmd_type":%s,"payload":{%s:[%s]}}' % (
+            jsonutils.dumps(cmd_type), jsonutils.dumps(key), ','.join(encoded)
+        )
+
+    def decode(self, data):
+        try:
+            return jsonutils.loads(data)
+        except (ValueError, TypeError):
+            raise exc.MessageDecodeError()
+
+
+class MsgpackFormat(object):
+    name = 'msgpack'
+    subprotocol = 'osws.msgpack'
+
+    def __init__(self):
+        self._packer = msgpack.Packer(use_bin_type=True)
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def encode_batch(self, cmd_type, key, encoded):
+        """Encode {cmd_type, payload: {key: [...]}} from encoded items."""
+        packer = self._packer
+        return b''.join([
+            packer.pack_map_header(2),
+            packer.pack('cmd_type'), packer.pack(cmd_type),
+            packer.pack('payload'), packer.pack_map_header(1),
+            packer.pack(key), packer.pack_array_header(len(encoded))
+        ] + list(encoded))
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except (ValueError, TypeError, msgpack.exceptions.UnpackException):
+            raise exc.MessageDecodeError()
+
+
+JSON = JSONFormat()
+
+FORMATS = collections.OrderedDict([(JSON.subprotocol, JSON)])
+if msgpack is not None:
+    MSGPACK = MsgpackFormat()
+    FORMATS[MSGPACK.subprotocol] = MSGPACK
+
+
+class Encoded(object):
+    """A command envelope and its encoding in each format it is sent in.
+
+    Encodings and websocket frames are computed the first time they are
+    asked for, so a message is encoded at most once per format and framed at
+    most once per format and compression window, however many clients it
+    reaches. received_at is the time.monotonic() time at which the message
+    reached the server, if known, and trace its tracing.Trace if sampled.
+
+    A message which cannot be encoded in a format, such as an integer too
+    large for msgpack, raises MessageEncodeError for that format only.
+    """
+    __slots__ = ('envelope', 'received_at', 'trace', '_encoded')
+
+    def __init__(self, envelope, received_at=None, trace=None):
+        self.envelope = envelope
+        self.received_at = received_at
+        self.trace = trace
+        self._encoded = {}
+
+    def encode(self, fmt):
+        try:
+            data = self._encoded[fmt]
+        except KeyError:
+            try:
+                data = fmt.encode(self.envelope)
+            except (TypeError, ValueError, OverflowError):
+                # Remembered so the encoding is not retried for every client
+                data = None
+            self._encoded[fmt] = data
+        if data is None:
+            raise exc.MessageEncodeError('Unable to encode as %s' % fmt.name)
+        return data
+
+    def frame(self, fmt, window_bits=None, compress=None):
+        key = (fmt, window_bits)
+        try:
+            return self._encoded[key]
+        except KeyError:
+            frame = self._encoded[key] = framing.build_frame(
+                self.encode(fmt), compress
+            )
+            return frame
+
+
+def subprotocols():
+    return list(FORMATS)
+
+
+def for_subprotocol(subprotocol):
+    """Return the format for a negotiated subprotocol, JSON if none was."""
+    return FORMATS.get(subprotocol, JSON)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Websocket frames which are built once and written to many transports.
+
+websockets frames, copies and possibly compresses every message it sends,
+once per connection. Servers never mask their frames, so as long as a
+connection has no extension with per-connection state the frame for a
+message is the same for every client and can be built once and written
+directly to each transport.
+
+Writing uses internals of the legacy websockets protocol, ensure_open(),
+drain() and transport, which the implementation served by default from
+websockets 14 does not have. requirements.txt pins websockets below it.
+"""
+
+import struct
+
+from osws import compression
+
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+FIN = 0x80
+RSV1 = 0x40
+
+_SHORT = struct.Struct('!BB')
+_MEDIUM = struct.Struct('!BBH')
+_LONG = struct.Struct('!BBQ')
+
+
+class Frame(bytes):
+    """A complete, unmasked websocket frame."""
+    __slots__ = ()
+
+
+def build_frame(data, compress=None, text=False):
+    """Frame encoded data as a single text or binary message.
+
+    :param data: A str for a text frame, bytes for a binary one
+    :param compress: Called with the payload to compress it for
+        permessage-deflate, in which case RSV1 is set
+    :param bool text: Whether bytes are UTF-8 text to send in a text frame
+
+    """
+    if isinstance(data, str):
+        first = FIN | OP_TEXT
+        payload = data.encode('utf-8')
+    elif text:
+        first = FIN | OP_TEXT
+        payload = data
+    else:
+        first = FIN | OP_BINARY
+        payload = data
+    if compress is not None:
+        first |= RSV1
+        payload = compress(payload)
+    length = len(payload)
+    if length < 126:
+        header = _SHORT.pack(first, length)
+    elif length < 65536:
+        header = _MEDIUM.pack(first, 126, length)
+    else:
+        header = _LONG.pack(first, 127, length)
+    return Frame(header + payload)
+
+
+def frame_args(websocket):
+    """How shared frames may be built for a websocket.
+
+    Returns None when frames can not be shared with the websocket, otherwise
+    the window size and compression function to build frames with, both
+    None when the websocket does not compress.
+    """
+    if getattr(websocket, 'transport', None) is None:
+        return None
+    extensions = getattr(websocket, 'extensions', None)
+    if not extensions:
+        return None, None
+    if (len(extensions) == 1 and
+            isinstance(extensions[0], compression.SharedPerMessageDeflate)):
+        return extensions[0].local_max_window_bits, extensions[0].compress
+    return None
+
+
+async def write_frames(websocket, queue):
+    """Write the frames at the head of a queue to a websocket's transport.
+
+    The queue holds pairs of data and a tag, such as when it was received.
+    Frames are written until the transport's buffer is full, and then
+    flow control is left to the websocket. Returns the tags of the frames
+    written.
+    """
+    await websocket.ensure_open()
+    transport = websocket.transport
+    high_water = transport.get_write_buffer_limits()[1]
+    written = []
+    while queue and type(queue[0][0]) is Frame:
+        frame, tag = queue.popleft()
+        transport.write(frame)
+        written.append(tag)
+        if transport.get_write_buffer_size() > high_water:
+            break
+    await websocket.drain()
+    return written
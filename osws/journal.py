@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""An append-only, on-disk journal of published notifications.
+
+The journal is a directory of fixed-size segment files named after the
+sequence number of their first record. Each record is a header holding the
+data and key lengths, sequence number and timestamp, followed by the key
+and the data. The key is a short string which readers may filter records
+by without parsing their data. Segments are preallocated, so a zero length
+marks the end of a segment, and the header is written after the data so
+that a partially written record is never seen. Segments are memory mapped:
+records are written into the map, and reads return memoryviews of it rather
+than copies. A sparse index of every index_interval bytes lets reads seek
+close to the requested sequence number or time.
+
+Records older than the retention time are deleted a segment at a time as
+records are appended, and are never read.
+
+The epoch file holds a random id for the sequence numbers in the journal.
+It is replaced whenever the journal is opened empty, as the numbering then
+starts over.
+"""
+
+import bisect
+import logging
+import mmap
+import os
+import struct
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+HEADER = struct.Struct('<IIQd')
+SEGMENT_SUFFIX = '.seg'
+EPOCH_FILE = 'epoch'
+
+
+class Segment(object):
+    def __init__(self, path, size=None, index_interval=64 * 1024):
+        """Open a segment, creating it when a size is given.
+
+        :param str path: The segment file
+        :param int size: Size to preallocate a new segment with
+        :param int index_interval: Bytes between sparse index entries
+
+        """
+        self.path = path
+        self._index_interval = index_interval
+        if size is not None:
+            self._file = open(path, 'w+b')
+            self._file.truncate(size)
+        else:
+            self._file = open(path, 'r+b')
+            size = os.fstat(self._file.fileno()).st_size
+        self.size = size
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self._index_seqs = []
+        self._index_times = []
+        self._index_offsets = []
+        self.end = 0
+        self.first_seq = self.last_seq = None
+        self.first_time = self.last_time = None
+        self._recover()
+
+    def __len__(self):
+        return self.end
+
+    def _recover(self):
+        offset = 0
+        while offset + HEADER.size <= self.size:
+            length, key_length, seq, timestamp = HEADER.unpack_from(
+                self._mmap, offset)
+            end = offset + HEADER.size + key_length + length
+            if not length or end > self.size:
+                break
+            self._add_record(seq, timestamp, offset)
+            offset = end
+        self.end = offset
+
+    def _add_record(self, seq, timestamp, offset):
+        if self.first_seq is None:
+            self.first_seq, self.first_time = seq, timestamp
+        self.last_seq, self.last_time = seq, timestamp
+        if (not self._index_offsets or
+                offset - self._index_offsets[-1] >= self._index_interval):
+            self._index_seqs.append(seq)
+            self._index_times.append(timestamp)
+            self._index_offsets.append(offset)
+
+    def append(self, seq, timestamp, data, key=b''):
+        """Append a record, returning False if the segment is full."""
+        start = self.end + HEADER.size
+        key_end = start + len(key)
+        end = key_end + len(data)
+        if end > self.size:
+            return False
+        self._mmap[start:key_end] = key
+        self._mmap[key_end:end] = data
+        HEADER.pack_into(self._mmap, self.end, len(data), len(key), seq,
+                         timestamp)
+        self._add_record(seq, timestamp, self.end)
+        self.end = end
+        return True
+
+    def _seek(self, start_seq, start_time):
+        if start_seq is not None:
+            pos = bisect.bisect_right(self._index_seqs, start_seq) - 1
+        elif start_time is not None:
+            pos = bisect.bisect_right(self._index_times, start_time) - 1
+        else:
+            return 0
+        return self._index_offsets[pos] if pos >= 0 else 0
+
+    def read(self, start_seq=None, end_seq=None, start_time=None,
+             end_time=None):
+        """Yield (seq, timestamp, key, data) for the records in range.
+
+        key and data are memoryviews of the segment which are only valid
+        until the segment is closed.
+        """
+        view = memoryview(self._mmap)
+        offset = self._seek(start_seq, start_time)
+        end = self.end
+        while offset < end:
+            length, key_length, seq, timestamp = HEADER.unpack_from(view,
+                                                                    offset)
+            key_start = offset + HEADER.size
+            start = key_start + key_length
+            offset = start + length
+            if end_seq is not None and seq > end_seq:
+                return
+            if end_time is not None and timestamp > end_time:
+                return
+            if start_seq is not None and seq < start_seq:
+                continue
+            if start_time is not None and timestamp < start_time:
+                continue
+            yield seq, timestamp, view[key_start:start], view[start:offset]
+
+    def close(self):
+        self._mmap.flush()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # A reader still holds a view, the map goes when it does
+            pass
+        self._file.close()
+
+    def delete(self):
+        self.close()
+        os.unlink(self.path)
+
+
+class Journal(object):
+    def __init__(self, path, segment_size=64 * 1024 * 1024,
+                 retention_seconds=None, retention_bytes=None,
+                 index_interval=64 * 1024):
+        """Open the journal in a directory, recovering existing segments.
+
+        :param str path: Directory holding the segment files
+        :param int segment_size: Size of each segment file
+        :param float retention_seconds: Delete segments whose newest record
+            is older than this, and read no record older than this
+        :param int retention_bytes: Delete the oldest segments while the
+            journal is larger than this
+
+        """
+        self._path = path
+        self._segment_size = segment_size
+        self._retention_seconds = retention_seconds
+        self._retention_bytes = retention_bytes
+        self._index_interval = index_interval
+        os.makedirs(path, exist_ok=True)
+        self._segments = [
+            Segment(os.path.join(path, name), index_interval=index_interval)
+            for name in sorted(os.listdir(path))
+            if name.endswith(SEGMENT_SUFFIX)
+        ]
+        self.epoch = self._open_epoch()
+
+    def _open_epoch(self):
+        path = os.path.join(self._path, EPOCH_FILE)
+        if self.last_seq:
+            try:
+                with open(path) as epoch_file:
+                    epoch = epoch_file.read().strip()
+                if epoch:
+                    return epoch
+            except FileNotFoundError:
+                pass
+        epoch = uuid.uuid4().hex
+        with open(path, 'w') as epoch_file:
+            epoch_file.write(epoch)
+        return epoch
+
+    @property
+    def last_seq(self):
+        for segment in reversed(self._segments):
+            if segment.last_seq is not None:
+                return segment.last_seq
+        return 0
+
+    @property
+    def size(self):
+        return sum(segment.size for segment in self._segments)
+
+    def append(self, seq, data, timestamp=None, key=b''):
+        if timestamp is None:
+            timestamp = time.time()
+        if not (self._segments and
+                self._segments[-1].append(seq, timestamp, data, key)):
+            size = max(self._segment_size,
+                       HEADER.size + len(key) + len(data))
+            path = os.path.join(self._path,
+                                '%020d%s' % (seq, SEGMENT_SUFFIX))
+            segment = Segment(path, size, self._index_interval)
+            segment.append(seq, timestamp, data, key)
+            self._segments.append(segment)
+        # Also when the segment has room, or a quiet journal would keep
+        # records until its segment fills
+        self._expire(timestamp)
+
+    def _expire(self, now):
+        segments = self._segments
+        while len(segments) > 1:
+            oldest = segments[0]
+            expired = (self._retention_seconds is not None and
+                       oldest.last_time is not None and
+                       oldest.last_time < now - self._retention_seconds)
+            oversized = (self._retention_bytes is not None and
+                         self.size > self._retention_bytes)
+            if not (expired or oversized):
+                break
+            LOGGER.info('Deleting journal segment %s', oldest.path)
+            segments.pop(0).delete()
+
+    def read(self, start_seq=None, end_seq=None, start_time=None,
+             end_time=None):
+        """Yield (seq, timestamp, key, data) for the records in range, in
+        order."""
+        if self._retention_seconds is not None:
+            oldest = time.time() - self._retention_seconds
+            if start_time is None or start_time < oldest:
+                start_time = oldest
+        for segment in list(self._segments):
+            if segment.last_seq is None:
+                continue
+            if start_seq is not None and segment.last_seq < start_seq:
+                continue
+            if start_time is not None and segment.last_time < start_time:
+                continue
+            if end_seq is not None and segment.first_seq > end_seq:
+                return
+            if end_time is not None and segment.first_time > end_time:
+                return
+            for record in segment.read(start_seq, end_seq,
+                                       start_time, end_time):
+                yield record
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+        self._segments = []
@@ -12,52 +12,101 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import json
-
 from osws import exc
+from osws import jsonutils
+
+
+class MessageMeta(type):
+    """Precompile the property lookups of each message class.
+
+    Message classes get empty __slots__ unless they declare their own, and
+    the set of accepted keyword arguments is built once per class so that
+    validating a message is a set comparison.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault('__slots__', ())
+        cls = super(MessageMeta, mcs).__new__(mcs, name, bases, namespace)
+        cls._valid_keys = frozenset(cls.properties) | frozenset(
+            cls.sub_messages)
+        cls._required = tuple(prop for prop in cls.properties
+                              if prop not in cls.defaults)
+        cls._optional = tuple(prop for prop in cls.properties
+                              if prop in cls.defaults)
+        return cls
+
 
+class Message(object, metaclass=MessageMeta):
+    __slots__ = ('_values',)
 
-class Message(object):
     properties = []
     sub_messages = {}
+    # Properties which may be omitted, and the value get() returns for them
+    defaults = {}
 
     @classmethod
     def from_json(cls, json_str):
         try:
-            flattened = json.loads(json_str)
-        except json.decoder.JSONDecodeError:
+            flattened = jsonutils.loads(json_str)
+        except (ValueError, TypeError):
+            raise exc.MessageDecodeError()
+        return cls.from_dict(flattened)
+
+    @classmethod
+    def from_dict(cls, flattened):
+        # Formats other than JSON, such as msgpack, allow keys which are not
+        # strings and so cannot be passed as keyword arguments
+        if not (isinstance(flattened, dict) and
+                all(isinstance(key, str) for key in flattened)):
             raise exc.MessageDecodeError()
         return cls(**flattened)
 
     def __init__(self, **kwargs):
-        self._properties = {}
-        self._sub_messages = {}
-        for key, val in kwargs.items():
-            if key in self.properties:
-                self._properties[key] = val
-            elif key in self.sub_messages:
-                self._sub_messages[key] = self.sub_messages[key](**val)
-            else:
+        if not self._valid_keys.issuperset(kwargs):
+            raise exc.InvalidMessagePropertyError(
+                '%s is not a valid property' %
+                ', '.join(sorted(set(kwargs) - self._valid_keys))
+            )
+        for key in self._required:
+            if key not in kwargs:
                 raise exc.InvalidMessagePropertyError(
-                    '%s is not a valid property' % key
+                    '%s is required' % key
                 )
+        for key, msg_type in self.sub_messages.items():
+            val = kwargs.get(key)
+            if val is not None and not isinstance(val, msg_type):
+                kwargs[key] = msg_type(**val)
+        self._values = kwargs
 
     def flatten(self):
+        values = self._values
         res = {}
-        for prop in self.properties:
-            res[prop] = self._properties[prop]
-        for prop, msg_type in self.sub_messages.items():
-            res[prop] = self._sub_messages[prop].flatten()
+        for prop in self._required:
+            res[prop] = values[prop]
+        for prop in self._optional:
+            if prop in values:
+                res[prop] = values[prop]
+        for prop in self.sub_messages:
+            res[prop] = values[prop].flatten()
         return res
 
     def to_json(self):
-        return json.dumps(self.flatten())
+        return jsonutils.dumps(self.flatten())
 
     def get(self, key):
         try:
-            return self._properties[key]
+            return self._values[key]
         except KeyError:
-            return self._sub_messages[key]
+            if key in self.defaults:
+                return self.defaults[key]
+            raise
+
+    def set(self, key, value):
+        if key not in self._valid_keys:
+            raise exc.InvalidMessagePropertyError(
+                '%s is not a valid property' % key
+            )
+        self._values[key] = value
 
 
 class Error(Message):
@@ -73,13 +122,112 @@ class Pong(Message):
 
 
 class Subscribe(Message):
-    properties = ['services']
+    properties = ['services', 'filters', 'resume_from', 'epoch', 'coalesce',
+                  'batch']
+    defaults = {'services': (), 'filters': None, 'resume_from': None,
+                'epoch': None, 'coalesce': None, 'batch': None}
 
 
 class Subscriptions(Message):
+    """A client's subscriptions, and the epoch of the sequence numbers of
+    its notifications when it may resume from them."""
+    properties = ['services', 'epoch']
+    defaults = {'epoch': None}
+
+
+class Unsubscribe(Message):
     properties = ['services']
 
 
+class Replace(Message):
+    """Replace all of a client's subscriptions, and optionally its filters.
+
+    The change is made at once, so no notification is published to the
+    client under a mix of its old and new subscriptions.
+    """
+    properties = ['services', 'filters']
+    defaults = {'filters': None}
+
+
+class SubscriptionsChanged(Message):
+    """The subscriptions an unsubscribe or replace added and removed."""
+    properties = ['added', 'removed']
+
+
+class Batch(Message):
+    """Several commands delivered in one frame.
+
+    Clients opt in by subscribing with a batch of the form
+    {"max_count": N, "max_bytes": B, "max_delay_ms": T}, where each limit is
+    optional, and opt out with a batch of false.
+    """
+    properties = ['commands']
+
+
+class History(Message):
+    """Ask for journalled notifications by sequence number or time.
+
+    Ranges are inclusive and either end may be left open. Times are in
+    seconds since the epoch, as recorded when the notification was
+    published. Only notifications for services, by default the client's
+    subscriptions, which its filters accept are sent.
+    """
+    properties = ['start_seq', 'end_seq', 'start_time', 'end_time',
+                  'services']
+    defaults = {'start_seq': None, 'end_seq': None,
+                'start_time': None, 'end_time': None, 'services': None}
+
+
+class HistoryEnd(Message):
+    properties = ['count']
+
+
+class Notification(Message):
+    properties = ['service', 'event_type', 'publisher_id', 'priority',
+                  'timestamp', 'payload', 'seq', 'source']
+    # The sequence number is stamped on by the server when publishing, and
+    # the source is the broker the notification came from
+    defaults = {'seq': None, 'source': None}
+
+    @classmethod
+    def from_amqp(cls, body, source=None):
+        """Decode an oslo.messaging notification body.
+
+        Both the 2.0 envelope (where the notification is a JSON string under
+        the 'oslo.message' key) and bare notifications are accepted. The
+        service is the first component of the publisher_id, falling back to
+        the event_type for publishers which do not set one.
+        """
+        try:
+            if isinstance(body, bytes):
+                body = body.decode('utf-8')
+            raw = jsonutils.loads(body)
+            if 'oslo.message' in raw:
+                raw = jsonutils.loads(raw['oslo.message'])
+        except (ValueError, TypeError):
+            # UnicodeDecodeError is a ValueError
+            raise exc.MessageDecodeError()
+        if not isinstance(raw, dict):
+            raise exc.MessageDecodeError()
+
+        publisher_id = raw.get('publisher_id') or ''
+        event_type = raw.get('event_type') or ''
+        if not (isinstance(publisher_id, str) and
+                isinstance(event_type, str)):
+            raise exc.MessageDecodeError()
+        notification = cls(
+            service=(publisher_id or event_type).split('.', 1)[0],
+            event_type=event_type,
+            publisher_id=publisher_id,
+            priority=raw.get('priority'),
+            timestamp=raw.get('timestamp'),
+            payload=raw.get('payload')
+        )
+        if source is not None:
+            notification.set('source', source)
+        return notification
+
+
 def bijective_dict(src):
     ret = {}
     for key, val in src.items():
@@ -90,11 +238,18 @@ def bijective_dict(src):
 
 class Command(Message):
     types = bijective_dict({
+        'batch': Batch,
         'error': Error,
+        'history': History,
+        'history_end': HistoryEnd,
+        'notification': Notification,
         'ping': Ping,
         'pong': Pong,
+        'replace': Replace,
         'subscribe': Subscribe,
-        'subscriptions': Subscriptions
+        'subscriptions': Subscriptions,
+        'subscriptions_changed': SubscriptionsChanged,
+        'unsubscribe': Unsubscribe
     })
 
     properties = ['cmd_type', 'payload']
@@ -104,9 +259,25 @@ class Command(Message):
         return Command(cmd_type=cls.types[type(message)],
                        payload=message.flatten())
 
+    @classmethod
+    def envelope(cls, message):
+        """Return the flattened command for a message."""
+        return {'cmd_type': cls.types[type(message)],
+                'payload': message.flatten()}
+
+    @classmethod
+    def encode(cls, message):
+        """Encode a message as a command, without an interim Command."""
+        return jsonutils.dumps(cls.envelope(message))
+
     def get_message(self):
         try:
             msg_type = self.types[self.get('cmd_type')]
-        except KeyError:
+        except (KeyError, TypeError):
             raise exc.InvalidCommandTypeError()
-        return msg_type.from_json(self.get('payload'))
+        payload = self.get('payload')
+        if isinstance(payload, str):
+            # The payload may be double encoded as a JSON string, otherwise
+            # it was decoded along with the command.
+            return msg_type.from_json(payload)
+        return msg_type.from_dict(payload)
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Runtime metrics, served in the Prometheus text format.
+
+Instruments are created up front and recording is an attribute update, or a
+bisect into fixed histogram buckets, so that they can be used on the hot
+path. Values which are cheap to read but expensive to track, such as queue
+depths, are gathered by collectors when the metrics are scraped.
+"""
+
+import asyncio
+import bisect
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUEUE_DEPTH_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', r'\\').replace(
+            '"', r'\"').replace('\n', r'\n'))
+        for key, value in sorted(labels.items())
+    )
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+    return repr(value)
+
+
+class Counter(object):
+    __slots__ = ('name', 'help', 'value')
+    type = COUNTER
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, None, self.value)]
+
+
+class Gauge(Counter):
+    __slots__ = ()
+    type = GAUGE
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    """A histogram with fixed buckets, as Prometheus defines them."""
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum')
+    type = HISTOGRAM
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.bounds = tuple(sorted(buckets))
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, labels=None):
+        res = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            bucket_labels = dict(labels or {}, le=_format_value(
+                float(bound)))
+            res.append((self.name + '_bucket', bucket_labels, cumulative))
+        res.append((self.name + '_sum', labels, self.sum))
+        res.append((self.name + '_count', labels, cumulative))
+        return res
+
+
+class Metrics(object):
+    """The instruments osws records to, and collectors read at scrape time.
+
+    A collector is a callable returning (name, type, help, samples) tuples,
+    where samples are (name, labels, value) tuples.
+    """
+
+    def __init__(self):
+        self.amqp_received = Counter(
+            'osws_amqp_messages_received_total',
+            'Notifications delivered by RabbitMQ.')
+        self.amqp_acked = Counter(
+            'osws_amqp_messages_acked_total',
+            'Notifications acknowledged to RabbitMQ.')
+        self.amqp_rejected = Counter(
+            'osws_amqp_messages_rejected_total',
+            'Notifications rejected because they could not be handled.')
+        self.published = Counter(
+            'osws_notifications_published_total',
+            'Notifications published to websocket clients.')
+        self.undecodable = Counter(
+            'osws_notifications_undecodable_total',
+            'Notifications dropped because they could not be decoded.')
+        self.unencodable = Counter(
+            'osws_deliveries_unencodable_total',
+            'Notifications not sent to a client because they could not be '
+            'encoded in its format.')
+        self.deliveries = Counter(
+            'osws_deliveries_total',
+            'Messages queued for websocket clients.')
+        self.dropped = Counter(
+            'osws_dropped_total',
+            'Messages dropped by the slow consumer policy.')
+        self.slow_consumer_disconnects = Counter(
+            'osws_slow_consumer_disconnects_total',
+            'Clients disconnected by the slow consumer policy.')
+        self.fanout_latency = Histogram(
+            'osws_fanout_latency_seconds',
+            'Time from receiving a notification from RabbitMQ to queueing '
+            'it for all of its subscribers.')
+        self.send_latency = Histogram(
+            'osws_send_latency_seconds',
+            'Time from receiving a notification from RabbitMQ to it being '
+            'written to a websocket.')
+        self.loop_lag = Histogram(
+            'osws_event_loop_lag_seconds',
+            'How late the event loop ran a timer.')
+        self._instruments = [
+            self.amqp_received, self.amqp_acked, self.amqp_rejected,
+            self.published, self.undecodable, self.unencodable,
+            self.deliveries, self.dropped,
+            self.slow_consumer_disconnects, self.fanout_latency,
+            self.send_latency, self.loop_lag,
+        ]
+        self._collectors = []
+        self._lag_monitor = None
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def collect(self):
+        families = [(inst.name, inst.type, inst.help, inst.samples())
+                    for inst in self._instruments]
+        for collector in self._collectors:
+            families.extend(collector())
+        return families
+
+    def render(self):
+        lines = []
+        for name, metric_type, help_text, samples in self.collect():
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for sample_name, labels, value in samples:
+                lines.append('%s%s %s' % (sample_name, _format_labels(labels),
+                                          _format_value(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def start_lag_monitor(self, interval=0.5):
+        self._lag_monitor = asyncio.ensure_future(
+            self._monitor_lag(interval))
+
+    def stop_lag_monitor(self):
+        if self._lag_monitor is not None:
+            self._lag_monitor.cancel()
+            self._lag_monitor = None
+
+    async def _monitor_lag(self, interval):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(loop.time() - expected, 0))
+
+
+class MetricsServer(object):
+    """Serve metrics over HTTP at /metrics.
+
+    While serving, event loop lag is measured every lag_interval seconds.
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, metrics, host='localhost', port=9998,
+                 lag_interval=0.5):
+        self._metrics = metrics
+        self._host = host
+        self._port = port
+        self._lag_interval = lag_interval
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self._host,
+                                                 self._port)
+        self._metrics.start_lag_monitor(self._lag_interval)
+
+    def stop(self):
+        self._metrics.stop_lag_monitor()
+        self.server.close()
+
+    async def wait_closed(self):
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request.split()
+            if (len(parts) >= 2 and parts[0] == b'GET' and
+                    parts[1].split(b'?')[0] == b'/metrics'):
+                status = '200 OK'
+                body = self._metrics.render().encode('utf-8')
+            else:
+                status = '404 Not Found'
+                body = b'Not found\n'
+            writer.write((
+                'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                '\r\n' % (status, self.CONTENT_TYPE, len(body))
+            ).encode('ascii') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
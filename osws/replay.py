@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+
+
+class Entry(object):
+    __slots__ = ('seq', 'notification', 'encoded', 'size')
+
+    def __init__(self, seq, notification, encoded, size):
+        self.seq = seq
+        self.notification = notification
+        self.encoded = encoded
+        self.size = size
+
+
+class ReplayBuffer(object):
+    """Recent notifications of one service, bounded by count and bytes."""
+
+    def __init__(self, max_count, max_bytes):
+        self._max_count = max_count
+        self._max_bytes = max_bytes
+        self._entries = collections.deque()
+        self._bytes = 0
+        # Sequence number of the newest entry which no longer fits
+        self.evicted_seq = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def append(self, entry):
+        entries = self._entries
+        entries.append(entry)
+        self._bytes += entry.size
+        while entries and (len(entries) > self._max_count or
+                           self._bytes > self._max_bytes):
+            evicted = entries.popleft()
+            self._bytes -= evicted.size
+            self.evicted_seq = evicted.seq
+
+    def since(self, seq):
+        """Return the entries newer than seq, oldest first."""
+        res = []
+        for entry in reversed(self._entries):
+            if entry.seq <= seq:
+                break
+            res.append(entry)
+        res.reverse()
+        return res
+
+
+def wanted(notification, services, patterns=None):
+    """Whether a notification is for one of services, or matches a
+    RoutingTrie of patterns."""
+    return wanted_keys(notification.get('service'),
+                       notification.get('event_type'),
+                       notification.get('publisher_id'),
+                       services, patterns)
+
+
+def wanted_keys(service, event_type, publisher_id, services, patterns=None):
+    """Like wanted, for the fields of a notification."""
+    if service in services:
+        return True
+    if patterns is not None:
+        for key in (event_type, publisher_id):
+            if key and patterns.match(key):
+                return True
+    return False
+
+
+class ReplayLog(object):
+    """A ReplayBuffer for each service notifications are published for."""
+
+    def __init__(self, max_count=1000, max_bytes=10 * 1024 * 1024,
+                 epoch=None, last_seq=0):
+        """
+        :param int max_count: Entries kept for each service
+        :param int max_bytes: Bytes of entries kept for each service
+        :param str epoch: Identifies the sequence numbers of the entries,
+            which only compare with those of the same epoch
+        :param int last_seq: Sequence number published last
+
+        """
+        self._max_count = max_count
+        self._max_bytes = max_bytes
+        self._buffers = {}
+        self.epoch = epoch
+        self.last_seq = last_seq
+
+    def append(self, entry):
+        self.last_seq = entry.seq
+        service = entry.notification.get('service')
+        try:
+            buf = self._buffers[service]
+        except KeyError:
+            buf = self._buffers[service] = ReplayBuffer(self._max_count,
+                                                        self._max_bytes)
+        buf.append(entry)
+
+    def since(self, seq, services=(), patterns=None, epoch=None):
+        """Return the entries newer than seq for some subscriptions.
+
+        A seq which was never published, or one from another epoch, comes
+        from before a restart or from another worker, so nothing can be
+        told about what was missed since.
+
+        :param int seq: The last sequence number the client has seen
+        :param services: Service names to replay
+        :param patterns: A RoutingTrie of patterns to replay, matched against
+            the event_type and publisher_id of each entry
+        :param str epoch: The epoch of seq, if known
+        :returns: A tuple of the entries ordered by sequence number, and
+            whether any entries newer than seq may have been missed
+
+        """
+        if seq > self.last_seq or (epoch is not None and
+                                   epoch != self.epoch):
+            return [], True
+        found = {}
+        complete = True
+        if patterns is not None:
+            buffers = self._buffers.items()
+        else:
+            buffers = [(service, self._buffers[service])
+                       for service in services if service in self._buffers]
+        for service, buf in buffers:
+            # Evicted entries are only known to have been wanted when the
+            # service is, or when the pattern matches what remains. Once
+            # anything newer than seq was evicted, all that remains is.
+            relevant = service in services
+            for entry in buf.since(seq):
+                if patterns is not None and not wanted(
+                        entry.notification, services, patterns):
+                    continue
+                found[entry.seq] = entry
+                relevant = True
+            if relevant and buf.evicted_seq > seq:
+                complete = False
+        return [found[s] for s in sorted(found)], not complete
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from osws import exc
+
+WORD_WILDCARD = '*'
+MULTI_WILDCARD = '#'
+
+
+def is_pattern(subscription):
+    """Whether a subscription is a dotted pattern rather than a service."""
+    return ('.' in subscription or
+            WORD_WILDCARD in subscription or
+            MULTI_WILDCARD in subscription)
+
+
+def validate_pattern(pattern):
+    for word in pattern.split('.'):
+        if not word:
+            raise exc.InvalidSubscriptionError(
+                '%s contains an empty word' % pattern
+            )
+        if word not in (WORD_WILDCARD, MULTI_WILDCARD) and (
+                WORD_WILDCARD in word or MULTI_WILDCARD in word):
+            raise exc.InvalidSubscriptionError(
+                '%s mixes a wildcard with other characters' % pattern
+            )
+
+
+class _Node(object):
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = set()
+
+
+class RoutingTrie(object):
+    """An index of dotted patterns, as used by AMQP topic exchanges.
+
+    Patterns are made of '.' separated words. A '*' word matches exactly one
+    word of a key and a '#' word matches zero or more words. Matching walks
+    the trie word by word, so its cost depends on the depth of the key and
+    not on the number of patterns in the index.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+
+    def add(self, pattern, value):
+        node = self._root
+        for word in pattern.split('.'):
+            child = node.children.get(word)
+            if child is None:
+                child = node.children[word] = _Node()
+            node = child
+        node.values.add(value)
+
+    def remove(self, pattern, value):
+        path = [self._root]
+        for word in pattern.split('.'):
+            try:
+                path.append(path[-1].children[word])
+            except KeyError:
+                return
+        path[-1].values.discard(value)
+
+        # Prune the branch back up to the first node still in use
+        words = pattern.split('.')
+        for depth in range(len(words), 0, -1):
+            node = path[depth]
+            if node.values or node.children:
+                break
+            del path[depth - 1].children[words[depth - 1]]
+
+    def match(self, key):
+        """Return the union of the values of all patterns matching key."""
+        words = key.split('.')
+        num_words = len(words)
+        result = set()
+        seen = set()
+        stack = [(self._root, 0)]
+        while stack:
+            node, pos = stack.pop()
+            if (node, pos) in seen:
+                continue
+            seen.add((node, pos))
+
+            children = node.children
+            multi = children.get(MULTI_WILDCARD)
+            if multi is not None:
+                for end in range(pos, num_words + 1):
+                    stack.append((multi, end))
+            if pos == num_words:
+                result |= node.values
+                continue
+            child = children.get(words[pos])
+            if child is not None:
+                stack.append((child, pos + 1))
+            child = children.get(WORD_WILDCARD)
+            if child is not None:
+                stack.append((child, pos + 1))
+        return result
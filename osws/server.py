@@ -12,20 +12,135 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import array
 import asyncio
 import collections
 import copy
+import logging
+import time
+import uuid
 
 import websockets
 
+from osws import coalesce
+from osws import compression
 from osws import exc
+from osws import filters
+from osws import formats
+from osws import framing
+from osws import jsonutils
 from osws import messages
+from osws import metrics as osws_metrics
+from osws import replay
+from osws import routing
+from osws import tracing
+
+LOGGER = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+DISCONNECT = 'disconnect'
+
+BATCH_CMD_TYPE = messages.Command.types[messages.Batch]
+DEFAULT_BATCH_COUNT = 100
+DEFAULT_BATCH_BYTES = 64 * 1024
+DEFAULT_BATCH_DELAY_MS = 100
+
+
+def _journal_key(notification):
+    """The fields history is filtered by, for the journal to keep with each
+    notification so that they are found without parsing it."""
+    key = '%s\0%s\0%s' % (notification.get('service'),
+                          notification.get('event_type'),
+                          notification.get('publisher_id'))
+    return key.encode('utf-8')
 
 
 class Connection(object):
-    def __init__(self, websocket, subscriptions):
+    """A websocket client and its outbound queue.
+
+    Outgoing data is appended to a bounded queue which is drained by a
+    writer task owned by the connection, so a client on a slow link only
+    delays its own messages. Once send_queue_size messages are queued the
+    slow consumer policy decides whether the oldest queued or the newest
+    message is dropped, or whether the client is disconnected after staying
+    over the limit for slow_consumer_timeout seconds. Replayed and
+    historical notifications are instead queued as the client reads them,
+    and live notifications are held back while a replay is queued.
+
+    Clients may ask for notifications to be batched, in which case they are
+    collected until a batch is full or its delay runs out and then queued
+    as a single frame.
+
+    Unless a client uses an extension with per-connection state, broadcast
+    notifications are queued as frames shared with other clients and
+    written straight to the transport.
+    """
+
+    def __init__(self, websocket, subscriptions, send_queue_size=1000,
+                 slow_consumer_policy=DROP_OLDEST, slow_consumer_timeout=10,
+                 replay_log=None, journal=None, coalesce=False,
+                 max_batch_count=1000, max_batch_bytes=1024 * 1024,
+                 max_batch_delay=1.0, metrics=None):
+        if slow_consumer_policy not in (DROP_OLDEST, DROP_NEWEST, DISCONNECT):
+            raise ValueError('Invalid slow consumer policy %s' %
+                             slow_consumer_policy)
         self.websocket = websocket
+        self.format = formats.for_subprotocol(
+            getattr(websocket, 'subprotocol', None)
+        )
+        self._frame_args = framing.frame_args(websocket)
         self._subscriptions = subscriptions
+        self._replay_log = replay_log
+        self._journal = journal
+        self._coalesce = coalesce
+        self._max_batch = (max_batch_count, max_batch_bytes, max_batch_delay)
+        # (count, bytes, delay) when the client asked for batches
+        self._batch = None
+        self._batched = []
+        self._batched_bytes = 0
+        self._batched_received_at = None
+        self._batch_timer = None
+        self._metrics = metrics or osws_metrics.Metrics()
+        self._send_queue_size = send_queue_size
+        self._send_queue_low = max(send_queue_size // 2, 1)
+        self._slow_consumer_policy = slow_consumer_policy
+        self._slow_consumer_timeout = slow_consumer_timeout
+        # Pairs of queued data and when it reached the server, or None
+        self._send_queue = collections.deque()
+        # Live notifications held back during a replay, as arguments of
+        # _queue_notification
+        self._held = None
+        self._send_ready = asyncio.Event()
+        self._send_space = asyncio.Event()
+        self._writer = None
+        self._closed = False
+        self._over_limit_since = None
+        self._slow_consumer_timer = None
+        self.dropped = 0
+
+    @property
+    def queue_depth(self):
+        return len(self._send_queue)
+
+    def start(self):
+        self._writer = asyncio.ensure_future(self._write_queued())
+
+    def stop(self):
+        # Wake anything waiting for queue space, it will find us closed
+        self._closed = True
+        self._send_space.set()
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        if self._slow_consumer_timer is not None:
+            self._slow_consumer_timer.cancel()
+            self._slow_consumer_timer = None
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        self._batched = []
+        self._send_queue.clear()
 
     async def handle(self):
         while True:
@@ -44,12 +159,14 @@ class Connection(object):
 
     async def _handle_message(self, message):
         try:
-            cmd = messages.Command.from_json(message)
+            cmd = messages.Command.from_dict(self.format.decode(message))
             msg = cmd.get_message()
         except exc.InvalidCommandTypeError:
             await self._send_error('Invalid command type')
         except exc.MessageDecodeError:
             await self._send_error('Message decode error')
+        except exc.InvalidMessagePropertyError:
+            await self._send_error('Invalid message property')
         else:
             try:
                 handler = getattr(self,
@@ -64,46 +181,766 @@ class Connection(object):
             messages.Pong(payload=message.get('payload'))
         )
 
+    def _validate_services(self, services):
+        if not isinstance(services, (list, tuple)):
+            raise exc.InvalidSubscriptionError('services must be a list')
+        for service in services:
+            if not isinstance(service, str):
+                raise exc.InvalidSubscriptionError('%r is not a service' %
+                                                   (service,))
+            if routing.is_pattern(service):
+                routing.validate_pattern(service)
+
+    def _validate_filters(self, expressions):
+        if expressions is None:
+            return
+        if not isinstance(expressions, (list, tuple)):
+            raise exc.InvalidFilterError('filters must be a list')
+        for expression in expressions:
+            filters.compile_filter(expression)
+
     async def _handle_subscribe_message(self, message):
+        # Everything which can fail is checked before anything changes
+        try:
+            self._validate_services(message.get('services'))
+            self._validate_filters(message.get('filters'))
+        except exc.InvalidSubscriptionError as e:
+            await self._send_error('Invalid subscription: %s' % e)
+            return
+        except exc.InvalidFilterError as e:
+            await self._send_error('Invalid filter: %s' % e)
+            return
+        coalescing = message.get('coalesce')
+        if coalescing is not None:
+            if not isinstance(coalescing, bool):
+                await self._send_error('Invalid coalesce')
+                return
+            if coalescing and not self._coalesce:
+                await self._send_error('Coalescing is not enabled')
+                return
+        batch = message.get('batch')
+        if batch is not None:
+            try:
+                batch = self._parse_batch(batch)
+            except ValueError as e:
+                await self._send_error('Invalid batch: %s' % e)
+                return
+        resume_from = message.get('resume_from')
+        if resume_from is not None:
+            if self._replay_log is None:
+                await self._send_error('Replay is not enabled')
+                return
+            if (isinstance(resume_from, bool) or
+                    not isinstance(resume_from, int) or resume_from < 0):
+                await self._send_error('Invalid resume_from')
+                return
+        epoch = message.get('epoch')
+        if epoch is not None and not isinstance(epoch, str):
+            await self._send_error('Invalid epoch')
+            return
+
+        # Nothing below yields to the event loop before live notifications
+        # are held back, so none is missed between the replay and joining
+        # the live stream.
+        if message.get('filters') is not None:
+            self._subscriptions.set_filters(self, message.get('filters'))
         for service in message.get('services'):
             self._subscriptions.add_subscription(service, self)
+        if coalescing is not None:
+            self._subscriptions.set_coalescing(self, coalescing)
+        if batch is not None:
+            self._flush_batch()
+            self._batch = batch or None
         my_services = list(self._subscriptions.get_services(self))
-        await self._send_message(messages.Subscriptions(services=my_services))
+        if self._replay_log is not None:
+            reply = messages.Subscriptions(services=my_services,
+                                           epoch=self._replay_log.epoch)
+        else:
+            reply = messages.Subscriptions(services=my_services)
+        if resume_from is None:
+            await self._send_message(reply)
+            return
+        self._held = collections.deque()
+        try:
+            await self._replay(resume_from, message.get('services'), epoch)
+            await self._send_message(reply)
+        finally:
+            await self._release_held()
+
+    async def _handle_unsubscribe_message(self, message):
+        try:
+            self._validate_services(message.get('services'))
+        except exc.InvalidSubscriptionError as e:
+            await self._send_error('Invalid subscription: %s' % e)
+            return
+        removed = [service for service in message.get('services')
+                   if self._subscriptions.remove_subscription(service, self)]
+        await self._send_message(
+            messages.SubscriptionsChanged(added=[], removed=removed)
+        )
+
+    async def _handle_replace_message(self, message):
+        # Everything which can fail is checked before anything changes
+        try:
+            self._validate_services(message.get('services'))
+            self._validate_filters(message.get('filters'))
+        except exc.InvalidSubscriptionError as e:
+            await self._send_error('Invalid subscription: %s' % e)
+            return
+        except exc.InvalidFilterError as e:
+            await self._send_error('Invalid filter: %s' % e)
+            return
+        if message.get('filters') is not None:
+            self._subscriptions.set_filters(self, message.get('filters'))
+        added, removed = self._subscriptions.replace(
+            self, message.get('services'))
+        await self._send_message(
+            messages.SubscriptionsChanged(added=added, removed=removed)
+        )
+
+    def _parse_batch(self, batch):
+        if batch is False:
+            return False
+        if not isinstance(batch, dict):
+            raise ValueError('batch must be an object or false')
+        unknown = set(batch) - {'max_count', 'max_bytes', 'max_delay_ms'}
+        if unknown:
+            raise ValueError('unknown option %s' % ', '.join(sorted(unknown)))
+        max_count, max_bytes, max_delay = self._max_batch
+        settings = []
+        for key, default, limit in (
+                ('max_count', DEFAULT_BATCH_COUNT, max_count),
+                ('max_bytes', DEFAULT_BATCH_BYTES, max_bytes),
+                ('max_delay_ms', DEFAULT_BATCH_DELAY_MS, max_delay * 1000)):
+            value = batch.get(key, min(default, limit))
+            if (isinstance(value, bool) or not isinstance(value, int) or
+                    not 0 < value <= limit):
+                raise ValueError('%s must be between 1 and %d' % (key, limit))
+            settings.append(value)
+        settings[2] /= 1000.0
+        return tuple(settings)
+
+    @staticmethod
+    def _split_services(services):
+        """Return the plain services, and a RoutingTrie of the patterns or
+        None if there are none."""
+        plain = set()
+        patterns = None
+        for service in services:
+            if routing.is_pattern(service):
+                if patterns is None:
+                    patterns = routing.RoutingTrie()
+                patterns.add(service, True)
+            else:
+                plain.add(service)
+        return plain, patterns
+
+    async def _replay(self, seq, services, epoch=None):
+        plain, patterns = self._split_services(services)
+        entries, missed = self._replay_log.since(seq, plain, patterns,
+                                                 epoch)
+        if missed:
+            self._queue_message(
+                messages.Error(description='Notifications since %d are no '
+                                           'longer available' % seq)
+            )
+        for entry in entries:
+            if self._subscriptions.accepts(self, entry.notification):
+                # Wait for the client rather than letting the slow consumer
+                # policy drop the replay, which may be longer than the queue
+                await self._wait_for_send_space()
+                if self._closed:
+                    return
+                self.send_notification(entry.encoded, live=False)
+
+    async def _release_held(self):
+        """Queue the live notifications held back during a replay, holding
+        back any more until those are queued."""
+        held = self._held
+        while held:
+            await self._wait_for_send_space()
+            if self._closed:
+                break
+            self._queue_notification(*held.popleft())
+        self._held = None
+
+    async def _handle_history_message(self, message):
+        if self._journal is None:
+            await self._send_error('History is not enabled')
+            return
+        for key in ('start_seq', 'end_seq', 'start_time', 'end_time'):
+            value = message.get(key)
+            if value is not None and (isinstance(value, bool) or
+                                      not isinstance(value, (int, float))):
+                await self._send_error('Invalid %s' % key)
+                return
+        services = message.get('services')
+        if services is None:
+            services = self._subscriptions.get_services(self)
+        else:
+            try:
+                self._validate_services(services)
+            except exc.InvalidSubscriptionError as e:
+                await self._send_error('Invalid subscription: %s' % e)
+                return
+        plain, patterns = self._split_services(services)
+        # Records are parsed only for filters or to be sent in another
+        # format, and otherwise framed straight from the journal. History
+        # is not compressed with the shared cache, which it would only
+        # churn.
+        filtered = self._subscriptions.filtered(self)
+        as_json = self.format is formats.JSON
+        framed = self._frame_args == (None, None) and self._batch is None
+
+        count = 0
+        for seq, timestamp, key, data in self._journal.read(
+                message.get('start_seq'), message.get('end_seq'),
+                message.get('start_time'), message.get('end_time')):
+            service, event_type, publisher_id = str(key, 'utf-8').split(
+                '\0', 2)
+            if not replay.wanted_keys(service, event_type, publisher_id,
+                                      plain, patterns):
+                continue
+            envelope = None
+            if filtered:
+                envelope = jsonutils.loads(bytes(data))
+                notification = messages.Notification.from_dict(
+                    envelope['payload'])
+                if not self._subscriptions.accepts(self, notification):
+                    continue
+            if as_json:
+                if framed:
+                    data = framing.build_frame(data, text=True)
+                else:
+                    data = str(data, 'utf-8')
+            else:
+                if envelope is None:
+                    envelope = jsonutils.loads(bytes(data))
+                try:
+                    data = self.format.encode(envelope)
+                except (TypeError, ValueError, OverflowError):
+                    self._metrics.unencodable.inc()
+                    continue
+                if framed:
+                    data = framing.build_frame(data)
+            # Wait for the client rather than letting the slow consumer
+            # policy drop history, which may be far longer than the queue.
+            await self._wait_for_send_space()
+            if self._closed:
+                return
+            self._queue_notification(data, None, framed)
+            count += 1
+        await self._send_message(messages.HistoryEnd(count=count))
+
+    async def _wait_for_send_space(self):
+        while (not self._closed and
+               len(self._send_queue) >= self._send_queue_low):
+            self._send_space.clear()
+            await self._send_space.wait()
 
     async def _send_error(self, error_str):
         await self._send_message(messages.Error(description=error_str))
 
     async def _send_message(self, msg):
-        await self.websocket.send(messages.Command.for_message(msg).to_json())
+        self._queue_message(msg)
+
+    def _queue_message(self, msg):
+        # Anything batched so far was generated before this message
+        self._flush_batch()
+        self._enqueue(self.format.encode(messages.Command.envelope(msg)))
+
+    def send_notification(self, encoded, live=True):
+        """Send a formats.Encoded notification command to this client.
+
+        Notifications which are not live, such as replayed ones, are left
+        out of latency measurements. Notifications which cannot be encoded
+        in the client's format are counted and skipped.
+        """
+        if self._closed:
+            return
+        framed = self._frame_args is not None and self._batch is None
+        try:
+            if framed:
+                data = encoded.frame(self.format, *self._frame_args)
+            else:
+                data = encoded.encode(self.format)
+        except exc.MessageEncodeError as e:
+            LOGGER.debug('Not sending notification: %s', e)
+            self._metrics.unencodable.inc()
+            return
+        origin = None
+        if live:
+            origin = encoded.received_at
+            if encoded.trace is not None:
+                encoded.trace.enqueue()
+                origin = encoded.trace
+            if self._held is not None:
+                if self._make_room(self._held):
+                    self._held.append((data, origin, framed))
+                return
+        self._queue_notification(data, origin, framed)
+
+    def _queue_notification(self, data, origin, framed):
+        if framed:
+            self._enqueue(data, origin)
+        else:
+            self.send_encoded(data, origin)
+
+    def send_encoded(self, data, received_at=None):
+        """Send an already encoded notification command to this client.
+
+        received_at is when the notification reached the server, or its
+        tracing.Trace.
+        """
+        if self._closed:
+            return
+        if self._batch is None:
+            self._enqueue(data, received_at)
+            return
+        batched = self._batched
+        if not batched:
+            self._batched_received_at = received_at
+        batched.append(data)
+        self._batched_bytes += len(data)
+        max_count, max_bytes, max_delay = self._batch
+        if len(batched) >= max_count or self._batched_bytes >= max_bytes:
+            self._flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = asyncio.get_event_loop().call_later(
+                max_delay, self._flush_batch
+            )
+
+    def _flush_batch(self):
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        if not self._batched:
+            return
+        batched = self._batched
+        self._batched = []
+        self._batched_bytes = 0
+        self._enqueue(self.format.encode_batch(BATCH_CMD_TYPE, 'commands',
+                                               batched),
+                      self._batched_received_at)
+
+    def _enqueue(self, data, received_at=None):
+        # A closed connection may still be subscribed until its handler
+        # returns, and nothing would drain what it queued
+        if self._closed:
+            return
+        if self._make_room(self._send_queue):
+            self._send_queue.append((data, received_at))
+            self._send_ready.set()
+
+    def _make_room(self, queue):
+        """Apply the slow consumer policy before appending to a queue.
+
+        Returns whether the item should be appended.
+        """
+        if len(queue) < self._send_queue_size:
+            return True
+        if self._slow_consumer_policy == DROP_NEWEST:
+            self.dropped += 1
+            self._metrics.dropped.inc()
+            return False
+        elif self._slow_consumer_policy == DROP_OLDEST:
+            queue.popleft()
+            self.dropped += 1
+            self._metrics.dropped.inc()
+        elif self._over_limit_since is None:
+            loop = asyncio.get_event_loop()
+            self._over_limit_since = loop.time()
+            if self._slow_consumer_timer is None:
+                self._slow_consumer_timer = loop.call_later(
+                    self._slow_consumer_timeout,
+                    self._check_slow_consumer
+                )
+        return True
+
+    def _check_slow_consumer(self):
+        self._slow_consumer_timer = None
+        if self._over_limit_since is None:
+            return
+        loop = asyncio.get_event_loop()
+        remaining = (self._over_limit_since + self._slow_consumer_timeout -
+                     loop.time())
+        if remaining > 0:
+            self._slow_consumer_timer = loop.call_later(
+                remaining, self._check_slow_consumer
+            )
+            return
+        LOGGER.warning('Disconnecting slow consumer with %d queued messages',
+                       len(self._send_queue))
+        self._metrics.slow_consumer_disconnects.inc()
+        self.stop()
+        asyncio.ensure_future(
+            self.websocket.close(code=1008, reason='Slow consumer')
+        )
+
+    def _record_sent(self, sent):
+        """Record the writes of data received at each of sent completing."""
+        now = time.monotonic()
+        observe = self._metrics.send_latency.observe
+        for received_at in sent:
+            if received_at is None:
+                continue
+            if type(received_at) is tracing.Trace:
+                received_at.write(now)
+                received_at = received_at.received_at
+            observe(now - received_at)
+
+    async def _write_queued(self):
+        queue = self._send_queue
+        try:
+            while True:
+                await self._send_ready.wait()
+                while queue:
+                    # Items are taken off the queue before awaiting their
+                    # write, so they cannot be dropped while in flight
+                    if type(queue[0][0]) is framing.Frame:
+                        sent = await framing.write_frames(self.websocket,
+                                                          queue)
+                    else:
+                        data, received_at = queue.popleft()
+                        await self.websocket.send(data)
+                        sent = (received_at,)
+                    self._record_sent(sent)
+                    if (self._over_limit_since is not None and
+                            len(queue) < self._send_queue_size):
+                        self._over_limit_since = None
+                    if len(queue) < self._send_queue_low:
+                        self._send_space.set()
+                self._send_ready.clear()
+                self._send_space.set()
+        except websockets.exceptions.ConnectionClosed:
+            self._closed = True
+            self._send_space.set()
 
 
 class SubscriptionMap(object):
-    def __init__(self):
-        self._service_map = collections.defaultdict(set)
-        self._connection_map = collections.defaultdict(set)
+    """Connections subscribed to services or dotted patterns.
+
+    A subscription is either a service name, such as 'compute', or a dotted
+    pattern such as 'compute.instance.*' or '#' which is matched against the
+    event_type and publisher_id of each notification. Connections may also
+    set filters, which then apply to all of their subscriptions, and ask for
+    bursts of notifications to be coalesced.
+
+    Service names are interned to small integer ids, and the subscribers of
+    each service are kept in a dense list which route() hands out without
+    copying. Each subscribed connection has a small integer id indexing an
+    array of (service id, position in the service's list) pairs, so that a
+    subscription is removed by moving the service's last subscriber into
+    its place. Services without subscribers and connections without
+    subscriptions are forgotten, and their ids reused, so memory is bounded
+    by the most subscriptions ever held at once. Dicts do not shrink, so
+    the tables are rebuilt whenever the last connection is removed.
+
+    If on_change is given it is called with a service or pattern and True
+    when it gains its first subscriber, or False when it loses its last.
+    """
+
+    def __init__(self, on_change=None):
+        self._on_change = on_change
+        self._reset()
+        self._patterns = routing.RoutingTrie()
+        self._filters = filters.FilterIndex()
+        # Connections which receive notifications through the coalescer
+        self.coalescing = set()
+
+    def _reset(self):
+        self._service_ids = {}
+        self._service_names = []
+        self._subscribers = []
+        self._free_service_ids = []
+        self._connection_ids = {}
+        # Connection id to an array of service id, position pairs
+        self._connection_subs = []
+        # Connection id to the patterns it is subscribed to, if any
+        self._connection_patterns = {}
+        self._free_connection_ids = []
+        # Pattern to the number of connections subscribed to it
+        self._pattern_counts = {}
+
+    def _connection_id(self, connection):
+        cid = self._connection_ids.get(connection)
+        if cid is None:
+            if self._free_connection_ids:
+                cid = self._free_connection_ids.pop()
+                self._connection_subs[cid] = array.array('I')
+            else:
+                cid = len(self._connection_subs)
+                self._connection_subs.append(array.array('I'))
+            self._connection_ids[connection] = cid
+        return cid
+
+    def _release_connection(self, connection, cid):
+        del self._connection_ids[connection]
+        self._connection_subs[cid] = None
+        self._free_connection_ids.append(cid)
+        if not self._connection_ids:
+            self._reset()
+
+    def _service_id(self, service):
+        sid = self._service_ids.get(service)
+        if sid is None:
+            if self._free_service_ids:
+                sid = self._free_service_ids.pop()
+                self._service_names[sid] = service
+                self._subscribers[sid] = []
+            else:
+                sid = len(self._service_names)
+                self._service_names.append(service)
+                self._subscribers.append([])
+            self._service_ids[service] = sid
+            if self._on_change is not None:
+                self._on_change(service, True)
+        return sid
+
+    def _detach(self, pairs):
+        """Remove subscribers given as service id, position pairs."""
+        all_subscribers = self._subscribers
+        connection_subs = self._connection_subs
+        connection_ids = self._connection_ids
+        for i in range(0, len(pairs), 2):
+            sid = pairs[i]
+            pos = pairs[i + 1]
+            subscribers = all_subscribers[sid]
+            last = subscribers.pop()
+            if pos < len(subscribers):
+                subscribers[pos] = last
+                subs = connection_subs[connection_ids[last]]
+                subs[subs[::2].index(sid) * 2 + 1] = pos
+            elif not subscribers:
+                service = self._service_names[sid]
+                del self._service_ids[service]
+                self._service_names[sid] = None
+                all_subscribers[sid] = None
+                self._free_service_ids.append(sid)
+                if self._on_change is not None:
+                    self._on_change(service, False)
+
+    def _add_pattern(self, pattern, connection):
+        self._patterns.add(pattern, connection)
+        count = self._pattern_counts.get(pattern, 0)
+        self._pattern_counts[pattern] = count + 1
+        if not count and self._on_change is not None:
+            self._on_change(pattern, True)
+
+    def _remove_pattern(self, pattern, connection):
+        self._patterns.remove(pattern, connection)
+        count = self._pattern_counts.pop(pattern) - 1
+        if count:
+            self._pattern_counts[pattern] = count
+        elif self._on_change is not None:
+            self._on_change(pattern, False)
 
     def add_subscription(self, service, connection):
-        self._service_map[service].add(connection)
-        self._connection_map[connection].add(service)
+        """Subscribe a connection, returning whether it was not already."""
+        cid = self._connection_id(connection)
+        if routing.is_pattern(service):
+            patterns = self._connection_patterns.setdefault(cid, [])
+            if service in patterns:
+                return False
+            patterns.append(service)
+            self._add_pattern(service, connection)
+            return True
+        subs = self._connection_subs[cid]
+        sid = self._service_id(service)
+        if sid in subs[::2]:
+            return False
+        subscribers = self._subscribers[sid]
+        subs.append(sid)
+        subs.append(len(subscribers))
+        subscribers.append(connection)
+        return True
+
+    def remove_subscription(self, service, connection):
+        """Unsubscribe a connection, returning whether it was subscribed."""
+        cid = self._connection_ids.get(connection)
+        if cid is None:
+            return False
+        removed = False
+        if routing.is_pattern(service):
+            patterns = self._connection_patterns.get(cid, ())
+            if service in patterns:
+                patterns.remove(service)
+                self._remove_pattern(service, connection)
+                if not patterns:
+                    del self._connection_patterns[cid]
+                removed = True
+        else:
+            sid = self._service_ids.get(service)
+            subs = self._connection_subs[cid]
+            if sid is not None and sid in subs[::2]:
+                i = subs[::2].index(sid) * 2
+                pairs = subs[i:i + 2]
+                del subs[i:i + 2]
+                self._detach(pairs)
+                removed = True
+        if not self._connection_subs[cid] and (
+                cid not in self._connection_patterns):
+            self._release_connection(connection, cid)
+        return removed
+
+    def replace(self, connection, services):
+        """Make services the only subscriptions of a connection.
+
+        Returns the lists of subscriptions added and removed.
+        """
+        wanted = set(services)
+        removed = [service for service in self.get_services(connection)
+                   if service not in wanted]
+        for service in removed:
+            self.remove_subscription(service, connection)
+        added = [service for service in services
+                 if self.add_subscription(service, connection)]
+        return added, removed
+
+    def set_filters(self, connection, expressions):
+        self._filters.set_filters(connection, expressions)
+
+    def filtered(self, connection):
+        """Whether a connection has filters."""
+        return connection in self._filters
+
+    def set_coalescing(self, connection, enabled):
+        if enabled:
+            self.coalescing.add(connection)
+        else:
+            self.coalescing.discard(connection)
 
     def remove_connection(self, connection):
-        for service in self._connection_map[connection]:
-            self._service_map[service].remove(connection)
+        self.coalescing.discard(connection)
+        self._filters.remove_connection(connection)
+        cid = self._connection_ids.pop(connection, None)
+        if cid is None:
+            return
+        subs = self._connection_subs[cid]
+        self._connection_subs[cid] = None
+        self._free_connection_ids.append(cid)
+        # No other subscriber can be moved into this connection's place
+        self._detach(subs)
+        if cid in self._connection_patterns:
+            for pattern in self._connection_patterns.pop(cid):
+                self._remove_pattern(pattern, connection)
+        if not self._connection_ids:
+            self._reset()
+
+    def route(self, notification):
+        """Return the connections a notification should be delivered to.
+
+        The returned collection must not be modified by the caller, and is
+        only valid until the subscriptions next change.
+        """
+        sid = self._service_ids.get(notification.get('service'))
+        connections = self._subscribers[sid] if sid is not None else ()
+        matched = set()
+        for key in (notification.get('event_type'),
+                    notification.get('publisher_id')):
+            if key:
+                matched |= self._patterns.match(key)
+        if matched:
+            connections = matched.union(connections)
+        if connections and self._filters:
+            connections = self._filters.apply(notification, connections)
+        return connections
+
+    def accepts(self, connection, notification):
+        """Whether the filters of a connection accept a notification."""
+        if connection not in self._filters:
+            return True
+        return bool(self._filters.apply(notification, {connection}))
 
     def get_connections(self, service):
-        return self._service_map[service]
+        sid = self._service_ids.get(service)
+        if sid is None:
+            return ()
+        return self._subscribers[sid]
 
     def get_services(self, connection):
-        return self._connection_map[connection]
+        cid = self._connection_ids.get(connection)
+        if cid is None:
+            return []
+        names = self._service_names
+        services = [names[sid] for sid in self._connection_subs[cid][::2]]
+        services.extend(self._connection_patterns.get(cid, ()))
+        return services
+
+    def subscriber_counts(self):
+        """Return the number of connections subscribed to each service."""
+        subscribers = self._subscribers
+        counts = dict((service, len(subscribers[sid]))
+                      for service, sid in self._service_ids.items())
+        counts.update(self._pattern_counts)
+        return counts
 
 
 class Server(object):
-    def __init__(self, notify_source, host='localhost', port='9999'):
+    def __init__(self, notify_source, host='localhost', port='9999',
+                 send_queue_size=1000, slow_consumer_policy=DROP_OLDEST,
+                 slow_consumer_timeout=10, max_batch_count=1000,
+                 max_batch_bytes=1024 * 1024, max_batch_delay=1.0,
+                 reuse_port=False,
+                 replay_count=1000, replay_bytes=10 * 1024 * 1024,
+                 journal=None, coalesce_window=0,
+                 coalesce_fields=coalesce.DEFAULT_RESOURCE_FIELDS,
+                 compression_mode=compression.PER_CONNECTION,
+                 compression_level=-1, compression_window_bits=12,
+                 compression_memory_level=5, compression_cache_size=256,
+                 metrics=None, tracer=None, bindings=None,
+                 binding_key_format='%(service)s.#'):
         self._host = host
         self._port = port
+        self._reuse_port = reuse_port
+        self._serve_args = compression.server_extensions(
+            compression_mode,
+            level=compression_level,
+            window_bits=compression_window_bits,
+            memory_level=compression_memory_level,
+            cache_size=compression_cache_size
+        )
+        self._metrics = metrics or osws_metrics.Metrics()
+        self._metrics.add_collector(self._collect_metrics)
+        self._tracer = tracer
+        self._connection_args = {
+            'send_queue_size': send_queue_size,
+            'slow_consumer_policy': slow_consumer_policy,
+            'slow_consumer_timeout': slow_consumer_timeout,
+            'max_batch_count': max_batch_count,
+            'max_batch_bytes': max_batch_bytes,
+            'max_batch_delay': max_batch_delay,
+            'metrics': self._metrics,
+        }
+        self._journal = journal
+        self._seq = 0
+        # Sequence numbers start over, and so are told apart, with each
+        # epoch
+        self.epoch = uuid.uuid4().hex
+        if journal is not None:
+            # Carry on from the journal so sequence numbers stay unique
+            self._seq = journal.last_seq
+            self.epoch = journal.epoch
+            self._connection_args['journal'] = journal
+        self._coalescer = None
+        if coalesce_window:
+            self._coalescer = coalesce.Coalescer(coalesce_window,
+                                                 self._publish_coalesced,
+                                                 coalesce_fields)
+            self._connection_args['coalesce'] = True
+        self._replay_log = None
+        if replay_count:
+            self._replay_log = replay.ReplayLog(replay_count, replay_bytes,
+                                                epoch=self.epoch,
+                                                last_seq=self._seq)
+            self._connection_args['replay_log'] = self._replay_log
         self._running = False
         self._connected = set()
-        self._subscriptions = SubscriptionMap()
+        self._bindings = bindings
+        self._binding_key_format = binding_key_format
+        self._subscriptions = SubscriptionMap(
+            self._update_bindings if bindings is not None else None
+        )
         notify_source.add_message_handler(self._handle_amqp_message)
 
     @property
@@ -115,27 +952,156 @@ class Server(object):
             raise ValueError('Already running')
 
         self._running = True
-        self.server = await websockets.serve(self._handle_ws,
-                                             self._host,
-                                             self._port)
+        self.server = await websockets.serve(
+            self._handle_ws,
+            self._host,
+            self._port,
+            reuse_port=self._reuse_port,
+            subprotocols=formats.subprotocols(),
+            **self._serve_args
+        )
 
     def stop(self):
         self._running = False
+        if self._coalescer is not None:
+            self._coalescer.flush()
         self.server.close()
 
     async def wait_closed(self):
         await self.server.wait_closed()
 
     async def _handle_ws(self, websocket, path):
-        conn = Connection(websocket, self._subscriptions)
+        conn = Connection(websocket, self._subscriptions,
+                          **self._connection_args)
         self._connected.add(conn)
+        conn.start()
         try:
-            while self._running:
-                await conn.handle()
+            await conn.handle()
         finally:
+            conn.stop()
             self._subscriptions.remove_connection(conn)
             self._connected.remove(conn)
 
-    def _handle_amqp_message(self, properties, body):
-        import pdb;pdb.set_trace()
-        print(body)
+    def publish(self, notification, received_at=None, trace=None):
+        """Fan a notification out to every subscribed connection.
+
+        The notification is stamped with the next sequence number. The
+        outgoing command is encoded once per wire format in use and the same
+        data is handed to each connection, so the encoding cost depends on
+        the message rate rather than on the number of subscribers.
+        Connections which asked for coalescing get the notification from the
+        coalescer instead.
+
+        received_at is the time.monotonic() time the notification reached
+        the server, from which fan-out and send latencies are measured, and
+        trace its tracing.Trace if it was sampled.
+        """
+        if received_at is None:
+            received_at = time.monotonic()
+        self._seq += 1
+        notification.set('seq', self._seq)
+        encoded = formats.Encoded(messages.Command.envelope(notification),
+                                  received_at, trace)
+        if self._replay_log is not None:
+            size = len(encoded.encode(formats.JSON))
+            self._replay_log.append(
+                replay.Entry(self._seq, notification, encoded, size)
+            )
+        if self._journal is not None:
+            self._journal.append(
+                self._seq, encoded.encode(formats.JSON).encode('utf-8'),
+                key=_journal_key(notification)
+            )
+        connections = self._subscriptions.route(notification)
+        if trace is not None:
+            trace.routed(self._seq)
+        coalescing = self._subscriptions.coalescing
+        if connections and not coalescing.isdisjoint(connections):
+            self._coalescer.add(
+                notification, encoded,
+                frozenset(coalescing.intersection(connections))
+            )
+            connections = [conn for conn in connections
+                           if conn not in coalescing]
+        metrics = self._metrics
+        unencodable = metrics.unencodable.value
+        for conn in connections:
+            conn.send_notification(encoded)
+        unencodable = metrics.unencodable.value - unencodable
+        if unencodable:
+            LOGGER.warning('Unable to encode notification %d for %d clients',
+                           self._seq, unencodable)
+        metrics.published.inc()
+        metrics.deliveries.inc(len(connections) - unencodable)
+        metrics.fanout_latency.observe(time.monotonic() - received_at)
+        if trace is not None:
+            trace.published()
+
+    def _publish_coalesced(self, notification, encoded):
+        connections = self._subscriptions.coalescing.intersection(
+            self._subscriptions.route(notification))
+        for conn in connections:
+            conn.send_notification(encoded)
+        self._metrics.deliveries.inc(len(connections))
+
+    def _update_bindings(self, service, subscribed):
+        """Have the broker route only what clients are subscribed to.
+
+        Patterns may match on either the event_type or the publisher_id, so
+        any pattern subscription needs every notification.
+        """
+        if routing.is_pattern(service):
+            key = routing.MULTI_WILDCARD
+        else:
+            key = self._binding_key_format % {'service': service}
+        if subscribed:
+            self._bindings.bind(key)
+        else:
+            self._bindings.unbind(key)
+
+    def _handle_amqp_message(self, properties, body, source=None):
+        # Handlers run inside the consumer's on_message, so this is when
+        # RabbitMQ delivered the notification
+        received_at = time.monotonic()
+        trace = None
+        if self._tracer is not None:
+            trace = self._tracer.sample(received_at)
+        try:
+            notification = messages.Notification.from_amqp(body, source)
+        except exc.MessageDecodeError:
+            LOGGER.warning('Unable to decode notification from %s on %s',
+                           getattr(properties, 'app_id', None), source)
+            self._metrics.undecodable.inc()
+            if trace is not None:
+                self._tracer.finish(trace)
+            return
+        if trace is not None:
+            trace.decoded()
+        self.publish(notification, received_at, trace)
+
+    def _collect_metrics(self):
+        connections = self._connected
+        depths = osws_metrics.Histogram(
+            'osws_send_queue_depth',
+            'Messages queued for each client.',
+            buckets=osws_metrics.QUEUE_DEPTH_BUCKETS
+        )
+        for conn in connections:
+            depths.observe(conn.queue_depth)
+        subscribers = [
+            ('osws_subscribers', {'service': service}, count)
+            for service, count in sorted(
+                self._subscriptions.subscriber_counts().items())
+        ]
+        return [
+            ('osws_connections', osws_metrics.GAUGE,
+             'Connected websocket clients.',
+             [('osws_connections', None, len(connections))]),
+            ('osws_subscribers', osws_metrics.GAUGE,
+             'Clients subscribed to each service or pattern.', subscribers),
+            (depths.name, depths.type, depths.help, depths.samples()),
+            ('osws_send_queue_depth_max', osws_metrics.GAUGE,
+             'Most messages queued for any one client.',
+             [('osws_send_queue_depth_max', None,
+               max([conn.queue_depth for conn in connections] or [0]))]),
+        ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import io
+import os
+
+import fixtures
+
+from osws.benchmarks import micro
+from osws.benchmarks import subscriptions
+from osws.benchmarks import utils
+from osws.tests import base
+
+
+class TestCompare(base.TestCase):
+    def test_regressions(self):
+        baseline = {'fast': 100.0, 'slow': 100.0, 'gone': 10.0}
+        results = {'fast': 150.0, 'slow': 75.0, 'new': 1.0}
+        self.assertEqual([('slow', 100.0, 75.0, -0.25)],
+                         utils.compare(results, baseline, 0.2))
+        self.assertEqual([], utils.compare(results, baseline, 0.3))
+
+    def test_save_and_load(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'baseline.json')
+        utils.save_results(path, {'a': 1.5})
+        self.assertEqual({'a': 1.5}, utils.load_results(path))
+
+
+class TestMicro(base.TestCase):
+    def test_gate(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'baseline.json')
+        self.useFixture(fixtures.MonkeyPatch('sys.stdout', io.StringIO()))
+        args = ['--number', '10', '--connections', '10']
+        self.assertEqual(0, micro.main(args + ['--save', path]))
+        utils.save_results(path, dict(
+            (name, value * 100)
+            for name, value in utils.load_results(path).items()
+        ))
+        self.assertEqual(1, micro.main(args + ['--compare', path]))
+
+
+class TestSubscriptions(base.TestCase):
+    def test_no_growth(self):
+        result = subscriptions.run(connections=200)['subscription_map']
+        self.assertGreater(result['bytes_per_subscription'], 0)
+        self.assertLess(result['churn_growth_bytes'], 1024)
+        self.assertLess(result['retained_after_removal_bytes'], 1024)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+
+from osws import coalesce
+from osws import messages
+from osws.tests import base
+
+
+def make_notification(seq, payload, event_type='compute.instance.update'):
+    return messages.Notification(service='compute',
+                                 event_type=event_type,
+                                 publisher_id='compute.host1',
+                                 priority='INFO',
+                                 timestamp=None,
+                                 payload=payload,
+                                 seq=seq)
+
+
+class TestCoalescer(base.TestCase):
+    def setUp(self):
+        super(TestCoalescer, self).setUp()
+        self.emitted = []
+        self.coalescer = coalesce.Coalescer(0.01, self._emit)
+
+    def _emit(self, notification, encoded):
+        self.emitted.append(notification.get('seq'))
+
+    @base.asynctest
+    async def test_keeps_latest(self):
+        for seq in range(1, 4):
+            self.coalescer.add(make_notification(seq, {'instance_id': 'a'}),
+                               None)
+        self.coalescer.add(make_notification(4, {'instance_id': 'b'}), None)
+        self.assertEqual([], self.emitted)
+        self.assertEqual(2, self.coalescer.merged)
+        await asyncio.sleep(0.05)
+        self.assertEqual([3, 4], self.emitted)
+        self.assertEqual(0, len(self.coalescer))
+
+    @base.asynctest
+    async def test_audience(self):
+        self.coalescer.add(make_notification(1, {'instance_id': 'a'}), None,
+                           frozenset(['x']))
+        self.coalescer.add(make_notification(2, {'instance_id': 'a'}), None,
+                           frozenset(['y']))
+        self.coalescer.add(make_notification(3, {'instance_id': 'a'}), None,
+                           frozenset(['x']))
+        await asyncio.sleep(0.05)
+        self.assertEqual([3, 2], self.emitted)
+
+    @base.asynctest
+    async def test_new_window_after_emit(self):
+        self.coalescer.add(make_notification(1, {'instance_id': 'a'}), None)
+        await asyncio.sleep(0.05)
+        self.coalescer.add(make_notification(2, {'instance_id': 'a'}), None)
+        await asyncio.sleep(0.05)
+        self.assertEqual([1, 2], self.emitted)
+
+    @base.asynctest
+    async def test_keyed_by_event_type(self):
+        self.coalescer.add(make_notification(1, {'instance_id': 'a'}), None)
+        self.coalescer.add(make_notification(
+            2, {'instance_id': 'a'}, 'compute.instance.create.end'), None)
+        await asyncio.sleep(0.05)
+        self.assertEqual([1, 2], self.emitted)
+
+    def test_no_resource_id(self):
+        self.coalescer.add(make_notification(1, {'state': 'active'}), None)
+        self.coalescer.add(make_notification(2, {'instance_id': ['a']}),
+                           None)
+        self.assertEqual([1, 2], self.emitted)
+
+    def test_resource_fields(self):
+        coalescer = coalesce.Coalescer(1, self._emit, ['payload.port.id'])
+        self.assertEqual(('port.create.end', 'p1'), coalescer.key(
+            make_notification(1, {'port': {'id': 'p1'}}, 'port.create.end')))
+        self.assertIsNone(coalescer.key(
+            make_notification(1, {'instance_id': 'a'})))
+
+    @base.asynctest
+    async def test_flush(self):
+        self.coalescer.add(make_notification(1, {'instance_id': 'a'}), None)
+        self.coalescer.flush()
+        self.assertEqual([1], self.emitted)
+        await asyncio.sleep(0.05)
+        self.assertEqual([1], self.emitted)
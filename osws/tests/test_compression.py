@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import random
+import zlib
+
+import websockets
+
+from osws import compression
+from osws import server as osws_server
+from osws.tests import base
+from osws.tests import test_server
+
+
+def inflate(data, window_bits=12):
+    return zlib.decompressobj(-window_bits).decompress(
+        data + b'\x00\x00\xff\xff')
+
+
+class TestCompressedCache(base.TestCase):
+    def test_reused(self):
+        cache = compression.CompressedCache(2)
+        data = b'{"payload": "%s"}' % (b'x' * 100)
+        first = cache.compress(data, 12)
+        self.assertIs(first, cache.compress(bytes(bytearray(data)), 12))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertLess(len(first), len(data))
+        self.assertEqual(data, inflate(first))
+
+    def test_keyed_by_window_bits(self):
+        cache = compression.CompressedCache(2)
+        cache.compress(b'abc', 12)
+        cache.compress(b'abc', 15)
+        self.assertEqual(2, cache.misses)
+
+    def test_bounded(self):
+        cache = compression.CompressedCache(2)
+        for data in (b'a', b'b', b'c'):
+            cache.compress(data, 12)
+        self.assertEqual(2, len(cache))
+        cache.compress(b'a', 12)
+        self.assertEqual(4, cache.misses)
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, compression.server_extensions, 'derp')
+
+
+class TestSharedCompression(base.AsyncTestCase):
+    @base.asynctest
+    async def test_broadcast_compressed_once(self):
+        consumer = test_server.FakeConsumer()
+        port = random.randint(20000, 60000)
+        srv = osws_server.Server(notify_source=consumer, port=port,
+                                 compression_mode=compression.SHARED)
+        await srv.start()
+        cache = srv._serve_args['extensions'][0]._cache
+        sockets = []
+        try:
+            for _ in range(3):
+                ws = await websockets.connect('ws://localhost:%d/' % port)
+                sockets.append(ws)
+                await ws.send(json.dumps({
+                    'cmd_type': 'subscribe',
+                    'payload': {'services': ['compute']}
+                }))
+                await ws.recv()
+            misses, hits = cache.misses, cache.hits
+            consumer.notify(test_server.make_notification_body(
+                payload={'state': 'x' * 200}))
+            for ws in sockets:
+                resp = json.loads(await ws.recv())
+                self.assertEqual('x' * 200,
+                                 resp['payload']['payload']['state'])
+            # The compressed frame itself is shared, so the cache is only
+            # consulted once
+            self.assertEqual(misses + 1, cache.misses)
+            self.assertEqual(hits, cache.hits)
+        finally:
+            for ws in sockets:
+                await ws.close()
+            srv.stop()
+            await srv.wait_closed()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from osws import exc
+from osws import filters
+from osws import messages
+from osws.tests import base
+
+
+def make_notification(**payload):
+    return messages.Notification(service='compute',
+                                 event_type='compute.instance.update',
+                                 publisher_id='compute.host1',
+                                 priority='INFO',
+                                 timestamp=None,
+                                 payload=payload)
+
+
+class TestCompileFilter(base.TestCase):
+    def test_equals(self):
+        pred = filters.compile_filter('payload.tenant_id == abc')
+        self.assertEqual(('payload', 'tenant_id'), pred.path)
+        self.assertEqual('==', pred.op)
+        self.assertEqual(('abc',), pred.values)
+
+    def test_json_values(self):
+        pred = filters.compile_filter('payload.vcpus != 4')
+        self.assertEqual((4,), pred.values)
+        self.assertTrue(pred.negated)
+        pred = filters.compile_filter('payload.name == "a b"')
+        self.assertEqual(('a b',), pred.values)
+
+    def test_in(self):
+        pred = filters.compile_filter('payload.state in [error, deleted]')
+        self.assertEqual(('error', 'deleted'), pred.values)
+        pred = filters.compile_filter('payload.state not  in ["error"]')
+        self.assertEqual('not in', pred.op)
+        self.assertEqual(('error',), pred.values)
+
+    def test_invalid(self):
+        for expr in ('payload.state', 'payload.state ~= x',
+                     'payload.state in error', 'payload.x == [1]',
+                     'payload.x in [[1]]', 42):
+            self.assertRaises(exc.InvalidFilterError,
+                              filters.compile_filter, expr)
+
+
+class TestFilterIndex(base.TestCase):
+    def setUp(self):
+        super(TestFilterIndex, self).setUp()
+        self.index = filters.FilterIndex()
+
+    def test_all_predicates_must_hold(self):
+        self.index.set_filters('a', ['payload.tenant_id == t1',
+                                     'payload.state in [error, deleted]'])
+        self.assertEqual({'a'}, self.index.match(
+            make_notification(tenant_id='t1', state='error')))
+        self.assertEqual(set(), self.index.match(
+            make_notification(tenant_id='t1', state='active')))
+        self.assertEqual(set(), self.index.match(
+            make_notification(tenant_id='t2', state='error')))
+
+    def test_negated(self):
+        self.index.set_filters('a', ['payload.state not in [active]'])
+        self.index.set_filters('b', ['payload.state != error'])
+        self.assertEqual({'a', 'b'}, self.index.match(
+            make_notification(state='building')))
+        self.assertEqual({'b'}, self.index.match(
+            make_notification(state='active')))
+        self.assertEqual({'a', 'b'}, self.index.match(make_notification()))
+
+    def test_top_level_and_missing_fields(self):
+        self.index.set_filters('a', ['event_type == compute.instance.update'])
+        self.index.set_filters('b', ['payload.flavor.name == m1.tiny'])
+        self.assertEqual({'a'}, self.index.match(make_notification()))
+        self.assertEqual({'a', 'b'}, self.index.match(
+            make_notification(flavor={'name': 'm1.tiny'})))
+        self.assertEqual({'a'}, self.index.match(
+            make_notification(flavor=['m1.tiny'])))
+
+    def test_apply(self):
+        self.index.set_filters('a', ['payload.state == error'])
+        self.assertEqual({'b'}, self.index.apply(
+            make_notification(state='active'), {'a', 'b'}))
+        self.assertEqual({'a', 'b'}, self.index.apply(
+            make_notification(state='error'), {'a', 'b'}))
+
+    def test_replace_and_remove(self):
+        self.index.set_filters('a', ['payload.state == error'])
+        self.index.set_filters('a', ['payload.state == active'])
+        self.assertEqual({'a'}, self.index.match(
+            make_notification(state='active')))
+        self.assertRaises(exc.InvalidFilterError, self.index.set_filters,
+                          'a', ['payload.state ~ x'])
+        self.assertIn('a', self.index)
+        self.index.remove_connection('a')
+        self.assertFalse(self.index)
+        self.assertEqual({}, self.index._fields)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import random
+
+import fixtures
+import websockets
+from websockets import frames
+
+from osws import compression
+from osws import framing
+from osws import journal
+from osws import server as osws_server
+from osws.tests import base
+from osws.tests import test_server
+
+
+class TestBuildFrame(base.TestCase):
+    def _assert_serialized(self, data, opcode, payload):
+        expected = frames.Frame(opcode, payload).serialize(mask=False,
+                                                           extensions=[])
+        frame = framing.build_frame(data)
+        self.assertIsInstance(frame, framing.Frame)
+        self.assertEqual(expected, frame)
+
+    def test_text(self):
+        for length in (0, 125, 126, 65535, 65536):
+            self._assert_serialized('x' * length, frames.OP_TEXT,
+                                    b'x' * length)
+
+    def test_unicode(self):
+        self._assert_serialized(u'caf\xe9', frames.OP_TEXT,
+                                u'caf\xe9'.encode('utf-8'))
+
+    def test_binary(self):
+        self._assert_serialized(b'\x00\x01', frames.OP_BINARY, b'\x00\x01')
+
+    def test_text_bytes(self):
+        expected = frames.Frame(frames.OP_TEXT, b'abc').serialize(
+            mask=False, extensions=[])
+        self.assertEqual(expected,
+                         framing.build_frame(memoryview(b'abc'), text=True))
+
+    def test_compressed(self):
+        frame = framing.build_frame('abc', compress=lambda data: b'z')
+        self.assertEqual(bytes([framing.FIN | framing.RSV1 | framing.OP_TEXT,
+                                1]) + b'z', frame)
+
+
+class FakeTransport(object):
+    pass
+
+
+class TestFrameArgs(base.TestCase):
+    def test_no_transport(self):
+        self.assertIsNone(framing.frame_args(test_server.FakeWebsocket()))
+
+    def test_no_extensions(self):
+        websocket = test_server.FakeWebsocket()
+        websocket.transport = FakeTransport()
+        websocket.extensions = []
+        self.assertEqual((None, None), framing.frame_args(websocket))
+
+    def test_per_connection_extension(self):
+        websocket = test_server.FakeWebsocket()
+        websocket.transport = FakeTransport()
+        websocket.extensions = [object()]
+        self.assertIsNone(framing.frame_args(websocket))
+
+
+class TestFrameOnceBroadcast(base.AsyncTestCase):
+    async def _broadcast(self, mode, clients=3):
+        consumer = test_server.FakeConsumer()
+        port = random.randint(20000, 60000)
+        srv = osws_server.Server(notify_source=consumer, port=port,
+                                 compression_mode=mode)
+        await srv.start()
+        sockets = []
+        try:
+            for _ in range(clients):
+                ws = await websockets.connect('ws://localhost:%d/' % port)
+                sockets.append(ws)
+                await ws.send(json.dumps({
+                    'cmd_type': 'subscribe',
+                    'payload': {'services': ['compute']}
+                }))
+                await ws.recv()
+            for conn in srv.connections:
+                self.assertIsNotNone(conn._frame_args)
+            for state in ('building', 'active'):
+                consumer.notify(test_server.make_notification_body(
+                    payload={'state': state * 100}))
+            return [[json.loads(await ws.recv()) for _ in range(2)]
+                    for ws in sockets]
+        finally:
+            for ws in sockets:
+                await ws.close()
+            srv.stop()
+            await srv.wait_closed()
+
+    @base.asynctest
+    async def test_uncompressed(self):
+        for received in await self._broadcast(compression.NONE):
+            self.assertEqual(['building' * 100, 'active' * 100],
+                             [r['payload']['payload']['state']
+                              for r in received])
+
+    @base.asynctest
+    async def test_compressed(self):
+        for received in await self._broadcast(compression.SHARED):
+            self.assertEqual([1, 2], [r['payload']['seq'] for r in received])
+
+    @base.asynctest
+    async def test_history(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        jrnl = journal.Journal(path, segment_size=4096)
+        self.addCleanup(jrnl.close)
+        consumer = test_server.FakeConsumer()
+        port = random.randint(20000, 60000)
+        srv = osws_server.Server(notify_source=consumer, port=port,
+                                 journal=jrnl,
+                                 compression_mode=compression.NONE)
+        await srv.start()
+        try:
+            for state in ('building', 'active'):
+                consumer.notify(test_server.make_notification_body(
+                    payload={'state': state}))
+            ws = await websockets.connect('ws://localhost:%d/' % port)
+            await ws.send(json.dumps({
+                'cmd_type': 'history',
+                'payload': {'services': ['compute']}
+            }))
+            # Records are framed as text straight from the journal
+            received = [await ws.recv() for _ in range(3)]
+            await ws.close()
+        finally:
+            srv.stop()
+            await srv.wait_closed()
+        for data in received:
+            self.assertIsInstance(data, str)
+        received = [json.loads(data) for data in received]
+        self.assertEqual(['building', 'active'],
+                         [r['payload']['payload']['state']
+                          for r in received[:2]])
+        self.assertEqual({'count': 2}, received[2]['payload'])
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import time
+
+import fixtures
+
+from osws import journal
+from osws.tests import base
+
+
+def seqs(records):
+    return [seq for seq, timestamp, key, data in records]
+
+
+class TestJournal(base.TestCase):
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+
+    def _journal(self, **kwargs):
+        kwargs.setdefault('segment_size', 4096)
+        kwargs.setdefault('index_interval', 256)
+        jrnl = journal.Journal(self.path, **kwargs)
+        self.addCleanup(jrnl.close)
+        return jrnl
+
+    def _fill(self, jrnl, count, start=1, now=0):
+        for seq in range(start, start + count):
+            jrnl.append(seq, b'{"seq": %d}' % seq, timestamp=now + seq)
+
+    def test_read_all(self):
+        jrnl = self._journal()
+        self._fill(jrnl, 3)
+        records = list(jrnl.read())
+        self.assertEqual([1, 2, 3], seqs(records))
+        self.assertEqual(b'{"seq": 2}', bytes(records[1][3]))
+        self.assertEqual(2.0, records[1][1])
+
+    def test_key(self):
+        jrnl = self._journal()
+        jrnl.append(1, b'{"seq": 1}', key=b'compute')
+        jrnl.append(2, b'{"seq": 2}')
+        jrnl.close()
+        records = list(self._journal().read())
+        self.assertEqual([b'compute', b''],
+                         [bytes(key) for _, _, key, _ in records])
+        self.assertEqual(b'{"seq": 1}', bytes(records[0][3]))
+
+    def test_read_seq_range(self):
+        jrnl = self._journal()
+        self._fill(jrnl, 500)
+        self.assertGreater(len(jrnl._segments), 1)
+        self.assertEqual(list(range(200, 301)),
+                         seqs(jrnl.read(start_seq=200, end_seq=300)))
+        self.assertEqual([499, 500], seqs(jrnl.read(start_seq=499)))
+        self.assertEqual([1, 2], seqs(jrnl.read(end_seq=2)))
+
+    def test_read_time_range(self):
+        jrnl = self._journal()
+        self._fill(jrnl, 500)
+        self.assertEqual([10, 11, 12],
+                         seqs(jrnl.read(start_time=10, end_time=12.5)))
+
+    def test_recover(self):
+        jrnl = self._journal()
+        self._fill(jrnl, 300)
+        jrnl.close()
+        jrnl = self._journal()
+        self.assertEqual(300, jrnl.last_seq)
+        self._fill(jrnl, 2, start=301)
+        self.assertEqual(list(range(1, 303)), seqs(jrnl.read()))
+
+    def test_empty(self):
+        jrnl = self._journal()
+        self.assertEqual(0, jrnl.last_seq)
+        self.assertEqual([], list(jrnl.read()))
+
+    def test_epoch(self):
+        jrnl = self._journal()
+        epoch = jrnl.epoch
+        self._fill(jrnl, 3)
+        jrnl.close()
+        self.assertEqual(epoch, self._journal().epoch)
+
+    def test_epoch_renewed_when_empty(self):
+        jrnl = self._journal()
+        epoch = jrnl.epoch
+        jrnl.close()
+        self.assertNotEqual(epoch, self._journal().epoch)
+
+    def test_oversized_record(self):
+        jrnl = self._journal()
+        jrnl.append(1, b'x' * 10000)
+        self.assertEqual([1], seqs(jrnl.read()))
+
+    def test_retention_bytes(self):
+        jrnl = self._journal(retention_bytes=3 * 4096)
+        self._fill(jrnl, 1000)
+        self.assertEqual(3, len([name for name in os.listdir(self.path)
+                                 if name.endswith(journal.SEGMENT_SUFFIX)]))
+        records = seqs(jrnl.read())
+        self.assertEqual(1000, records[-1])
+        self.assertGreater(records[0], 1)
+
+    def test_retention_seconds(self):
+        now = time.time()
+        jrnl = self._journal(retention_seconds=100)
+        self._fill(jrnl, 200, now=now - 1000)
+        jrnl.append(201, b'x' * 4096, timestamp=now)
+        self.assertEqual([201], seqs(jrnl.read()))
+        self.assertEqual(1, len(jrnl._segments))
+
+    def test_retention_seconds_quiet(self):
+        now = time.time()
+        jrnl = self._journal(retention_seconds=100)
+        self._fill(jrnl, 150, now=now - 1000)
+        self.assertGreater(len(jrnl._segments), 1)
+        # Segments expire without waiting for the next to be started
+        self._fill(jrnl, 1, start=151, now=now - 151)
+        self.assertEqual(1, len(jrnl._segments))
+        # Expired records left in a segment are not read
+        self.assertEqual([151], seqs(jrnl.read()))
@@ -14,6 +14,7 @@
 
 import json
 
+from osws import exc
 from osws import messages
 from osws.tests import base
 
@@ -52,3 +53,107 @@ class TestMessage(base.TestCase):
         self.assertEqual('complex_prop1_val', msg.get('complex_prop1'))
         self.assertEqual(True, isinstance(msg, ComplexMessage))
         self.assertEqual(True, isinstance(msg.get('sub_msg1'), SimpleMessage))
+
+
+class TestNotification(base.TestCase):
+    def test_from_amqp_envelope(self):
+        body = json.dumps({
+            'oslo.version': '2.0',
+            'oslo.message': json.dumps({
+                'event_type': 'compute.instance.update',
+                'publisher_id': 'compute.host1',
+                'priority': 'INFO',
+                'timestamp': '2016-01-01 00:00:00.000000',
+                'payload': {'state': 'active'}})})
+        msg = messages.Notification.from_amqp(body.encode('utf-8'))
+        self.assertEqual('compute', msg.get('service'))
+        self.assertEqual('compute.instance.update', msg.get('event_type'))
+        self.assertEqual({'state': 'active'}, msg.get('payload'))
+
+    def test_from_amqp_bare(self):
+        msg = messages.Notification.from_amqp(
+            '{"event_type": "port.create.end", "payload": {}}')
+        self.assertEqual('port', msg.get('service'))
+        self.assertEqual('', msg.get('publisher_id'))
+        self.assertIsNone(msg.get('source'))
+        self.assertNotIn('source', json.loads(msg.to_json()))
+
+    def test_from_amqp_source(self):
+        msg = messages.Notification.from_amqp(
+            '{"event_type": "port.create.end", "payload": {}}', 'cell1')
+        self.assertEqual('cell1', msg.get('source'))
+
+    def test_from_amqp_decode_error(self):
+        self.assertRaises(exc.MessageDecodeError,
+                          messages.Notification.from_amqp, '{,}')
+        self.assertRaises(exc.MessageDecodeError,
+                          messages.Notification.from_amqp, '[]')
+        self.assertRaises(exc.MessageDecodeError,
+                          messages.Notification.from_amqp, b'\xff\xfe{}')
+        self.assertRaises(exc.MessageDecodeError,
+                          messages.Notification.from_amqp,
+                          '{"publisher_id": 42, "event_type": "a.b"}')
+        self.assertRaises(exc.MessageDecodeError,
+                          messages.Notification.from_amqp,
+                          '{"event_type": ["a.b"]}')
+
+
+class TestSubscribe(base.TestCase):
+    def test_optional_properties(self):
+        msg = messages.Subscribe(services=['compute'])
+        self.assertIsNone(msg.get('filters'))
+        self.assertEqual({'services': ['compute']},
+                         json.loads(msg.to_json()))
+        msg = messages.Subscribe.from_json(
+            '{"filters": ["payload.state == error"]}')
+        self.assertEqual((), msg.get('services'))
+        self.assertEqual(['payload.state == error'], msg.get('filters'))
+
+
+class TestCommand(base.TestCase):
+    def test_get_message_string_payload(self):
+        cmd = messages.Command.from_json(
+            '{"cmd_type": "ping", "payload": "{\\"payload\\": 1}"}')
+        msg = cmd.get_message()
+        self.assertIsInstance(msg, messages.Ping)
+        self.assertEqual(1, msg.get('payload'))
+
+    def test_get_message_object_payload(self):
+        cmd = messages.Command.from_json(
+            '{"cmd_type": "ping", "payload": {"payload": 1}}')
+        self.assertEqual(1, cmd.get_message().get('payload'))
+
+    def test_get_message_errors(self):
+        self.assertRaises(exc.InvalidCommandTypeError,
+                          messages.Command(cmd_type='derp',
+                                           payload={}).get_message)
+        self.assertRaises(exc.InvalidCommandTypeError,
+                          messages.Command(cmd_type=[],
+                                           payload={}).get_message)
+        self.assertRaises(exc.InvalidMessagePropertyError,
+                          messages.Command, cmd_type='ping')
+        self.assertRaises(exc.InvalidMessagePropertyError,
+                          messages.Command(cmd_type='ping',
+                                           payload={}).get_message)
+        self.assertRaises(exc.MessageDecodeError,
+                          messages.Command(cmd_type='ping',
+                                           payload=[]).get_message)
+        self.assertRaises(exc.MessageDecodeError,
+                          messages.Command(cmd_type='ping',
+                                           payload={b'payload': 1}
+                                           ).get_message)
+        self.assertRaises(exc.MessageDecodeError,
+                          messages.Command.from_dict, {b'cmd_type': 'ping'})
+
+    def test_encode(self):
+        msg = messages.Pong(payload='derp')
+        cmd = messages.Command.for_message(msg)
+        self.assertEqual(json.loads(cmd.to_json()),
+                         json.loads(messages.Command.encode(msg)))
+
+    def test_invalid_property(self):
+        self.assertRaises(exc.InvalidMessagePropertyError,
+                          messages.Ping, derp=1)
+
+    def test_slots(self):
+        self.assertFalse(hasattr(messages.Ping(payload=1), '__dict__'))
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import json
+import random
+
+import websockets
+
+from osws import metrics
+from osws import server as osws_server
+from osws.tests import base
+from osws.tests import test_server
+
+
+async def http_get(port, path):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET %s HTTP/1.0\r\nHost: localhost\r\n\r\n' %
+                 path.encode('ascii'))
+    response = await reader.read()
+    writer.close()
+    head, body = response.split(b'\r\n\r\n', 1)
+    return head.split(b'\r\n')[0], body.decode('utf-8')
+
+
+def sample_values(text):
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+class TestHistogram(base.TestCase):
+    def test_buckets_cumulative(self):
+        hist = metrics.Histogram('latency', 'help', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            hist.observe(value)
+        self.assertEqual(4, hist.count)
+        self.assertEqual([
+            ('latency_bucket', {'le': '0.1'}, 2),
+            ('latency_bucket', {'le': '1'}, 3),
+            ('latency_bucket', {'le': '+Inf'}, 4),
+            ('latency_sum', None, 2.65),
+            ('latency_count', None, 4),
+        ], hist.samples())
+
+
+class TestMetrics(base.TestCase):
+    def test_render(self):
+        stats = metrics.Metrics()
+        stats.amqp_received.inc(3)
+        stats.add_collector(lambda: [
+            ('osws_test', metrics.GAUGE, 'A test.',
+             [('osws_test', {'service': 'com"pute'}, 1)])
+        ])
+        text = stats.render()
+        self.assertIn('# TYPE osws_amqp_messages_received_total counter\n'
+                      'osws_amqp_messages_received_total 3\n', text)
+        self.assertIn('# HELP osws_test A test.\n# TYPE osws_test gauge\n'
+                      'osws_test{service="com\\"pute"} 1\n', text)
+        self.assertIn('osws_send_latency_seconds_bucket{le="+Inf"} 0\n',
+                      text)
+
+
+class TestConnectionMetrics(base.TestCase):
+    @base.asynctest
+    async def test_dropped(self):
+        stats = metrics.Metrics()
+        websocket = test_server.FakeWebsocket()
+        conn = osws_server.Connection(websocket,
+                                      osws_server.SubscriptionMap(),
+                                      send_queue_size=1, metrics=stats)
+        for data in ('a', 'b', 'c'):
+            conn.send_encoded(data)
+        self.assertEqual(2, stats.dropped.value)
+
+    @base.asynctest
+    async def test_send_latency(self):
+        stats = metrics.Metrics()
+        websocket = test_server.FakeWebsocket()
+        conn = osws_server.Connection(websocket,
+                                      osws_server.SubscriptionMap(),
+                                      metrics=stats)
+        conn.start()
+        try:
+            conn.send_encoded('a', received_at=0)
+            conn.send_encoded('b')
+            await asyncio.sleep(0)
+            self.assertEqual(['a', 'b'], websocket.sent)
+            # Only messages which came from RabbitMQ are timed
+            self.assertEqual(1, stats.send_latency.count)
+            self.assertGreater(stats.send_latency.sum, 0)
+        finally:
+            conn.stop()
+
+
+class TestMetricsServer(base.AsyncTestCase):
+    @base.asynctest
+    async def test_scrape(self):
+        consumer = test_server.FakeConsumer()
+        port = random.randint(20000, 60000)
+        stats = metrics.Metrics()
+        srv = osws_server.Server(notify_source=consumer, port=port,
+                                 metrics=stats)
+        await srv.start()
+        metrics_server = metrics.MetricsServer(stats, host='127.0.0.1',
+                                               port=port + 1)
+        await metrics_server.start()
+        ws = await websockets.connect('ws://localhost:%d/' % port)
+        try:
+            await ws.send(json.dumps({
+                'cmd_type': 'subscribe',
+                'payload': {'services': ['compute', 'compute.#']}
+            }))
+            await ws.recv()
+            consumer.notify(test_server.make_notification_body())
+            await ws.recv()
+            consumer.notify('derp')
+
+            status, body = await http_get(port + 1, '/metrics')
+            self.assertEqual(b'HTTP/1.0 200 OK', status)
+            values = sample_values(body)
+            self.assertEqual(1, values['osws_notifications_published_total'])
+            self.assertEqual(1,
+                             values['osws_notifications_undecodable_total'])
+            self.assertEqual(1, values['osws_deliveries_total'])
+            self.assertEqual(1, values['osws_fanout_latency_seconds_count'])
+            self.assertEqual(1, values['osws_send_latency_seconds_count'])
+            self.assertEqual(1, values['osws_connections'])
+            self.assertEqual(1, values['osws_subscribers{service="compute"}'])
+            self.assertEqual(
+                1, values['osws_subscribers{service="compute.#"}'])
+            self.assertEqual(
+                1, values['osws_send_queue_depth_bucket{le="0"}'])
+
+            status, body = await http_get(port + 1, '/')
+            self.assertEqual(b'HTTP/1.0 404 Not Found', status)
+        finally:
+            await ws.close()
+            metrics_server.stop()
+            await metrics_server.wait_closed()
+            srv.stop()
+            await srv.wait_closed()
+
+        # Disconnected clients are no longer counted
+        self.assertNotIn('osws_subscribers{', stats.render())
+
+    @base.asynctest
+    async def test_loop_lag(self):
+        stats = metrics.Metrics()
+        stats.start_lag_monitor(0.01)
+        try:
+            await asyncio.sleep(0.05)
+        finally:
+            stats.stop_lag_monitor()
+        self.assertGreater(stats.loop_lag.count, 0)
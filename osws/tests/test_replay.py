@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from osws import messages
+from osws import replay
+from osws import routing
+from osws.tests import base
+
+
+def make_entry(seq, service='compute', event_type=None, size=10):
+    notification = messages.Notification(
+        service=service,
+        event_type=event_type or '%s.instance.update' % service,
+        publisher_id='%s.host1' % service,
+        priority='INFO',
+        timestamp=None,
+        payload={},
+        seq=seq)
+    return replay.Entry(seq, notification, None, size)
+
+
+def seqs(entries):
+    return [entry.seq for entry in entries]
+
+
+class TestReplayBuffer(base.TestCase):
+    def test_since(self):
+        buf = replay.ReplayBuffer(10, 1000)
+        for seq in (1, 2, 5, 7):
+            buf.append(make_entry(seq))
+        self.assertEqual([5, 7], seqs(buf.since(2)))
+        self.assertEqual([], seqs(buf.since(7)))
+        self.assertEqual([1, 2, 5, 7], seqs(buf.since(0)))
+
+    def test_bounded_by_count(self):
+        buf = replay.ReplayBuffer(2, 1000)
+        for seq in range(1, 5):
+            buf.append(make_entry(seq))
+        self.assertEqual([3, 4], seqs(buf.since(0)))
+        self.assertEqual(2, buf.evicted_seq)
+
+    def test_bounded_by_bytes(self):
+        buf = replay.ReplayBuffer(10, 25)
+        for seq in range(1, 5):
+            buf.append(make_entry(seq, size=10))
+        self.assertEqual(2, len(buf))
+        self.assertEqual(20, buf.size)
+
+
+class TestReplayLog(base.TestCase):
+    def setUp(self):
+        super(TestReplayLog, self).setUp()
+        self.log = replay.ReplayLog(3, 1000)
+        self.log.append(make_entry(1, 'compute'))
+        self.log.append(make_entry(2, 'network'))
+        self.log.append(make_entry(3, 'compute',
+                                   'compute.instance.create.end'))
+        self.log.append(make_entry(4, 'image'))
+
+    def test_services_merged_in_order(self):
+        entries, missed = self.log.since(1, {'compute', 'network'})
+        self.assertEqual([2, 3], seqs(entries))
+        self.assertFalse(missed)
+
+    def test_patterns(self):
+        patterns = routing.RoutingTrie()
+        patterns.add('*.instance.create.end', True)
+        entries, missed = self.log.since(0, {'image'}, patterns)
+        self.assertEqual([3, 4], seqs(entries))
+
+    def test_missed(self):
+        for seq in range(5, 8):
+            self.log.append(make_entry(seq, 'compute'))
+        entries, missed = self.log.since(2, {'compute'})
+        self.assertEqual([5, 6, 7], seqs(entries))
+        self.assertTrue(missed)
+        entries, missed = self.log.since(2, {'network'})
+        self.assertEqual([], seqs(entries))
+        self.assertFalse(missed)
+
+    def test_missed_patterns(self):
+        for seq in range(5, 8):
+            self.log.append(make_entry(seq, 'compute'))
+        patterns = routing.RoutingTrie()
+        patterns.add('compute.#', True)
+        entries, missed = self.log.since(2, set(), patterns)
+        self.assertEqual([5, 6, 7], seqs(entries))
+        self.assertTrue(missed)
+        # Only compute was evicted from, which the pattern does not match
+        patterns = routing.RoutingTrie()
+        patterns.add('network.#', True)
+        self.assertEqual(([], False), self.log.since(2, set(), patterns))
+
+    def test_missed_unknown_seq(self):
+        self.assertEqual(([], False), self.log.since(4, {'compute'}))
+        self.assertEqual(([], True), self.log.since(5, {'compute'}))
+
+    def test_missed_other_epoch(self):
+        log = replay.ReplayLog(3, 1000, epoch='a', last_seq=10)
+        log.append(make_entry(11, 'compute'))
+        entries, missed = log.since(10, {'compute'}, epoch='a')
+        self.assertEqual([11], seqs(entries))
+        self.assertFalse(missed)
+        self.assertEqual(([], True), log.since(10, {'compute'}, epoch='b'))
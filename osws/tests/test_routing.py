@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from osws import exc
+from osws import routing
+from osws.tests import base
+
+
+class TestRoutingTrie(base.TestCase):
+    def setUp(self):
+        super(TestRoutingTrie, self).setUp()
+        self.trie = routing.RoutingTrie()
+
+    def test_literal(self):
+        self.trie.add('compute.instance.create.end', 'a')
+        self.assertEqual({'a'}, self.trie.match('compute.instance.create.end'))
+        self.assertEqual(set(), self.trie.match('compute.instance.create'))
+
+    def test_word_wildcard(self):
+        self.trie.add('compute.*', 'a')
+        self.trie.add('*.instance.create.end', 'b')
+        self.assertEqual({'a'}, self.trie.match('compute.host1'))
+        self.assertEqual(set(), self.trie.match('compute'))
+        self.assertEqual(set(), self.trie.match('compute.instance.update'))
+        self.assertEqual({'b'}, self.trie.match('compute.instance.create.end'))
+
+    def test_multi_wildcard(self):
+        self.trie.add('#', 'a')
+        self.trie.add('compute.#', 'b')
+        self.trie.add('#.error', 'c')
+        self.trie.add('compute.#.end', 'd')
+        self.assertEqual({'a', 'b'}, self.trie.match('compute'))
+        self.assertEqual({'a', 'b', 'c'},
+                         self.trie.match('compute.instance.error'))
+        self.assertEqual({'a', 'b', 'd'},
+                         self.trie.match('compute.instance.create.end'))
+        self.assertEqual({'a'}, self.trie.match('network.port.create'))
+
+    def test_remove_prunes(self):
+        self.trie.add('compute.instance.*', 'a')
+        self.trie.add('compute.instance.*', 'b')
+        self.trie.remove('compute.instance.*', 'a')
+        self.assertEqual({'b'}, self.trie.match('compute.instance.update'))
+        self.trie.remove('compute.instance.*', 'b')
+        self.assertEqual({}, self.trie._root.children)
+        self.trie.remove('compute.unknown', 'b')
+
+    def test_validate(self):
+        routing.validate_pattern('compute.*.end')
+        for pattern in ('compute..end', 'compute.', 'comp*.end'):
+            self.assertRaises(exc.InvalidSubscriptionError,
+                              routing.validate_pattern, pattern)
+
+    def test_is_pattern(self):
+        self.assertFalse(routing.is_pattern('compute'))
+        self.assertTrue(routing.is_pattern('compute.*'))
+        self.assertTrue(routing.is_pattern('#'))
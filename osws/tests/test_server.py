@@ -15,26 +15,82 @@
 import asyncio
 import json
 import random
+import time
 import traceback
 
+from unittest import mock
+
 import fixtures
+import testtools
 import websockets
 
+from osws import formats
+from osws import journal
 from osws import messages
+from osws import metrics
 from osws import server as osws_server
 from osws.tests import base
 
 
+def make_notification_body(event_type='compute.instance.create.end',
+                           publisher_id='compute.host1', payload=None):
+    return json.dumps({
+        'oslo.version': '2.0',
+        'oslo.message': json.dumps({
+            'event_type': event_type,
+            'publisher_id': publisher_id,
+            'priority': 'INFO',
+            'timestamp': '2016-01-01 00:00:00.000000',
+            'payload': payload or {},
+        })
+    })
+
+
 class FakeConsumer(object):
+    def __init__(self):
+        self._message_handlers = set()
+
     def add_message_handler(self, handler):
-        pass
+        self._message_handlers.add(handler)
+
+    def notify(self, body, properties=None, **kwargs):
+        for handler in self._message_handlers:
+            handler(properties, body, **kwargs)
+
+
+class FakeConnection(object):
+    def __init__(self, fmt=formats.JSON):
+        self.format = fmt
+        self.sent = []
+
+    def send_encoded(self, data):
+        self.sent.append(data)
+
+    def send_notification(self, encoded):
+        self.send_encoded(encoded.encode(self.format))
+
+
+class FakeWebsocket(object):
+    def __init__(self):
+        self.sent = []
+        self.closed = None
+        self.unblocked = asyncio.Event()
+        self.unblocked.set()
+
+    async def send(self, data):
+        await self.unblocked.wait()
+        self.sent.append(data)
+
+    async def close(self, code=1000, reason=''):
+        self.closed = (code, reason)
 
 
 class ServerFixture(base.AsyncFixture):
     async def asyncSetUp(self):
         self.port = random.randint(20000, 60000)
         self.host = 'localhost'
-        self.server = osws_server.Server(notify_source=FakeConsumer(),
+        self.consumer = FakeConsumer()
+        self.server = osws_server.Server(notify_source=self.consumer,
                                          host=self.host, port=self.port)
         self.addAsyncCleanUp(self._clean_up)
         await self.server.start()
@@ -45,15 +101,18 @@ class ServerFixture(base.AsyncFixture):
 
 
 class WebsocketFixture(base.AsyncFixture):
-    def __init__(self, host, port):
+    def __init__(self, host, port, subprotocols=None):
         super(WebsocketFixture, self).__init__()
         self.host = host
         self.port = port
+        self.subprotocols = subprotocols
 
     async def asyncSetUp(self):
         dest_str = u'ws://%s:%d/' % (self.host, self.port)
         self.addAsyncCleanUp(self._clean_up)
-        self.socket = await websockets.connect(dest_str)
+        self.socket = await websockets.connect(
+            dest_str, subprotocols=self.subprotocols
+        )
 
     async def _clean_up(self):
         await self.socket.close()
@@ -66,10 +125,11 @@ class TestServer(base.AsyncTestCase):
         self.server, self.host, self.port = (
             server_fxtr.server, server_fxtr.host, server_fxtr.port
         )
+        self.consumer = server_fxtr.consumer
 
-    async def _get_server_ws(self):
+    async def _get_server_ws(self, subprotocols=None):
         fxtr = await self.useAsyncFixture(
-            WebsocketFixture(self.host, self.port)
+            WebsocketFixture(self.host, self.port, subprotocols)
         )
         return fxtr.socket
 
@@ -92,7 +152,7 @@ class TestServer(base.AsyncTestCase):
     async def test_command_unable_to_handle(self):
         ws = await self._get_server_ws()
         await ws.send(messages.Command(cmd_type='pong',
-                                       payload='{}').to_json())
+                                       payload='{"payload": 1}').to_json())
         resp = await ws.recv()
         self.assertEqual({
             "payload": {"description": "Unable to handle command type"},
@@ -108,6 +168,42 @@ class TestServer(base.AsyncTestCase):
                           "cmd_type": "error"},
                          json.loads(resp))
 
+    @base.asynctest
+    async def test_command_invalid_property(self):
+        ws = await self._get_server_ws()
+        await ws.send(messages.Command(cmd_type='ping',
+                                       payload='{"derp": 1}').to_json())
+        resp = await ws.recv()
+        self.assertEqual({"payload": {"description":
+                                      "Invalid message property"},
+                          "cmd_type": "error"},
+                         json.loads(resp))
+
+    @base.asynctest
+    async def test_command_payload_object(self):
+        ws = await self._get_server_ws()
+        await ws.send(json.dumps({'cmd_type': 'ping',
+                                  'payload': {'payload': 'derp'}}))
+        resp = await ws.recv()
+        self.assertEqual({'payload': {'payload': 'derp'}, 'cmd_type': 'pong'},
+                         json.loads(resp))
+
+    @base.asynctest
+    async def test_command_missing_property(self):
+        ws = await self._get_server_ws()
+        for command in ({'cmd_type': 'ping', 'payload': {}},
+                        {'cmd_type': 'ping'}):
+            await ws.send(json.dumps(command))
+            resp = await ws.recv()
+            self.assertEqual(
+                {'payload': {'description': 'Invalid message property'},
+                 'cmd_type': 'error'},
+                json.loads(resp))
+        # The connection is still usable
+        await ws.send(json.dumps({'cmd_type': 'ping',
+                                  'payload': {'payload': 'derp'}}))
+        self.assertEqual('pong', json.loads(await ws.recv())['cmd_type'])
+
     @base.asynctest
     async def test_command_ping(self):
         ws = await self._get_server_ws()
@@ -126,7 +222,8 @@ class TestServer(base.AsyncTestCase):
         await ws.send(cmd.to_json())
         resp = await ws.recv()
         self.assertEqual(
-            {'cmd_type': 'subscriptions', 'payload': {'services': ['derp']}},
+            {'cmd_type': 'subscriptions',
+             'payload': {'services': ['derp'], 'epoch': self.server.epoch}},
             json.loads(resp)
         )
 
@@ -141,6 +238,932 @@ class TestServer(base.AsyncTestCase):
         resp_cmp['payload']['services'] = set(resp_cmp['payload']['services'])
         self.assertEqual(
             {'cmd_type': 'subscriptions',
-             'payload': {'services': set(['derp1', 'derp2'])}},
+             'payload': {'services': set(['derp1', 'derp2']),
+                         'epoch': self.server.epoch}},
             resp_cmp
         )
+
+    async def _command(self, ws, cmd_type, payload):
+        await ws.send(json.dumps({'cmd_type': cmd_type, 'payload': payload}))
+        return json.loads(await ws.recv())
+
+    @base.asynctest
+    async def test_command_unsubscribe(self):
+        ws = await self._get_server_ws()
+        await self._command(ws, 'subscribe',
+                            {'services': ['compute', 'network', 'image.#']})
+        resp = await self._command(ws, 'unsubscribe',
+                                   {'services': ['network', 'image.#',
+                                                 'volume']})
+        self.assertEqual(
+            {'cmd_type': 'subscriptions_changed',
+             'payload': {'added': [], 'removed': ['network', 'image.#']}},
+            resp
+        )
+        self.consumer.notify(make_notification_body(
+            event_type='image.upload', publisher_id='image.host1'))
+        self.consumer.notify(make_notification_body())
+        resp = json.loads(await ws.recv())
+        self.assertEqual('compute', resp['payload']['service'])
+
+    @base.asynctest
+    async def test_command_empty_payload(self):
+        ws = await self._get_server_ws()
+        await self._command(ws, 'subscribe', {'services': ['compute']})
+        for cmd_type in ('unsubscribe', 'replace'):
+            resp = await self._command(ws, cmd_type, {})
+            self.assertEqual(
+                {'cmd_type': 'error',
+                 'payload': {'description': 'Invalid message property'}},
+                resp
+            )
+        # Neither changed the subscriptions
+        self.consumer.notify(make_notification_body())
+        resp = json.loads(await ws.recv())
+        self.assertEqual('compute', resp['payload']['service'])
+
+    @base.asynctest
+    async def test_command_replace(self):
+        ws = await self._get_server_ws()
+        await self._command(ws, 'subscribe',
+                            {'services': ['compute', 'network']})
+        resp = await self._command(ws, 'replace',
+                                   {'services': ['network', 'image',
+                                                 'image'],
+                                    'filters': ['payload.state == active']})
+        self.assertEqual(
+            {'cmd_type': 'subscriptions_changed',
+             'payload': {'added': ['image'], 'removed': ['compute']}},
+            resp
+        )
+        self.consumer.notify(make_notification_body(
+            payload={'state': 'building'}))
+        self.consumer.notify(make_notification_body(
+            publisher_id='image.host1', payload={'state': 'building'}))
+        self.consumer.notify(make_notification_body(
+            publisher_id='image.host1', payload={'state': 'active'}))
+        resp = json.loads(await ws.recv())
+        self.assertEqual('image', resp['payload']['service'])
+        self.assertEqual({'state': 'active'}, resp['payload']['payload'])
+
+    @base.asynctest
+    async def test_command_replace_invalid(self):
+        ws = await self._get_server_ws()
+        await self._command(ws, 'subscribe', {'services': ['compute']})
+        for payload in ({'services': ['image', 'image..x']},
+                        {'services': ['image', 1]},
+                        {'services': 'image'},
+                        {'services': ['image'], 'filters': ['payload.x']}):
+            resp = await self._command(ws, 'replace', payload)
+            self.assertEqual('error', resp['cmd_type'])
+        conn, = self.server.connections
+        self.assertEqual(['compute'],
+                         self.server._subscriptions.get_services(conn))
+
+    @base.asynctest
+    async def test_notification_delivered(self):
+        ws = await self._get_server_ws()
+        cmd = messages.Command(cmd_type='subscribe',
+                               payload='{"services": ["compute"]}')
+        await ws.send(cmd.to_json())
+        await ws.recv()
+        self.consumer.notify(make_notification_body(payload={'id': 'x'}))
+        resp = json.loads(await ws.recv())
+        self.assertEqual('notification', resp['cmd_type'])
+        self.assertEqual('compute', resp['payload']['service'])
+        self.assertEqual('compute.instance.create.end',
+                         resp['payload']['event_type'])
+        self.assertEqual({'id': 'x'}, resp['payload']['payload'])
+
+    @base.asynctest
+    async def test_command_subscribe_invalid_pattern(self):
+        ws = await self._get_server_ws()
+        cmd = messages.Command(cmd_type='subscribe',
+                               payload='{"services": ["compute..end"]}')
+        await ws.send(cmd.to_json())
+        resp = json.loads(await ws.recv())
+        self.assertEqual('error', resp['cmd_type'])
+
+    @base.asynctest
+    async def test_command_subscribe_invalid_filter(self):
+        ws = await self._get_server_ws()
+        cmd = messages.Command(
+            cmd_type='subscribe',
+            payload=json.dumps({'services': ['compute'],
+                                'filters': ['payload.state']}))
+        await ws.send(cmd.to_json())
+        resp = json.loads(await ws.recv())
+        self.assertEqual('error', resp['cmd_type'])
+        self.assertEqual({}, self.server._subscriptions._service_ids)
+
+    @base.asynctest
+    async def test_default_subprotocol(self):
+        ws = await self._get_server_ws(subprotocols=['derp'])
+        self.assertIsNone(ws.subprotocol)
+        await ws.send(messages.Command(cmd_type='ping',
+                                       payload='{"payload": 1}').to_json())
+        self.assertEqual('pong', json.loads(await ws.recv())['cmd_type'])
+
+    @testtools.skipIf(formats.msgpack is None, 'msgpack is not installed')
+    @base.asynctest
+    async def test_msgpack_subprotocol(self):
+        ws = await self._get_server_ws(subprotocols=['osws.msgpack'])
+        self.assertEqual('osws.msgpack', ws.subprotocol)
+        await ws.send(formats.MSGPACK.encode(
+            {'cmd_type': 'subscribe', 'payload': {'services': ['compute']}}
+        ))
+        resp = formats.MSGPACK.decode(await ws.recv())
+        self.assertEqual('subscriptions', resp['cmd_type'])
+        self.consumer.notify(make_notification_body(payload={'id': 'x'}))
+        data = await ws.recv()
+        self.assertIsInstance(data, bytes)
+        resp = formats.MSGPACK.decode(data)
+        self.assertEqual('notification', resp['cmd_type'])
+        self.assertEqual({'id': 'x'}, resp['payload']['payload'])
+
+    @testtools.skipIf(formats.msgpack is None, 'msgpack is not installed')
+    @base.asynctest
+    async def test_msgpack_decode_error(self):
+        ws = await self._get_server_ws(subprotocols=['osws.msgpack'])
+        await ws.send(b'\xc1')
+        resp = formats.MSGPACK.decode(await ws.recv())
+        self.assertEqual({'description': 'Message decode error'},
+                         resp['payload'])
+
+    @testtools.skipIf(formats.msgpack is None, 'msgpack is not installed')
+    @base.asynctest
+    async def test_msgpack_bytes_keys(self):
+        ws = await self._get_server_ws(subprotocols=['osws.msgpack'])
+        for command in ({b'cmd_type': 'ping', b'payload': {'payload': 1}},
+                        {'cmd_type': 'ping', 'payload': {b'payload': 1}}):
+            await ws.send(formats.MSGPACK.encode(command))
+            resp = formats.MSGPACK.decode(await ws.recv())
+            self.assertEqual({'description': 'Message decode error'},
+                             resp['payload'])
+        # The connection is still served
+        await ws.send(formats.MSGPACK.encode(
+            {'cmd_type': 'ping', 'payload': {'payload': 1}}))
+        resp = formats.MSGPACK.decode(await ws.recv())
+        self.assertEqual('pong', resp['cmd_type'])
+
+    async def _subscribe_ws(self, ws, **payload):
+        await ws.send(json.dumps({'cmd_type': 'subscribe',
+                                  'payload': payload}))
+
+    @base.asynctest
+    async def test_resume_from(self):
+        for state in ('building', 'active', 'error'):
+            self.consumer.notify(make_notification_body(
+                payload={'state': state}))
+        self.consumer.notify(make_notification_body(
+            event_type='port.create.end', publisher_id='network.host1'))
+        ws = await self._get_server_ws()
+        await self._subscribe_ws(ws, services=['compute'], resume_from=1)
+        resp = [json.loads(await ws.recv()) for _ in range(3)]
+        self.assertEqual([2, 3], [r['payload']['seq'] for r in resp[:2]])
+        self.assertEqual(['active', 'error'],
+                         [r['payload']['payload']['state'] for r in resp[:2]])
+        self.assertEqual('subscriptions', resp[2]['cmd_type'])
+        self.consumer.notify(make_notification_body())
+        resp = json.loads(await ws.recv())
+        self.assertEqual(5, resp['payload']['seq'])
+
+    @base.asynctest
+    async def test_resume_from_ahead(self):
+        # As after a restart without a journal, or from another worker
+        self.consumer.notify(make_notification_body())
+        ws = await self._get_server_ws()
+        await self._subscribe_ws(ws, services=['compute'], resume_from=999999)
+        resp = json.loads(await ws.recv())
+        self.assertEqual(
+            {'description': 'Notifications since 999999 are no longer '
+                            'available'},
+            resp['payload'])
+        resp = json.loads(await ws.recv())
+        self.assertEqual('subscriptions', resp['cmd_type'])
+
+    @base.asynctest
+    async def test_resume_from_other_epoch(self):
+        for _ in range(2):
+            self.consumer.notify(make_notification_body())
+        ws = await self._get_server_ws()
+        await self._subscribe_ws(ws, services=['compute'], resume_from=1,
+                                 epoch=self.server.epoch)
+        resp = json.loads(await ws.recv())
+        self.assertEqual(2, resp['payload']['seq'])
+        resp = json.loads(await ws.recv())
+        self.assertEqual(self.server.epoch, resp['payload']['epoch'])
+
+        await self._subscribe_ws(ws, services=['compute'], resume_from=1,
+                                 epoch='stale')
+        resp = json.loads(await ws.recv())
+        self.assertEqual('error', resp['cmd_type'])
+        resp = json.loads(await ws.recv())
+        self.assertEqual('subscriptions', resp['cmd_type'])
+
+        await self._subscribe_ws(ws, services=['compute'], resume_from=1,
+                                 epoch=1)
+        resp = json.loads(await ws.recv())
+        self.assertEqual({'description': 'Invalid epoch'}, resp['payload'])
+
+    @base.asynctest
+    async def test_resume_from_with_filters(self):
+        for state in ('building', 'active', 'error'):
+            self.consumer.notify(make_notification_body(
+                payload={'state': state}))
+        ws = await self._get_server_ws()
+        await self._subscribe_ws(ws, services=['compute.#'], resume_from=0,
+                                 filters=['payload.state == active'])
+        resp = json.loads(await ws.recv())
+        self.assertEqual(2, resp['payload']['seq'])
+        resp = json.loads(await ws.recv())
+        self.assertEqual('subscriptions', resp['cmd_type'])
+
+    @base.asynctest
+    async def test_coalesce_not_enabled(self):
+        ws = await self._get_server_ws()
+        await self._subscribe_ws(ws, services=['compute'], coalesce=True)
+        resp = json.loads(await ws.recv())
+        self.assertEqual({'description': 'Coalescing is not enabled'},
+                         resp['payload'])
+
+    @base.asynctest
+    async def test_resume_from_invalid(self):
+        ws = await self._get_server_ws()
+        await self._subscribe_ws(ws, services=['compute'], resume_from='x')
+        resp = json.loads(await ws.recv())
+        self.assertEqual({'description': 'Invalid resume_from'},
+                         resp['payload'])
+        await self._subscribe_ws(ws, services=['compute'], resume_from=True)
+        resp = json.loads(await ws.recv())
+        self.assertEqual({'description': 'Invalid resume_from'},
+                         resp['payload'])
+
+    @base.asynctest
+    async def test_rejected_subscribe_changes_nothing(self):
+        ws = await self._get_server_ws()
+        await self._subscribe_ws(ws, services=['compute'])
+        await ws.recv()
+        for payload in ({'filters': ['payload.state == nope'],
+                         'resume_from': -1},
+                        {'services': ['network'],
+                         'filters': ['payload.state == nope'],
+                         'coalesce': 'yes'},
+                        {'filters': 'payload.state == nope'}):
+            await self._subscribe_ws(ws, **payload)
+            resp = json.loads(await ws.recv())
+            self.assertEqual('error', resp['cmd_type'])
+        self.consumer.notify(make_notification_body(
+            event_type='port.create.end', publisher_id='network.host1'))
+        self.consumer.notify(make_notification_body(
+            payload={'state': 'active'}))
+        resp = json.loads(await ws.recv())
+        self.assertEqual('compute', resp['payload']['service'])
+
+
+class TestServerFanOut(base.TestCase):
+    def setUp(self):
+        super(TestServerFanOut, self).setUp()
+        self.consumer = FakeConsumer()
+        self.server = osws_server.Server(notify_source=self.consumer)
+
+    def _subscribe(self, service):
+        conn = FakeConnection()
+        self.server._subscriptions.add_subscription(service, conn)
+        return conn
+
+    def test_encodes_once(self):
+        conns = [self._subscribe('compute') for _ in range(3)]
+        with mock.patch.object(formats.JSONFormat, 'encode',
+                               return_value='encoded') as encode:
+            self.consumer.notify(make_notification_body())
+        self.assertEqual(1, encode.call_count)
+        for conn in conns:
+            self.assertEqual(['encoded'], conn.sent)
+
+    @testtools.skipIf(formats.msgpack is None, 'msgpack is not installed')
+    def test_encodes_once_per_format(self):
+        json_conns = [self._subscribe('compute') for _ in range(2)]
+        msgpack_conns = [FakeConnection(formats.MSGPACK) for _ in range(2)]
+        for conn in msgpack_conns:
+            self.server._subscriptions.add_subscription('compute', conn)
+        self.consumer.notify(make_notification_body())
+        self.assertIs(json_conns[0].sent[0], json_conns[1].sent[0])
+        self.assertIs(msgpack_conns[0].sent[0], msgpack_conns[1].sent[0])
+        self.assertEqual(json.loads(json_conns[0].sent[0]),
+                         formats.MSGPACK.decode(msgpack_conns[0].sent[0]))
+
+    @testtools.skipIf(formats.msgpack is None, 'msgpack is not installed')
+    @base.asynctest
+    async def test_unencodable_format_skipped(self):
+        conns = []
+        for subprotocol in ('osws.msgpack', 'osws.json', 'osws.msgpack'):
+            websocket = FakeWebsocket()
+            websocket.subprotocol = subprotocol
+            conn = osws_server.Connection(websocket,
+                                          self.server._subscriptions,
+                                          metrics=self.server._metrics)
+            self.server._subscriptions.add_subscription('compute', conn)
+            conns.append(conn)
+        # As for an integer which is valid JSON but too large for msgpack
+        with mock.patch.object(formats.MsgpackFormat, 'encode',
+                               side_effect=OverflowError):
+            self.consumer.notify(make_notification_body())
+        self.assertEqual([0, 1, 0], [conn.queue_depth for conn in conns])
+        stats = self.server._metrics
+        self.assertEqual(2, stats.unencodable.value)
+        self.assertEqual(1, stats.deliveries.value)
+
+    def test_sequence_numbers(self):
+        conn = self._subscribe('compute')
+        self.consumer.notify(make_notification_body())
+        self.consumer.notify(make_notification_body(
+            event_type='port.create.end', publisher_id='network.host1'))
+        self.consumer.notify(make_notification_body())
+        self.assertEqual([1, 3], [json.loads(data)['payload']['seq']
+                                  for data in conn.sent])
+
+    def test_only_subscribed_service(self):
+        compute = self._subscribe('compute')
+        network = self._subscribe('network')
+        self.consumer.notify(make_notification_body())
+        self.assertEqual(1, len(compute.sent))
+        self.assertEqual([], network.sent)
+
+    def test_pattern_subscriptions(self):
+        create = self._subscribe('*.instance.create.end')
+        host = self._subscribe('compute.host1')
+        errors = self._subscribe('#.error')
+        everything = self._subscribe('#')
+        self.consumer.notify(make_notification_body())
+        self.assertEqual(1, len(create.sent))
+        self.assertEqual(1, len(host.sent))
+        self.assertEqual([], errors.sent)
+        self.assertEqual(1, len(everything.sent))
+
+    def test_pattern_and_service_deliver_once(self):
+        conn = FakeConnection()
+        self.server._subscriptions.add_subscription('compute', conn)
+        self.server._subscriptions.add_subscription('compute.#', conn)
+        self.consumer.notify(make_notification_body())
+        self.assertEqual(1, len(conn.sent))
+
+    def test_filters(self):
+        errors = self._subscribe('compute')
+        self.server._subscriptions.set_filters(errors,
+                                               ['payload.state == error'])
+        everything = self._subscribe('compute')
+        self.consumer.notify(make_notification_body(
+            payload={'state': 'active'}))
+        self.assertEqual([], errors.sent)
+        self.assertEqual(1, len(everything.sent))
+        self.consumer.notify(make_notification_body(
+            payload={'state': 'error'}))
+        self.assertEqual(1, len(errors.sent))
+
+    @base.asynctest
+    async def test_coalescing(self):
+        server = osws_server.Server(notify_source=self.consumer,
+                                    coalesce_window=0.01)
+        coalesced = FakeConnection()
+        server._subscriptions.add_subscription('compute', coalesced)
+        server._subscriptions.set_coalescing(coalesced, True)
+        everything = FakeConnection()
+        server._subscriptions.add_subscription('compute', everything)
+        for state in ('building', 'active'):
+            server._handle_amqp_message(None, make_notification_body(
+                payload={'instance_id': 'a', 'state': state}))
+        self.assertEqual(2, len(everything.sent))
+        self.assertEqual([], coalesced.sent)
+        await asyncio.sleep(0.05)
+        self.assertEqual(1, len(coalesced.sent))
+        self.assertIs(everything.sent[1], coalesced.sent[0])
+
+    @base.asynctest
+    async def test_coalescing_respects_filters(self):
+        server = osws_server.Server(notify_source=self.consumer,
+                                    coalesce_window=0.01)
+        subs = server._subscriptions
+        building, active = FakeConnection(), FakeConnection()
+        for conn, state in ((building, 'building'), (active, 'active')):
+            subs.add_subscription('compute', conn)
+            subs.set_filters(conn, ['payload.state == %s' % state])
+            subs.set_coalescing(conn, True)
+        for state in ('building', 'active'):
+            server._handle_amqp_message(None, make_notification_body(
+                payload={'instance_id': 'a', 'state': state}))
+        await asyncio.sleep(0.05)
+        self.assertEqual(
+            ['building'],
+            [json.loads(data)['payload']['payload']['state']
+             for data in building.sent])
+        self.assertEqual(
+            ['active'],
+            [json.loads(data)['payload']['payload']['state']
+             for data in active.sent])
+
+    def test_bindings(self):
+        bindings = mock.Mock()
+        server = osws_server.Server(notify_source=FakeConsumer(),
+                                    bindings=bindings)
+        subs = server._subscriptions
+        a, b = FakeConnection(), FakeConnection()
+        subs.add_subscription('compute', a)
+        subs.add_subscription('compute', b)
+        subs.add_subscription('compute.instance.*', a)
+        subs.add_subscription('network.#', b)
+        self.assertEqual(
+            [mock.call.bind('compute.#'), mock.call.bind('#'),
+             mock.call.bind('#')],
+            bindings.mock_calls
+        )
+        bindings.reset_mock()
+        subs.remove_connection(a)
+        self.assertEqual([mock.call.unbind('#')], bindings.mock_calls)
+        subs.remove_connection(b)
+        self.assertEqual(
+            [mock.call.unbind('#'), mock.call.unbind('compute.#'),
+             mock.call.unbind('#')],
+            bindings.mock_calls
+        )
+
+    def test_source(self):
+        conn = self._subscribe('compute')
+        self.consumer.notify(make_notification_body(), source='cell1')
+        self.consumer.notify(make_notification_body())
+        self.assertEqual(
+            ['cell1', None],
+            [json.loads(data)['payload'].get('source') for data in conn.sent]
+        )
+
+    def test_undecodable_notification(self):
+        conn = self._subscribe('compute')
+        self.consumer.notify('{,}')
+        self.assertEqual([], conn.sent)
+
+
+class TestSubscriptionMap(base.TestCase):
+    def setUp(self):
+        super(TestSubscriptionMap, self).setUp()
+        self.subs = osws_server.SubscriptionMap()
+
+    def _route(self, service, event_type='x.y'):
+        return set(self.subs.route(messages.Notification(
+            service=service, event_type=event_type, publisher_id=None,
+            priority='INFO', timestamp=None, payload={})))
+
+    def test_route(self):
+        a, b = FakeConnection(), FakeConnection()
+        self.subs.add_subscription('compute', a)
+        self.subs.add_subscription('compute', b)
+        self.subs.add_subscription('compute', b)
+        self.subs.add_subscription('network.#', b)
+        self.assertEqual({a, b}, self._route('compute'))
+        self.assertEqual({b}, self._route('image', 'network.port.create'))
+        self.assertEqual(set(), self._route('image'))
+        self.assertEqual(['compute'], self.subs.get_services(a))
+        self.assertEqual(['compute', 'network.#'], self.subs.get_services(b))
+        self.assertEqual({'compute': 2, 'network.#': 1},
+                         self.subs.subscriber_counts())
+
+    def test_remove_connection(self):
+        conns = [FakeConnection() for _ in range(4)]
+        for conn in conns:
+            self.subs.add_subscription('compute', conn)
+            self.subs.add_subscription('network', conn)
+        self.subs.remove_connection(conns[0])
+        self.subs.remove_connection(conns[2])
+        self.assertEqual({conns[1], conns[3]}, self._route('compute'))
+        self.assertEqual({conns[1], conns[3]}, self._route('network'))
+        self.assertEqual([], self.subs.get_services(conns[0]))
+        # Positions moved by the removals are still right
+        self.subs.remove_subscription('network', conns[3])
+        self.assertEqual({conns[1]}, self._route('network'))
+        self.assertEqual({conns[1], conns[3]}, self._route('compute'))
+
+    def test_nothing_retained(self):
+        conns = [FakeConnection() for _ in range(3)]
+        for i, conn in enumerate(conns):
+            self.subs.add_subscription('compute', conn)
+            self.subs.add_subscription('service-%d' % i, conn)
+            self.subs.add_subscription('compute.#', conn)
+        self.subs.remove_subscription('service-0', conns[0])
+        self.assertNotIn('service-0', self.subs._service_ids)
+        for conn in conns:
+            self.subs.remove_connection(conn)
+        self.subs.get_connections('compute')
+        self.subs.get_services(conns[0])
+        self.assertEqual({}, self.subs._service_ids)
+        self.assertEqual({}, self.subs._connection_ids)
+        self.assertEqual({}, self.subs._connection_patterns)
+        self.assertEqual({}, self.subs.subscriber_counts())
+        self.assertEqual(set(), self._route('compute', 'compute.x'))
+
+    def test_ids_reused(self):
+        a, b = FakeConnection(), FakeConnection()
+        self.subs.add_subscription('compute', a)
+        self.subs.remove_connection(a)
+        self.subs.add_subscription('network', b)
+        self.assertEqual(1, len(self.subs._connection_subs))
+        self.assertEqual(1, len(self.subs._service_names))
+
+    def test_replace(self):
+        a, b = FakeConnection(), FakeConnection()
+        for service in ('compute', 'network', 'compute.#'):
+            self.subs.add_subscription(service, a)
+        self.subs.add_subscription('network', b)
+        self.assertEqual(
+            (['image', 'image.#'], ['compute', 'compute.#']),
+            self.subs.replace(a, ['network', 'image', 'image.#', 'image'])
+        )
+        self.assertEqual(['network', 'image', 'image.#'],
+                         self.subs.get_services(a))
+        self.assertEqual({a, b}, self._route('network'))
+        self.assertEqual(([], ['network', 'image', 'image.#']),
+                         self.subs.replace(a, []))
+        self.assertEqual({b}, self._route('network', 'image.x'))
+
+    def test_last_pattern_removed(self):
+        conn = FakeConnection()
+        self.subs.add_subscription('compute.#', conn)
+        self.subs.remove_subscription('compute.#', conn)
+        self.assertEqual({}, self.subs._connection_ids)
+        self.assertEqual(set(), self._route('compute', 'compute.x'))
+
+
+class TestConnectionSendQueue(base.TestCase):
+    def _connection(self, **kwargs):
+        self.websocket = FakeWebsocket()
+        conn = osws_server.Connection(self.websocket,
+                                      osws_server.SubscriptionMap(),
+                                      **kwargs)
+        conn.start()
+        self.addCleanup(conn.stop)
+        return conn
+
+    @base.asynctest
+    async def test_sends_in_order(self):
+        conn = self._connection()
+        for i in range(3):
+            conn.send_encoded(str(i))
+        self.assertEqual(3, conn.queue_depth)
+        await asyncio.sleep(0)
+        self.assertEqual(['0', '1', '2'], self.websocket.sent)
+        self.assertEqual(0, conn.queue_depth)
+
+    @base.asynctest
+    async def test_drop_oldest(self):
+        conn = self._connection(send_queue_size=2,
+                                slow_consumer_policy='drop_oldest')
+        self.websocket.unblocked.clear()
+        for i in range(4):
+            conn.send_encoded(str(i))
+        self.assertEqual(2, conn.queue_depth)
+        self.assertEqual(2, conn.dropped)
+        self.websocket.unblocked.set()
+        await asyncio.sleep(0)
+        self.assertEqual(['2', '3'], self.websocket.sent)
+
+    @base.asynctest
+    async def test_drop_newest(self):
+        conn = self._connection(send_queue_size=2,
+                                slow_consumer_policy='drop_newest')
+        self.websocket.unblocked.clear()
+        for i in range(4):
+            conn.send_encoded(str(i))
+        self.assertEqual(2, conn.dropped)
+        self.websocket.unblocked.set()
+        await asyncio.sleep(0)
+        self.assertEqual(['0', '1'], self.websocket.sent)
+
+    @base.asynctest
+    async def test_drop_oldest_while_sending(self):
+        stats = metrics.Metrics()
+        conn = self._connection(send_queue_size=1,
+                                slow_consumer_policy='drop_oldest',
+                                metrics=stats)
+        self.websocket.unblocked.clear()
+        now = time.monotonic()
+        conn.send_encoded('0', now - 100)
+        # The writer takes the first message and waits to send it
+        await asyncio.sleep(0)
+        conn.send_encoded('1', now)
+        conn.send_encoded('2', now)
+        self.assertEqual(1, conn.dropped)
+        self.websocket.unblocked.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(['0', '2'], self.websocket.sent)
+        # The latency of the message in flight, not of the dropped one
+        self.assertEqual(2, stats.send_latency.count)
+        self.assertGreaterEqual(stats.send_latency.sum, 100)
+
+    @base.asynctest
+    async def test_disconnect(self):
+        conn = self._connection(send_queue_size=1,
+                                slow_consumer_policy='disconnect',
+                                slow_consumer_timeout=0.01)
+        self.websocket.unblocked.clear()
+        for i in range(3):
+            conn.send_encoded(str(i))
+        self.assertEqual(3, conn.queue_depth)
+        self.assertIsNone(self.websocket.closed)
+        await asyncio.sleep(0.05)
+        self.assertEqual(1008, self.websocket.closed[0])
+        # Still subscribed until the close completes, but nothing is queued
+        for i in range(10):
+            conn.send_encoded(str(i))
+        self.assertEqual(0, conn.queue_depth)
+
+    @base.asynctest
+    async def test_disconnect_recovers(self):
+        conn = self._connection(send_queue_size=1,
+                                slow_consumer_policy='disconnect',
+                                slow_consumer_timeout=0.01)
+        for i in range(3):
+            conn.send_encoded(str(i))
+        await asyncio.sleep(0.05)
+        self.assertIsNone(self.websocket.closed)
+        self.assertEqual(['0', '1', '2'], self.websocket.sent)
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, osws_server.Connection,
+                          FakeWebsocket(), osws_server.SubscriptionMap(),
+                          slow_consumer_policy='derp')
+
+
+class TestConnectionBatching(base.TestCase):
+    def setUp(self):
+        super(TestConnectionBatching, self).setUp()
+        self.websocket = FakeWebsocket()
+        self.conn = osws_server.Connection(self.websocket,
+                                           osws_server.SubscriptionMap(),
+                                           max_batch_count=10)
+        self.conn.start()
+        self.addCleanup(self.conn.stop)
+
+    async def _subscribe(self, batch):
+        self.websocket.sent = []
+        await self.conn._handle_message(json.dumps({
+            'cmd_type': 'subscribe',
+            'payload': {'services': ['compute'], 'batch': batch}
+        }))
+        await asyncio.sleep(0)
+        return [json.loads(data) for data in self.websocket.sent]
+
+    def _received(self):
+        return [json.loads(data) for data in self.websocket.sent]
+
+    @base.asynctest
+    async def test_flush_on_count(self):
+        await self._subscribe({'max_count': 2, 'max_delay_ms': 1000})
+        self.websocket.sent = []
+        for i in range(5):
+            self.conn.send_encoded(json.dumps({'n': i}))
+        await asyncio.sleep(0)
+        self.assertEqual([{'cmd_type': 'batch',
+                           'payload': {'commands': [{'n': 0}, {'n': 1}]}},
+                          {'cmd_type': 'batch',
+                           'payload': {'commands': [{'n': 2}, {'n': 3}]}}],
+                         self._received())
+
+    @base.asynctest
+    async def test_flush_on_bytes(self):
+        await self._subscribe({'max_bytes': 10, 'max_delay_ms': 1000})
+        self.websocket.sent = []
+        self.conn.send_encoded('"abcdef"')
+        self.conn.send_encoded('"ghijkl"')
+        await asyncio.sleep(0)
+        self.assertEqual([['abcdef', 'ghijkl']],
+                         [r['payload']['commands'] for r in self._received()])
+
+    @base.asynctest
+    async def test_flush_on_delay(self):
+        await self._subscribe({'max_delay_ms': 10})
+        self.websocket.sent = []
+        self.conn.send_encoded('1')
+        await asyncio.sleep(0)
+        self.assertEqual([], self.websocket.sent)
+        await asyncio.sleep(0.05)
+        self.assertEqual([[1]],
+                         [r['payload']['commands'] for r in self._received()])
+
+    @base.asynctest
+    async def test_flushed_before_reply(self):
+        await self._subscribe({'max_delay_ms': 1000})
+        self.conn.send_encoded('1')
+        resp = await self._subscribe(False)
+        self.assertEqual(['batch', 'subscriptions'],
+                         [r['cmd_type'] for r in resp])
+        self.websocket.sent = []
+        self.conn.send_encoded('2')
+        await asyncio.sleep(0)
+        self.assertEqual([2], self._received())
+
+    @base.asynctest
+    async def test_invalid(self):
+        for batch in ({'max_count': 11}, {'max_count': 0}, {'derp': 1}, 5):
+            resp = await self._subscribe(batch)
+            self.assertEqual('error', resp[0]['cmd_type'])
+            self.assertTrue(resp[0]['payload']['description'].startswith(
+                'Invalid batch'))
+        self.assertIsNone(self.conn._batch)
+
+    @testtools.skipIf(formats.msgpack is None, 'msgpack is not installed')
+    @base.asynctest
+    async def test_msgpack(self):
+        self.conn.format = formats.MSGPACK
+        self.conn._batch = (2, 1000, 1)
+        for i in range(2):
+            self.conn.send_encoded(formats.MSGPACK.encode({'n': i}))
+        await asyncio.sleep(0)
+        self.assertEqual({'cmd_type': 'batch',
+                          'payload': {'commands': [{'n': 0}, {'n': 1}]}},
+                         formats.MSGPACK.decode(self.websocket.sent[0]))
+
+
+class TestConnectionReplay(base.TestCase):
+    def setUp(self):
+        super(TestConnectionReplay, self).setUp()
+        self.server = osws_server.Server(notify_source=FakeConsumer())
+        for _ in range(20):
+            self._notify()
+
+    def _notify(self):
+        self.server._handle_amqp_message(None, make_notification_body())
+
+    def _connection(self, **kwargs):
+        self.websocket = FakeWebsocket()
+        conn = osws_server.Connection(self.websocket,
+                                      self.server._subscriptions,
+                                      replay_log=self.server._replay_log,
+                                      **kwargs)
+        conn.start()
+        self.addCleanup(conn.stop)
+        return conn
+
+    def _resume(self, conn, seq):
+        return asyncio.ensure_future(conn._handle_message(json.dumps({
+            'cmd_type': 'subscribe',
+            'payload': {'services': ['compute'], 'resume_from': seq}})))
+
+    def _sent(self):
+        return [json.loads(data) for data in self.websocket.sent]
+
+    @base.asynctest
+    async def test_flow_controlled(self):
+        for policy in ('drop_oldest', 'drop_newest', 'disconnect'):
+            conn = self._connection(send_queue_size=5,
+                                    slow_consumer_policy=policy)
+            await self._resume(conn, 0)
+            await asyncio.sleep(0)
+            resp = self._sent()
+            self.assertEqual(0, conn.dropped)
+            self.assertEqual(list(range(1, 21)),
+                             [r['payload']['seq'] for r in resp[:-1]])
+            self.assertEqual('subscriptions', resp[-1]['cmd_type'])
+            self.assertIsNone(self.websocket.closed)
+
+    @base.asynctest
+    async def test_live_held(self):
+        conn = self._connection(send_queue_size=5)
+        self.websocket.unblocked.clear()
+        replaying = self._resume(conn, 10)
+        await asyncio.sleep(0)
+        self.assertFalse(replaying.done())
+        self._notify()
+        self._notify()
+        self.websocket.unblocked.set()
+        await replaying
+        await asyncio.sleep(0)
+        resp = self._sent()
+        self.assertEqual(0, conn.dropped)
+        self.assertEqual(list(range(11, 21)),
+                         [r['payload']['seq'] for r in resp[:10]])
+        self.assertEqual('subscriptions', resp[10]['cmd_type'])
+        self.assertEqual([21, 22], [r['payload']['seq'] for r in resp[11:]])
+
+    @base.asynctest
+    async def test_live_held_bounded(self):
+        conn = self._connection(send_queue_size=5,
+                                slow_consumer_policy='drop_oldest')
+        self.websocket.unblocked.clear()
+        replaying = self._resume(conn, 10)
+        await asyncio.sleep(0)
+        for _ in range(8):
+            self._notify()
+        self.assertEqual(3, conn.dropped)
+        self.websocket.unblocked.set()
+        await replaying
+        await asyncio.sleep(0)
+        resp = self._sent()
+        self.assertEqual(list(range(24, 29)),
+                         [r['payload']['seq'] for r in resp[11:]])
+
+
+class TestConnectionHistory(base.TestCase):
+    def setUp(self):
+        super(TestConnectionHistory, self).setUp()
+        path = self.useFixture(fixtures.TempDir()).path
+        self.journal = journal.Journal(path, segment_size=4096)
+        self.addCleanup(self.journal.close)
+        self.server = osws_server.Server(notify_source=FakeConsumer(),
+                                         journal=self.journal)
+        for state in ('building', 'active', 'error'):
+            self.server._handle_amqp_message(None, make_notification_body(
+                payload={'state': state}))
+
+    def _connection(self, services=('compute',), **kwargs):
+        self.websocket = FakeWebsocket()
+        self.subscriptions = osws_server.SubscriptionMap()
+        conn = osws_server.Connection(self.websocket, self.subscriptions,
+                                      journal=self.journal, **kwargs)
+        for service in services:
+            self.subscriptions.add_subscription(service, conn)
+        conn.start()
+        self.addCleanup(conn.stop)
+        return conn
+
+    async def _history(self, conn, **payload):
+        await conn._handle_message(json.dumps({'cmd_type': 'history',
+                                               'payload': payload}))
+        await asyncio.sleep(0)
+        return [json.loads(data) for data in self.websocket.sent]
+
+    @base.asynctest
+    async def test_seq_range(self):
+        resp = await self._history(self._connection(), start_seq=2)
+        self.assertEqual([2, 3], [r['payload']['seq'] for r in resp[:2]])
+        self.assertEqual('error', resp[1]['payload']['payload']['state'])
+        self.assertEqual({'cmd_type': 'history_end',
+                          'payload': {'count': 2}}, resp[2])
+
+    @base.asynctest
+    async def test_flow_controlled(self):
+        conn = self._connection(send_queue_size=2,
+                                slow_consumer_policy='drop_newest')
+        resp = await self._history(conn)
+        self.assertEqual(0, conn.dropped)
+        self.assertEqual([1, 2, 3], [r['payload']['seq'] for r in resp[:3]])
+
+    @base.asynctest
+    async def test_subscriptions(self):
+        self.server._handle_amqp_message(None, make_notification_body(
+            event_type='port.create.end', publisher_id='network.host1'))
+        resp = await self._history(self._connection(services=['network']))
+        self.assertEqual([4], [r['payload']['seq'] for r in resp[:-1]])
+
+        resp = await self._history(self._connection(services=['port.#']))
+        self.assertEqual([4], [r['payload']['seq'] for r in resp[:-1]])
+
+        resp = await self._history(self._connection(services=[]))
+        self.assertEqual([{'cmd_type': 'history_end',
+                           'payload': {'count': 0}}], resp)
+
+    @base.asynctest
+    async def test_filters(self):
+        conn = self._connection()
+        self.subscriptions.set_filters(conn, ['payload.state != active'])
+        resp = await self._history(conn)
+        self.assertEqual([1, 3], [r['payload']['seq'] for r in resp[:-1]])
+
+    @base.asynctest
+    async def test_not_parsed(self):
+        self.server._handle_amqp_message(None, make_notification_body(
+            event_type='port.create.end', publisher_id='network.host1'))
+        conn = self._connection(services=['compute', 'port.#'])
+        # Subscriptions are matched by the key journalled with each record
+        with mock.patch.object(osws_server.jsonutils, 'loads',
+                               side_effect=AssertionError):
+            await conn._handle_history_message(
+                messages.History(start_seq=2))
+        await asyncio.sleep(0)
+        resp = [json.loads(data) for data in self.websocket.sent]
+        self.assertEqual([2, 3, 4], [r['payload']['seq'] for r in resp[:-1]])
+
+    @base.asynctest
+    async def test_services(self):
+        self.server._handle_amqp_message(None, make_notification_body(
+            event_type='port.create.end', publisher_id='network.host1'))
+        resp = await self._history(self._connection(),
+                                   services=['network'], start_seq=2)
+        self.assertEqual([4], [r['payload']['seq'] for r in resp[:-1]])
+        resp = await self._history(self._connection(), services='network')
+        self.assertEqual('error', resp[0]['cmd_type'])
+
+    @base.asynctest
+    async def test_invalid_range(self):
+        resp = await self._history(self._connection(), start_seq='x')
+        self.assertEqual({'description': 'Invalid start_seq'},
+                         resp[0]['payload'])
+
+    @base.asynctest
+    async def test_not_enabled(self):
+        self.journal = None
+        resp = await self._history(self._connection())
+        self.assertEqual({'description': 'History is not enabled'},
+                         resp[0]['payload'])
+
+    def test_sequence_recovered(self):
+        server = osws_server.Server(notify_source=FakeConsumer(),
+                                    journal=self.journal)
+        self.assertEqual(3, server._seq)
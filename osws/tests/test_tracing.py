@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import os
+
+import fixtures
+
+from osws import server as osws_server
+from osws.tests import base
+from osws.tests import test_server
+from osws import tracing
+
+
+def parse_trace(line):
+    fields = line.split()
+    return dict(field.split('=', 1) for field in fields[1:])
+
+
+class TestTracer(base.TestCase):
+    def setUp(self):
+        super(TestTracer, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'trace.log')
+
+    def _traces(self):
+        with open(self.path) as trace_file:
+            return [parse_trace(line) for line in trace_file]
+
+    def test_sampled(self):
+        tracer = tracing.Tracer(self.path, sample_rate=3)
+        sampled = [tracer.sample(i) is not None for i in range(7)]
+        tracer.close()
+        self.assertEqual([False, False, True, False, False, True, False],
+                         sampled)
+
+    def test_written_once_published_and_sent(self):
+        tracer = tracing.Tracer(self.path, sample_rate=1)
+        trace = tracer.sample(0)
+        trace.decoded()
+        trace.routed(5)
+        trace.enqueue()
+        trace.enqueue()
+        trace.published()
+        trace.write(1)
+        self.assertEqual([], self._traces())
+        trace.write(2)
+        traces = self._traces()
+        tracer.close()
+        self.assertEqual(1, len(traces))
+        self.assertEqual('5', traces[0]['seq'])
+        self.assertEqual('2', traces[0]['queued'])
+        self.assertEqual('1000000/1000000/2000000', traces[0]['write'])
+
+    def test_no_subscribers(self):
+        tracer = tracing.Tracer(self.path, sample_rate=1)
+        trace = tracer.sample(0)
+        trace.published()
+        tracer.close()
+        self.assertEqual('0', self._traces()[0]['queued'])
+
+    def test_expired(self):
+        tracer = tracing.Tracer(self.path, sample_rate=1, timeout=10)
+        trace = tracer.sample(0)
+        trace.enqueue()
+        trace.published()
+        tracer.sample(5)
+        self.assertEqual([], self._traces())
+        tracer.sample(11)
+        traces = self._traces()
+        tracer.close()
+        self.assertEqual(['1'], [t['trace'] for t in traces])
+        self.assertEqual('0', traces[0]['written'])
+
+    def test_invalid_sample_rate(self):
+        self.assertRaises(ValueError, tracing.Tracer, self.path,
+                          sample_rate=0)
+
+
+class TestServerTracing(base.TestCase):
+    @base.asynctest
+    async def test_traced(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'trace.log')
+        tracer = tracing.Tracer(path, sample_rate=2)
+        consumer = test_server.FakeConsumer()
+        srv = osws_server.Server(notify_source=consumer, tracer=tracer)
+        websocket = test_server.FakeWebsocket()
+        conn = osws_server.Connection(websocket, srv._subscriptions)
+        srv._subscriptions.add_subscription('compute', conn)
+        conn.start()
+        try:
+            for _ in range(4):
+                consumer.notify(test_server.make_notification_body())
+            await asyncio.sleep(0)
+        finally:
+            conn.stop()
+            tracer.close()
+        self.assertEqual(4, len(websocket.sent))
+        with open(path) as trace_file:
+            traces = [parse_trace(line) for line in trace_file]
+        self.assertEqual(['2', '4'], [t['seq'] for t in traces])
+        for trace in traces:
+            self.assertEqual('1', trace['queued'])
+            self.assertEqual('1', trace['written'])
+            self.assertLessEqual(int(trace['decode']), int(trace['route']))
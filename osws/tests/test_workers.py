@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+
+from osws.tests import base
+from osws import workers
+
+
+class TestWorkerPool(base.TestCase):
+    def setUp(self):
+        super(TestWorkerPool, self).setUp()
+        self.read_fd, self.write_fd = os.pipe()
+        self.addCleanup(os.close, self.read_fd)
+        self.addCleanup(os.close, self.write_fd)
+        self.pool = workers.WorkerPool(2, self._target)
+        self.pool.RESTART_DELAY = 0
+        self.addCleanup(self._stop_pool)
+
+    def _target(self, index):
+        os.write(self.write_fd, str(index).encode('ascii'))
+        if index == 1:
+            raise ValueError('Worker failed')
+
+    def _read_started(self, count):
+        started = b''
+        while len(started) < count:
+            started += os.read(self.read_fd, count - len(started))
+        return sorted(started.decode('ascii'))
+
+    def _stop_pool(self):
+        self.pool.stop()
+        while self.pool._workers:
+            self.pool._reap()
+
+    def test_restarts_exited_workers(self):
+        self.pool.start()
+        self.assertEqual(['0', '1'], self._read_started(2))
+        self.pool._reap()
+        self.pool._reap()
+        # Each reaped worker has been replaced, keeping its index
+        self.assertEqual(2, len(self._read_started(2)))
+        self.assertEqual([0, 1], sorted(self.pool._workers.values()))
+
+    def test_stopped_workers_not_restarted(self):
+        self.pool.start()
+        self._read_started(2)
+        self.pool.stop()
+        self.pool._reap()
+        self.pool._reap()
+        self.assertEqual({}, self.pool._workers)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Sampled tracing of notifications through the server.
+
+One in every sample_rate notifications delivered by RabbitMQ is traced.
+Its trace records, relative to the delivery, when it was decoded, when it
+was routed, when it was queued for each client and when the write to each
+client completed. Once every client it was queued for has been written to,
+or after timeout seconds, the trace is written as one line to a rotating
+file::
+
+    1697625600.123456 trace=7 seq=42 decode=31 route=58 queued=1000
+    enqueue=66/410/530 written=998 write=220/1900/25000
+
+(on a single line). Times are in microseconds since delivery, and those of
+enqueue and write are the 50th percentile, 99th percentile and maximum
+over the clients. Clients which were queued the notification but never
+written it, because it was dropped or they disconnected, account for the
+difference between queued and written.
+"""
+
+import collections
+import logging
+import logging.handlers
+import time
+
+
+def _spread(offsets):
+    if not offsets:
+        return '-'
+    offsets.sort()
+    last = len(offsets) - 1
+    return '%d/%d/%d' % (offsets[last // 2], offsets[int(last * 0.99)],
+                         offsets[last])
+
+
+class Trace(object):
+    """The timeline of one notification, in time.monotonic() times."""
+    __slots__ = ('tracer', 'trace_id', 'wall_time', 'received_at', 'seq',
+                 'decoded_at', 'routed_at', 'enqueued', 'written',
+                 'pending')
+
+    def __init__(self, tracer, trace_id, received_at):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.wall_time = time.time()
+        self.received_at = received_at
+        self.seq = None
+        self.decoded_at = None
+        self.routed_at = None
+        self.enqueued = []
+        self.written = []
+        # Writes outstanding, None until routing has finished
+        self.pending = None
+
+    def decoded(self):
+        self.decoded_at = time.monotonic()
+
+    def routed(self, seq):
+        self.seq = seq
+        self.routed_at = time.monotonic()
+
+    def enqueue(self):
+        """Record the notification being queued for a client."""
+        self.enqueued.append(time.monotonic())
+        if self.pending is not None:
+            self.pending += 1
+
+    def write(self, now):
+        """Record a client's write completing at now."""
+        self.written.append(now)
+        if self.pending is not None:
+            self.pending -= 1
+            if not self.pending:
+                self.tracer.finish(self)
+
+    def published(self):
+        """Record that the notification was handed to every client."""
+        self.pending = len(self.enqueued) - len(self.written)
+        if not self.pending:
+            self.tracer.finish(self)
+
+    def format(self):
+        def offset(when):
+            if when is None:
+                return '-'
+            return '%d' % ((when - self.received_at) * 1000000)
+
+        return ('%.6f trace=%d seq=%s decode=%s route=%s queued=%d '
+                'enqueue=%s written=%d write=%s' % (
+                    self.wall_time, self.trace_id, self.seq,
+                    offset(self.decoded_at), offset(self.routed_at),
+                    len(self.enqueued),
+                    _spread([int((t - self.received_at) * 1000000)
+                             for t in self.enqueued]),
+                    len(self.written),
+                    _spread([int((t - self.received_at) * 1000000)
+                             for t in self.written])))
+
+
+class Tracer(object):
+    """Start traces for a sample of notifications and write them out.
+
+    Traces are written to the logger given, which by default is one
+    writing to a rotating file at path.
+    """
+
+    def __init__(self, path=None, sample_rate=1000, max_bytes=10 * 1024 * 1024,
+                 backup_count=5, timeout=60, logger=None):
+        if sample_rate < 1:
+            raise ValueError('Invalid sample rate %s' % sample_rate)
+        self._handler = None
+        if logger is None:
+            # Not registered with logging, so traces never reach the
+            # handlers of the root logger
+            logger = logging.Logger(__name__)
+            self._handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backup_count
+            )
+            self._handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(self._handler)
+        self._logger = logger
+        self._sample_rate = sample_rate
+        self._timeout = timeout
+        self._countdown = sample_rate
+        self._next_id = 0
+        self._open = collections.OrderedDict()
+
+    def sample(self, received_at):
+        """Return a Trace if this delivery should be traced, else None."""
+        self._countdown -= 1
+        if self._countdown:
+            return None
+        self._countdown = self._sample_rate
+        self._expire(received_at)
+        self._next_id += 1
+        trace = Trace(self, self._next_id, received_at)
+        self._open[trace.trace_id] = trace
+        return trace
+
+    def finish(self, trace):
+        if self._open.pop(trace.trace_id, None) is not None:
+            self._logger.info(trace.format())
+
+    def _expire(self, now):
+        deadline = now - self._timeout
+        while self._open:
+            trace = next(iter(self._open.values()))
+            if trace.received_at > deadline:
+                return
+            self.finish(trace)
+
+    def close(self):
+        """Write out the traces still open and close the trace file."""
+        for trace in list(self._open.values()):
+            self.finish(trace)
+        if self._handler is not None:
+            self._logger.removeHandler(self._handler)
+            self._handler.close()
+            self._handler = None
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import os
+import signal
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+    """Run a function in forked worker processes, restarting any which exit.
+
+    The target is called with the index of the worker, which stays the same
+    when a worker is restarted.
+    """
+    RESTART_DELAY = 1
+
+    def __init__(self, num_workers, target):
+        self._num_workers = num_workers
+        self._target = target
+        self._workers = {}
+        self._running = False
+
+    def run(self):
+        """Start the workers and supervise them until stopped by a signal."""
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        self.start()
+        while self._workers:
+            self._reap()
+
+    def start(self):
+        self._running = True
+        for index in range(self._num_workers):
+            self._spawn(index)
+
+    def stop(self):
+        self._running = False
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _handle_signal(self, signum, frame):
+        LOGGER.info('Received signal %d, stopping workers', signum)
+        self.stop()
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                self._target(index)
+            except BaseException:
+                LOGGER.exception('Worker %d failed', index)
+                status = 1
+            finally:
+                os._exit(status)
+        LOGGER.info('Started worker %d with pid %d', index, pid)
+        self._workers[pid] = index
+
+    def _reap(self):
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            self._workers.clear()
+            return
+        index = self._workers.pop(pid, None)
+        if index is None:
+            return
+        if self._running:
+            LOGGER.warning('Worker %d with pid %d exited with status %d, '
+                           'restarting', index, pid, status)
+            time.sleep(self.RESTART_DELAY)
+            if self._running:
+                self._spawn(index)
+        else:
+            LOGGER.info('Worker %d with pid %d stopped', index, pid)